@@ -0,0 +1,130 @@
+"""
+Map generators and round trip helpers for the tests
+"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from xml.etree import ElementTree
+
+import png
+
+from tile_extract import TileExtractor, FLIP_FLAGS, flip_tile
+
+
+class TempDirTestCase(unittest.TestCase):
+    """
+    A test case with a fresh folder in self.temp_dir
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def path(self, *names):
+        return os.path.join(self.temp_dir, *names)
+
+
+def make_tiles(num_tiles, tile_size, channels=3, seed=0, colors=None):
+    """
+    :param num_tiles: The number of distinct tiles
+    :param tile_size: The size of the tiles
+    :param channels: The bytes per pixel
+    :param seed: The random seed
+    :param colors: list of pixel bytes to draw from, None for random pixels
+    :return: list of tile bytes, rows one after the other
+    """
+    rng = random.Random(seed)
+    tiles = set()
+    while len(tiles) < num_tiles:
+        if colors is None:
+            tile = bytes(rng.randrange(256) for _ in range(tile_size * tile_size * channels))
+        else:
+            tile = b''.join(rng.choice(colors) for _ in range(tile_size * tile_size))
+        tiles.add(tile)
+    return sorted(tiles)
+
+
+def make_map_rows(tiles, tiles_width, tiles_height, tile_size, channels=3, seed=0, flip_rate=0.0):
+    """
+    Lays random tiles out on a map
+    :param tiles: list of tile bytes, see make_tiles
+    :param tiles_width: The number of tiles across
+    :param tiles_height: The number of tiles down
+    :param flip_rate: The share of tiles drawn flipped or rotated
+    :return: list of row bytes
+    """
+    rng = random.Random(seed)
+    rows = [bytearray() for _ in range(0, tiles_height * tile_size)]
+    row_bytes = tile_size * channels
+    for tile_y in range(0, tiles_height):
+        for _ in range(0, tiles_width):
+            tile = rng.choice(tiles)
+            if rng.random() < flip_rate:
+                tile = flip_tile(tile, tile_size, channels, rng.randrange(1, 8) << 29)
+            for y in range(0, tile_size):
+                rows[tile_y * tile_size + y].extend(tile[y * row_bytes:(y + 1) * row_bytes])
+    return [bytes(row) for row in rows]
+
+
+def write_png(file_name, rows, width, channels=3, palette=None):
+    """
+    Writes rows as an RGB, RGBA or palette PNG
+    :param palette: list of (R, G, B) colors for 1 channel rows
+    """
+    if palette is not None:
+        writer = png.Writer(width, len(rows), palette=palette, bitdepth=8)
+    else:
+        writer = png.Writer(width, len(rows), greyscale=False, alpha=channels == 4)
+    with open(file_name, 'wb') as png_file:
+        writer.write(png_file, rows)
+
+
+def read_rgba_rows(file_name):
+    """
+    :return: tuple of (width, height, list of RGBA row bytes) of a PNG
+    """
+    width, height, rows, _ = png.Reader(filename=file_name).asRGBA8()
+    return width, height, [bytes(row) for row in rows]
+
+
+def reconstruct_map(tmx_file):
+    """
+    Draws a finite TMX map from its tile sheets, the way Tiled would
+    :param tmx_file: The TMX map, its sheets are looked up next to it
+    :return: list of RGBA row bytes of the first layer
+    """
+    root = ElementTree.parse(tmx_file).getroot()
+    tile_size = int(root.get('tilewidth'))
+    tilesets = []
+    for tileset in root.iter('tileset'):
+        image = tileset.find('image')
+        _, _, sheet_rows = read_rgba_rows(os.path.join(os.path.dirname(tmx_file), image.get('source')))
+        tilesets.append((int(tileset.get('firstgid')), int(tileset.get('tilecount')), int(tileset.get('columns')),
+                         int(tileset.get('margin', 0)), int(tileset.get('spacing', 0)), sheet_rows))
+
+    _, width, height, gids = next(TileExtractor.iter_tmx_layers(tmx_file))
+    row_bytes = tile_size * 4
+    rows = [bytearray(width * row_bytes) for _ in range(0, height * tile_size)]
+    for i, gid in enumerate(gids):
+        tile_id = gid & ~FLIP_FLAGS
+        if not tile_id:
+            continue
+        first_gid, tile_count, columns, margin, spacing, sheet_rows = [tileset for tileset in tilesets
+                                                                       if tileset[0] <= tile_id][-1]
+        local_id = tile_id - first_gid
+        if local_id >= tile_count:
+            raise AssertionError('gid {0} is past its tileset'.format(gid))
+        left = (margin + (local_id % columns) * (tile_size + spacing)) * 4
+        top = margin + (local_id // columns) * (tile_size + spacing)
+        if top + tile_size > len(sheet_rows) or left + row_bytes > len(sheet_rows[0]):
+            raise AssertionError('gid {0} is past the sheet'.format(gid))
+        tile = b''.join(sheet_rows[top + y][left:left + row_bytes] for y in range(0, tile_size))
+        tile = flip_tile(tile, tile_size, 4, gid & FLIP_FLAGS)
+        tile_x, tile_y = i % width, i // width
+        for y in range(0, tile_size):
+            rows[tile_y * tile_size + y][tile_x * row_bytes:(tile_x + 1) * row_bytes] = \
+                tile[y * row_bytes:(y + 1) * row_bytes]
+    return [bytes(row) for row in rows]
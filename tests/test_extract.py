@@ -0,0 +1,100 @@
+"""
+Round trips of extraction: the map drawn from the sheets and the TMX is the source map
+"""
+import unittest
+
+from tile_extract import TileExtractor, SheetPacker, Instrumentation, create_unique_tile_sheet_from_file
+from tests import support
+
+
+class ExtractRoundTripTest(support.TempDirTestCase):
+    def extract(self, file_name, tile_size, **options):
+        """
+        :return: tuple of (extractor, RGBA rows of the map drawn from the sheets and the TMX)
+        """
+        extractor = create_unique_tile_sheet_from_file(file_name, tile_size, out_folder=self.path('out'),
+                                                       instrumentation=Instrumentation(quiet=True), **options)
+        return extractor, support.reconstruct_map(self.path('out', 'map.tmx'))
+
+    def test_exact(self):
+        tiles = support.make_tiles(40, 16)
+        rows = support.make_map_rows(tiles, 20, 15, 16)
+        support.write_png(self.path('map.png'), rows, 320)
+
+        extractor, drawn = self.extract(self.path('map.png'), 16)
+        self.assertEqual(len(extractor.tiles), 40)
+        self.assertEqual(drawn, support.read_rgba_rows(self.path('map.png'))[2])
+
+    def test_exact_compressions(self):
+        tiles = support.make_tiles(10, 8)
+        support.write_png(self.path('map.png'), support.make_map_rows(tiles, 12, 9, 8), 96)
+        source = support.read_rgba_rows(self.path('map.png'))[2]
+        for compression in ('none', 'zlib', 'gzip'):
+            _, drawn = self.extract(self.path('map.png'), 8, tmx_compression=compression)
+            self.assertEqual(drawn, source, compression)
+        _, drawn = self.extract(self.path('map.png'), 8, tmx_chunk_size=4)
+        self.assertEqual(drawn, source)
+
+    def test_flips(self):
+        tiles = support.make_tiles(12, 16, seed=1)
+        rows = support.make_map_rows(tiles, 16, 16, 16, flip_rate=0.5)
+        support.write_png(self.path('map.png'), rows, 256)
+
+        extractor, drawn = self.extract(self.path('map.png'), 16, match_flips=True)
+        self.assertEqual(len(extractor.tiles), 12)
+        self.assertEqual(drawn, support.read_rgba_rows(self.path('map.png'))[2])
+
+    def test_palette(self):
+        palette = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (20, 30, 40), (250, 250, 250)]
+        tiles = support.make_tiles(20, 8, channels=1, colors=[bytes(bytearray([index])) for index in range(5)])
+        rows = support.make_map_rows(tiles, 10, 10, 8, channels=1)
+        support.write_png(self.path('map.png'), rows, 80, palette=palette)
+
+        extractor, drawn = self.extract(self.path('map.png'), 8, pixel_format='palette')
+        self.assertEqual(extractor.tiles.channels, 1)
+        self.assertEqual(len(extractor.tiles), 20)
+        self.assertEqual(drawn, support.read_rgba_rows(self.path('map.png'))[2])
+
+    def test_rgba(self):
+        tiles = support.make_tiles(15, 8, channels=4, seed=2)
+        support.write_png(self.path('map.png'), support.make_map_rows(tiles, 10, 6, 8, channels=4), 80, channels=4)
+
+        extractor, drawn = self.extract(self.path('map.png'), 8, pixel_format='auto')
+        self.assertEqual(extractor.tiles.channels, 4)
+        self.assertEqual(drawn, support.read_rgba_rows(self.path('map.png'))[2])
+
+    def test_padded_sheets(self):
+        tiles = support.make_tiles(70, 16, seed=3)
+        support.write_png(self.path('map.png'), support.make_map_rows(tiles, 20, 20, 16), 320)
+        source = support.read_rgba_rows(self.path('map.png'))[2]
+        packers = [SheetPacker(16, max_sheet_size=128, padding=2, extrude=1),
+                   SheetPacker(16, max_sheet_size=256, square=False, power_of_two=False, padding=1)]
+        for packer in packers:
+            extractor, drawn = self.extract(self.path('map.png'), 16, sheet_packer=packer)
+            self.assertEqual(drawn, source)
+        # 70 tiles of 20px slots do not fit one 128px sheet
+        self.assertGreater(len(SheetPacker(16, max_sheet_size=128, padding=2, extrude=1).get_layout(70)), 1)
+
+    def test_grid_offset(self):
+        tiles = support.make_tiles(10, 8, seed=4)
+        rows = support.make_map_rows(tiles, 8, 6, 8)
+        # A 3px border on the left and top, cropped away
+        bordered = [b'\x10\x20\x30' * 67 for _ in range(0, 3)] + [b'\x10\x20\x30' * 3 + row for row in rows]
+        support.write_png(self.path('map.png'), bordered, 67)
+
+        extractor, drawn = self.extract(self.path('map.png'), 8, offset_x=3, offset_y=3, edge_mode='crop')
+        self.assertEqual((extractor.tiles_width, extractor.tiles_height), (8, 6))
+        self.assertEqual(drawn, [row[3 * 4:] for row in support.read_rgba_rows(self.path('map.png'))[2][3:]])
+
+    def test_from_buffer(self):
+        tiles = support.make_tiles(10, 8, seed=5)
+        rows = support.make_map_rows(tiles, 6, 4, 8)
+        support.write_png(self.path('map.png'), rows, 48)
+        from_file = TileExtractor(self.path('map.png'), 8, Instrumentation(quiet=True))
+        from_buffer = TileExtractor.from_buffer(b''.join(rows), 48, 32, 8, instrumentation=Instrumentation(quiet=True))
+        self.assertEqual(list(from_buffer.tile_indices), list(from_file.tile_indices))
+        self.assertEqual(bytes(from_buffer.tiles.view()), bytes(from_file.tiles.view()))
+
+
+if __name__ == '__main__':
+    unittest.main()
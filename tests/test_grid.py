@@ -0,0 +1,55 @@
+"""
+Tile grid detection finds the tile size and offset of maps cut off at any position of the grid
+"""
+import unittest
+
+from tile_extract import TileGridAnalyzer, Instrumentation, detect_tile_grid
+from tests import support
+
+
+class TileGridAnalyzerTest(support.TempDirTestCase):
+    def write_offset_map(self, tile_size, offset_x, offset_y, tiles_width, tiles_height, num_tiles, seed=0):
+        """
+        Writes a map whose first whole tile is at offset_x, offset_y, with partial tiles around the edges
+        """
+        tiles = support.make_tiles(num_tiles, tile_size, seed=seed)
+        rows = support.make_map_rows(tiles, tiles_width, tiles_height, tile_size, seed=seed)
+        cut_x = (tile_size - offset_x) % tile_size
+        cut_y = (tile_size - offset_y) % tile_size
+        rows = [row[cut_x * 3:] for row in rows[cut_y:]]
+        support.write_png(self.path('map.png'), rows, tiles_width * tile_size - cut_x)
+
+    def assert_grid(self, candidates, tile_size, offset_x, offset_y):
+        best = candidates[0]
+        self.assertEqual((best['tile_size'], best['offset_x'], best['offset_y']), (tile_size, offset_x, offset_y))
+
+    def test_offsets(self):
+        for tile_size, offset_x, offset_y in [(16, 0, 0), (16, 5, 11), (32, 31, 1), (24, 12, 0), (8, 3, 7)]:
+            self.write_offset_map(tile_size, offset_x, offset_y, 24, 20, 120, seed=tile_size + offset_x)
+            self.assert_grid(TileGridAnalyzer().analyze(self.path('map.png')), tile_size, offset_x, offset_y)
+
+    def test_sampled(self):
+        # Large enough for the sample to be spread over the map, and for the finalists to be extracted
+        self.write_offset_map(16, 7, 9, 100, 60, 400, seed=1)
+        candidates = detect_tile_grid(self.path('map.png'), instrumentation=Instrumentation(quiet=True),
+                                      max_rows=256, max_columns=512)
+        self.assert_grid(candidates, 16, 7, 9)
+        self.assertEqual(candidates[0]['num_tiles'], 99 * 59)
+        self.assertEqual(candidates[0]['unique_tiles'], 400)
+
+    def test_tile_sizes(self):
+        self.write_offset_map(48, 20, 30, 24, 20, 12, seed=2)
+        self.assert_grid(TileGridAnalyzer(tile_sizes=(16, 48)).analyze(self.path('map.png')), 48, 20, 30)
+
+    def test_sample_spans(self):
+        analyzer = TileGridAnalyzer(max_rows=256)
+        self.assertEqual(analyzer.get_sample_spans(200, 256), [(0, 200)])
+        self.assertEqual(analyzer.get_sample_spans(200, None), [(0, 200)])
+        spans = analyzer.get_sample_spans(4096, 256)
+        self.assertEqual(spans[0][0], 0)
+        self.assertEqual(spans[-1][1], 4096)
+        self.assertLessEqual(sum(end - start for start, end in spans), 256)
+
+
+if __name__ == '__main__':
+    unittest.main()
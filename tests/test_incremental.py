@@ -0,0 +1,85 @@
+"""
+Incremental re-runs give the same outputs as a fresh run, whatever outputs each run asked for
+"""
+import os
+import unittest
+
+import tile_extract
+from tile_extract import Instrumentation, create_unique_tile_sheet_from_file
+from tests import support
+
+
+class IncrementalTest(support.TempDirTestCase):
+    def setUp(self):
+        support.TempDirTestCase.setUp(self)
+        self.tiles = support.make_tiles(300, 16, seed=1)
+        self.rows = support.make_map_rows(self.tiles, 40, 30, 16, seed=2)
+        support.write_png(self.path('map.png'), self.rows, 640)
+
+    def run_cli(self, *outputs):
+        self.assertEqual(tile_extract.main(['-q', '--incremental', '-t', '16', '-o', self.path('out'),
+                                            self.path('map.png'), '-m'] + list(outputs)), 0)
+
+    def run_extract(self, outputs=('sheets', 'tmx'), **options):
+        instrumentation = Instrumentation(quiet=True)
+        extractor = create_unique_tile_sheet_from_file(self.path('map.png'), 16, incremental=True,
+                                                       out_folder=self.path('out'), outputs=outputs,
+                                                       instrumentation=instrumentation, **options)
+        return extractor, instrumentation.get_metrics()['counters']
+
+    def edit_top_band(self, seed):
+        """
+        Redraws the top band of the map with tiles the cache has not seen
+        """
+        new_tiles = [tile for tile in support.make_tiles(340, 16, seed=seed) if tile not in self.tiles][:40]
+        self.rows = support.make_map_rows(new_tiles, 40, 1, 16, seed=3) + self.rows[16:]
+        support.write_png(self.path('map.png'), self.rows, 640)
+
+    def assert_round_trip(self):
+        self.assertEqual(support.reconstruct_map(self.path('out', 'map.tmx')),
+                         support.read_rgba_rows(self.path('map.png'))[2])
+
+    def test_unchanged_rerun(self):
+        self.run_extract()
+        extractor, counters = self.run_extract()
+        self.assertEqual(extractor.changed_bands, 0)
+        self.assertEqual(counters.get('sheets_written', 0), 0)
+        self.assert_round_trip()
+
+    def test_changed_band(self):
+        previous_tiles = list(self.run_extract()[0].tiles)
+        self.edit_top_band(9)
+        extractor, counters = self.run_extract()
+        self.assertEqual(extractor.changed_bands, 1)
+        # Cached tiles keep their ids, the new tiles come after them
+        self.assertGreater(len(extractor.tiles), len(previous_tiles))
+        self.assertEqual(list(extractor.tiles)[:len(previous_tiles)], previous_tiles)
+        self.assert_round_trip()
+
+    def test_mixed_outputs(self):
+        # The TMX only run must not record the sheet layout it never wrote
+        self.run_cli('sheets', 'tmx')
+        self.edit_top_band(9)
+        self.run_cli('tmx')
+        self.run_cli('sheets', 'tmx')
+        self.assert_round_trip()
+
+    def test_sheets_then_tmx(self):
+        self.run_cli('sheets')
+        self.edit_top_band(9)
+        self.run_cli('sheets')
+        self.assertFalse(os.path.exists(self.path('out', 'map.tmx')))
+        self.run_cli('tmx')
+        self.assert_round_trip()
+
+    def test_changed_options(self):
+        self.run_extract()
+        self.run_extract(tmx_compression='zlib', tmx_chunk_size=8)
+        self.assert_round_trip()
+        self.run_extract(outputs=('sheets', 'tmx', 'index'))
+        self.assertTrue(os.path.exists(self.path('out', 'map.tidx')))
+        self.assert_round_trip()
+
+
+if __name__ == '__main__':
+    unittest.main()
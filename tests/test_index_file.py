@@ -0,0 +1,96 @@
+"""
+Rectangles read from index files match the flat tile indices they were written from
+"""
+import array
+import random
+import unittest
+
+from tile_extract import TileIndexFile, TileExtractor, Instrumentation, UINT32_TYPECODE
+from tests import support
+
+
+def get_flat_rect(tile_indices, tiles_width, tiles_height, x, y, width, height):
+    """
+    :return: the gids of a rectangle of flat tile indices, 0 outside the map
+    """
+    gids = array.array(UINT32_TYPECODE)
+    for row_y in range(y, y + height):
+        for row_x in range(x, x + width):
+            inside = 0 <= row_x < tiles_width and 0 <= row_y < tiles_height
+            gids.append(tile_indices[row_y * tiles_width + row_x] if inside else 0)
+    return gids
+
+
+class TileIndexFileTest(support.TempDirTestCase):
+    def write_index(self, tiles_width, tiles_height, chunk_width, chunk_height, empty_rate=0.0, seed=0):
+        rng = random.Random(seed)
+        tile_indices = array.array(UINT32_TYPECODE, [0 if rng.random() < empty_rate else rng.randrange(1, 1 << 31)
+                                                     for _ in range(0, tiles_width * tiles_height)])
+        # Leave a whole empty chunk, it is not stored
+        for y in range(0, min(chunk_height, tiles_height)):
+            for x in range(0, min(chunk_width, tiles_width)):
+                tile_indices[y * tiles_width + x] = 0
+        TileIndexFile.write(self.path('map.tidx'), tile_indices, tiles_width, tiles_height, chunk_width, chunk_height,
+                            16)
+        return tile_indices
+
+    def assert_rects(self, tile_indices, tiles_width, tiles_height, rects):
+        index_file = TileIndexFile(self.path('map.tidx'))
+        try:
+            self.assertEqual((index_file.tiles_width, index_file.tiles_height, index_file.tile_size),
+                             (tiles_width, tiles_height, 16))
+            for rect in rects:
+                self.assertEqual(index_file.get_rect(*rect),
+                                 get_flat_rect(tile_indices, tiles_width, tiles_height, *rect), rect)
+        finally:
+            index_file.close()
+
+    def test_whole_map(self):
+        for tiles_width, tiles_height, chunk_width, chunk_height in [(37, 23, 8, 8), (32, 32, 16, 16),
+                                                                     (5, 40, 16, 4), (1, 1, 16, 16)]:
+            tile_indices = self.write_index(tiles_width, tiles_height, chunk_width, chunk_height, empty_rate=0.2)
+            self.assert_rects(tile_indices, tiles_width, tiles_height, [(0, 0, tiles_width, tiles_height)])
+
+    def test_random_rects(self):
+        rng = random.Random(1)
+        tile_indices = self.write_index(37, 23, 8, 5, empty_rate=0.1)
+        rects = [(rng.randrange(-10, 40), rng.randrange(-10, 26), rng.randrange(0, 30), rng.randrange(0, 20))
+                 for _ in range(0, 200)]
+        self.assert_rects(tile_indices, 37, 23, rects)
+
+    def test_out_of_bounds(self):
+        tile_indices = self.write_index(20, 10, 8, 8)
+        rects = [(-5, -5, 3, 3), (20, 0, 4, 4), (0, 10, 4, 4), (100, 100, 2, 2), (-3, -3, 30, 20),
+                 (19, 9, 5, 5), (-1, 5, 2, 1), (3, 3, 0, 0), (3, 3, 5, 0)]
+        self.assert_rects(tile_indices, 20, 10, rects)
+
+        index_file = TileIndexFile(self.path('map.tidx'))
+        try:
+            self.assertEqual(index_file.get_gid(-1, 0), 0)
+            self.assertEqual(index_file.get_gid(20, 9), 0)
+            self.assertEqual(index_file.get_gid(19, 9), tile_indices[9 * 20 + 19])
+            self.assertRaises(ValueError, index_file.get_rect, 0, 0, -1, 2)
+        finally:
+            index_file.close()
+
+    def test_not_an_index_file(self):
+        with open(self.path('map.tidx'), 'wb') as index_file:
+            index_file.write(b'\0' * 64)
+        self.assertRaises(ValueError, TileIndexFile, self.path('map.tidx'))
+
+    def test_extractor_index(self):
+        tiles = support.make_tiles(30, 8)
+        support.write_png(self.path('map.png'), support.make_map_rows(tiles, 21, 13, 8), 168)
+        extractor = TileExtractor(self.path('map.png'), 8, Instrumentation(quiet=True))
+        extractor.output_index_file(self.path('out'), 'map', chunk_size=4)
+        index_file = TileIndexFile(self.path('out', 'map.tidx'))
+        try:
+            self.assertEqual(index_file.get_rect(0, 0, 21, 13), extractor.tile_indices)
+            self.assertEqual(index_file.get_rect(-2, 11, 6, 4), get_flat_rect(extractor.tile_indices, 21, 13,
+                                                                              -2, 11, 6, 4))
+        finally:
+            index_file.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
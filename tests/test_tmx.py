@@ -0,0 +1,117 @@
+"""
+TMX layers read back in every layout Tiled writes them
+"""
+import array
+import io
+import unittest
+
+import tile_extract
+from tile_extract import TileExtractor, Instrumentation, UINT32_TYPECODE, FLIPPED_HORIZONTALLY
+from tests import support
+
+
+def get_tmx(layers, infinite=False):
+    """
+    :param layers: list of layer or group element text
+    :return: TMX map bytes around the layers
+    """
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<map version="1.0" orientation="orthogonal" width="3" height="2" tilewidth="8" tileheight="8" '
+            'infinite="{0}">\n'
+            ' <tileset firstgid="1" name="tiles" tilewidth="8" tileheight="8" tilecount="4" columns="2">\n'
+            '  <image source="tiles.png" width="16" height="16"/>\n'
+            ' </tileset>\n'
+            '{1}\n'
+            '</map>\n').format(int(infinite), '\n'.join(layers)).encode('utf-8')
+
+
+def read_layers(tmx_bytes):
+    return [(name, width, height, list(indices))
+            for name, width, height, indices in TileExtractor.iter_tmx_layers(io.BytesIO(tmx_bytes))]
+
+
+class TmxLayerTest(unittest.TestCase):
+    def test_csv(self):
+        tmx = get_tmx(['<layer name="ground" width="3" height="2"><data encoding="csv">\n1,2,3,\n4,0,2147483649\n'
+                       '</data></layer>'])
+        self.assertEqual(read_layers(tmx), [('ground', 3, 2, [1, 2, 3, 4, 0, FLIPPED_HORIZONTALLY | 1])])
+
+    def test_xml(self):
+        tmx = get_tmx(['<layer name="ground" width="3" height="2"><data>'
+                       '<tile gid="1"/><tile gid="2"/><tile/><tile gid="4"/><tile gid="3"/><tile gid="1"/>'
+                       '</data></layer>'])
+        self.assertEqual(read_layers(tmx), [('ground', 3, 2, [1, 2, 0, 4, 3, 1])])
+
+    def test_groups(self):
+        tmx = get_tmx(['<layer name="top" width="3" height="2"><data encoding="csv">1,1,1,1,1,1</data></layer>',
+                       '<group name="outer">',
+                       ' <layer name="a" width="3" height="2"><data encoding="csv">2,2,2,2,2,2</data></layer>',
+                       ' <group name="inner">',
+                       '  <layer name="b" width="3" height="2"><data><tile gid="3"/><tile gid="3"/><tile gid="3"/>'
+                       '<tile gid="3"/><tile gid="3"/><tile gid="3"/></data></layer>',
+                       ' </group>',
+                       ' <objectgroup name="objects"><object id="1" x="0" y="0"/></objectgroup>',
+                       '</group>',
+                       '<layer name="bottom" width="3" height="2"><data encoding="csv">4,4,4,4,4,4</data></layer>'])
+        self.assertEqual([(name, indices[0]) for name, _, _, indices in read_layers(tmx)],
+                         [('top', 1), ('a', 2), ('b', 3), ('bottom', 4)])
+
+    def test_chunks(self):
+        tmx = get_tmx(['<layer name="csv" width="3" height="2"><data encoding="csv">'
+                       '<chunk x="0" y="0" width="2" height="2">1,2,3,4</chunk>'
+                       '<chunk x="2" y="0" width="2" height="2">5,6,7,8</chunk>'
+                       '</data></layer>',
+                       '<layer name="xml" width="3" height="2"><data>'
+                       '<chunk x="-2" y="0" width="2" height="1"><tile gid="1"/><tile gid="2"/></chunk>'
+                       '<chunk x="0" y="1" width="2" height="1"><tile gid="3"/><tile/></chunk>'
+                       '</data></layer>'], infinite=True)
+        # The layers start at the top left chunk, and are widened to fit every chunk
+        self.assertEqual(read_layers(tmx), [('csv', 4, 2, [1, 2, 5, 6,
+                                                           3, 4, 7, 8]),
+                                            ('xml', 4, 2, [1, 2, 0, 0,
+                                                           0, 0, 3, 0])])
+
+    def test_unsupported(self):
+        tmx = get_tmx(['<layer name="ground" width="3" height="2"><data encoding="base32">AAAA</data></layer>'])
+        self.assertRaises(ValueError, read_layers, tmx)
+        tmx = get_tmx(['<layer name="ground" width="3" height="2">'
+                       '<data encoding="base64" compression="lzma">AAAA</data></layer>'])
+        self.assertRaises(ValueError, read_layers, tmx)
+
+
+class TmxRoundTripTest(support.TempDirTestCase):
+    def setUp(self):
+        support.TempDirTestCase.setUp(self)
+        tiles = support.make_tiles(20, 8)
+        self.extractor = TileExtractor.from_buffer(b''.join(support.make_map_rows(tiles, 11, 7, 8)), 88, 56, 8,
+                                                   instrumentation=Instrumentation(quiet=True))
+
+    def test_compressions(self):
+        compressions = [compression for compression in TileExtractor.TMX_COMPRESSIONS
+                        if compression != 'zstd' or tile_extract.zstandard is not None]
+        for compression in compressions:
+            for chunk_size in (None, 4, 16):
+                tmx = self.extractor.get_tmx_bytes('map', compression, chunk_size=chunk_size)
+                self.assertEqual(read_layers(tmx), [('map', 11, 7, list(self.extractor.tile_indices))],
+                                 (compression, chunk_size))
+
+    def test_get_tile_indices(self):
+        self.extractor.output_tmx_for_tiles(self.temp_dir, 'map', 'zlib')
+        tmx_file = self.path('map.tmx')
+        with open(tmx_file, 'rb') as in_file:
+            tmx = in_file.read()
+        # Add a second layer after the first, get_tile_indices puts the layers one after the other
+        layer_end = tmx.index(b'</layer>') + len(b'</layer>')
+        second_layer = b'<layer name="more" width="2" height="1"><data encoding="csv">3,2147483650</data></layer>'
+        with open(tmx_file, 'wb') as out_file:
+            out_file.write(tmx[:layer_end] + second_layer + tmx[layer_end:])
+
+        expected = array.array(UINT32_TYPECODE, self.extractor.tile_indices)
+        expected.extend([3, FLIPPED_HORIZONTALLY | 2])
+        self.assertEqual(TileExtractor.get_tile_indices(tmx_file), expected)
+        self.assertEqual(TileExtractor.get_tile_indices(tmx_file, decode_flips=True)[-2:],
+                         [TileExtractor.decode_gid(3), TileExtractor.decode_gid(FLIPPED_HORIZONTALLY | 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
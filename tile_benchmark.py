@@ -0,0 +1,464 @@
+import sys
+import os
+import random
+import shutil
+import tempfile
+import itertools
+import timeit
+import json
+import argparse
+import platform
+import resource
+import subprocess
+import png
+from tile_extract import TileExtractor, TileStore, FlipTileIndex, FuzzyTileIndex, Instrumentation, flip_tile
+
+# Synthetic map scenarios, see make_synthetic_map for the knobs
+SCENARIOS = {
+    'small': {'tiles_width': 64, 'tiles_height': 64, 'tile_size': 16, 'unique_ratio': 0.05},
+    'large': {'tiles_width': 256, 'tiles_height': 256, 'tile_size': 16, 'unique_ratio': 0.02},
+    'unique': {'tiles_width': 128, 'tiles_height': 128, 'tile_size': 16, 'unique_ratio': 0.5},
+    'big_tiles': {'tiles_width': 64, 'tiles_height': 64, 'tile_size': 32, 'unique_ratio': 0.05},
+    'flips': {'tiles_width': 128, 'tiles_height': 128, 'tile_size': 16, 'unique_ratio': 0.05, 'flip_rate': 0.3,
+              'match_flips': True},
+    'near': {'tiles_width': 128, 'tiles_height': 128, 'tile_size': 16, 'unique_ratio': 0.05, 'near_rate': 0.3,
+             'max_channel_error': 8},
+}
+
+# The stages measured for every scenario
+STAGES = ('extract', 'sheets', 'tmx')
+
+
+def make_random_tile_store(num_tiles, tile_size, seed=0):
+    """
+    Builds a TileStore of random tiles
+    :param num_tiles: The number of tiles to create
+    :param tile_size: The size of the tiles
+    :param seed: The random seed, the same seed always builds the same tiles
+    :return: the TileStore
+    """
+    rnd = random.Random(seed)
+    tiles = TileStore(tile_size, 3)
+    for _ in range(0, num_tiles):
+        tiles.append(bytearray(rnd.getrandbits(8) for _ in range(0, tiles.tile_bytes)))
+    return tiles
+
+
+def legacy_sheet_rows(tile_lists, square_width):
+    """
+    The original list of rows sheet builder, kept here as the benchmark baseline
+    :param tile_lists: List of tiles, each a list of rows of ints
+    :param square_width: The width of the sheet, which will also be the height
+    :return: list of sheet rows
+    """
+    num_tiles = len(tile_lists)
+    num_tile_rows = len(tile_lists[0])
+    num_tiles_per_row = square_width // num_tile_rows
+
+    output_rows = []
+    for cur_row in range(0, square_width):
+        row_out = []
+        for cur_tile_index in range(0, num_tiles_per_row):
+            cur_tile_row = int(cur_row / num_tile_rows)
+            tile_index = cur_tile_index + cur_tile_row * num_tiles_per_row
+            if tile_index < num_tiles:
+                tile_row_index = cur_row % num_tile_rows
+                row_out.extend(tile_lists[tile_index][tile_row_index])
+            else:
+                row_out.extend(list(itertools.repeat(255, num_tile_rows * 3)))
+        output_rows.append(row_out)
+    return output_rows
+
+
+def legacy_single_tiles(tile_lists, tile_size, out_folder, group_name):
+    """
+    The original single tile writer, a new writer per tile, kept here as the benchmark baseline
+    :param tile_lists: List of tiles, each a list of rows of ints
+    :param tile_size: The size of the tiles
+    :param out_folder: The folder to output to
+    :param group_name: The prefix of the output PNG files
+    """
+    for file_index, tile in enumerate(tile_lists):
+        out_filename = '{0}{1}{2}_{3}.png'.format(out_folder, os.sep, group_name, file_index)
+        tile_png = open(out_filename, 'wb')
+        png_writer = png.Writer(tile_size, tile_size, greyscale=False)
+        png_writer.write(tile_png, tile)
+        tile_png.close()
+
+
+def best_time(func, repeat):
+    """
+    Runs func repeat times
+    :param func: The function to time
+    :param repeat: The number of runs
+    :return: the fastest run in seconds
+    """
+    times = []
+    for _ in range(0, repeat):
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+
+def bench_sheet_composition(tile_size=16, square_width=512, repeat=3):
+    """
+    Compares the legacy sheet builder against the TileStore sheet compositor
+    :param tile_size: The size of the tiles
+    :param square_width: The sheet width
+    :param repeat: The number of runs, the fastest is reported
+    :return: tuple of (legacy seconds, compositor seconds)
+    """
+    tiles = make_random_tile_store((square_width // tile_size) ** 2, tile_size)
+    tile_lists = [tiles.get_tile_row_list(tile_id) for tile_id in range(0, len(tiles))]
+
+    legacy = best_time(lambda: legacy_sheet_rows(tile_lists, square_width), repeat)
+    composed = best_time(lambda: list(TileExtractor.iter_sheet_rows(tiles, square_width)), repeat)
+    return legacy, composed
+
+
+def bench_single_tiles(num_tiles=10000, tile_size=16, repeat=1):
+    """
+    Compares the legacy single tile writer against the batched writer
+    :param num_tiles: The number of tiles to write
+    :param tile_size: The size of the tiles
+    :param repeat: The number of runs, the fastest is reported
+    :return: tuple of (legacy seconds, batched seconds)
+    """
+    extractor = TileExtractor(instrumentation=Instrumentation(quiet=True))
+    extractor.tile_size = tile_size
+    extractor.tiles = make_random_tile_store(num_tiles, tile_size)
+    extractor.tile_indices = list(range(1, num_tiles + 1))
+    tile_lists = extractor.get_tile_row_lists()
+
+    out_folder = tempfile.mkdtemp()
+    try:
+        legacy = best_time(lambda: legacy_single_tiles(tile_lists, tile_size, out_folder, 'legacy'), repeat)
+        batched = best_time(lambda: extractor.output_single_tiles_to_folder(out_folder, 'batched'), repeat)
+    finally:
+        shutil.rmtree(out_folder)
+    return legacy, batched
+
+
+def make_synthetic_map(path, tiles_width, tiles_height, tile_size, unique_ratio=0.1, palette_size=16, flip_rate=0.0,
+                       near_rate=0.0, seed=0):
+    """
+    Writes a deterministic synthetic tile map PNG, the same arguments always write the same map
+    :param path: The PNG file to write
+    :param tiles_width: The width of the map in tiles
+    :param tiles_height: The height of the map in tiles
+    :param tile_size: The size of the tiles
+    :param unique_ratio: The number of distinct tiles over the number of tiles in the map, before flips and noise
+    :param palette_size: The number of colors tiles are painted with
+    :param flip_rate: The chance of a placed tile being flipped or rotated
+    :param near_rate: The chance of a placed tile having a little noise added, a near duplicate
+    :param seed: The random seed
+    :return: The number of distinct tiles
+    """
+    rnd = random.Random(seed)
+    num_tiles = tiles_width * tiles_height
+    num_unique = max(1, min(num_tiles, int(num_tiles * unique_ratio)))
+    palette = [bytes(bytearray(rnd.getrandbits(8) for _ in range(0, 3))) for _ in range(0, palette_size)]
+    unique_tiles = [b''.join(rnd.choice(palette) for _ in range(0, tile_size * tile_size))
+                    for _ in range(0, num_unique)]
+
+    # Every distinct tile is placed at least once
+    placement = list(range(0, num_unique)) + [rnd.randrange(num_unique) for _ in range(num_unique, num_tiles)]
+    rnd.shuffle(placement)
+
+    row_bytes = tile_size * 3
+    writer = png.Writer(tiles_width * tile_size, tiles_height * tile_size, greyscale=False)
+
+    def iter_rows():
+        for tile_y in range(0, tiles_height):
+            band = []
+            for tile_x in range(0, tiles_width):
+                tile = unique_tiles[placement[tile_y * tiles_width + tile_x]]
+                if rnd.random() < flip_rate:
+                    tile = flip_tile(tile, tile_size, 3, rnd.choice(FlipTileIndex.ORIENTATIONS))
+                if rnd.random() < near_rate:
+                    tile = bytearray(tile)
+                    for _ in range(0, 4):
+                        channel = rnd.randrange(len(tile))
+                        tile[channel] = min(255, max(0, tile[channel] + rnd.randint(-4, 4)))
+                band.append(tile)
+            for tile_row in range(0, tile_size):
+                start = tile_row * row_bytes
+                yield bytearray(b''.join(bytes(tile[start:start + row_bytes]) for tile in band))
+
+    with open(path, 'wb') as png_file:
+        writer.write(png_file, iter_rows())
+    return num_unique
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident set size of this process, so the next get_peak_rss covers only what runs after it.
+    Needs Linux 4.0 or later.
+    :return: True if the peak was reset, False if get_peak_rss stays the peak since the process started
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def get_peak_rss():
+    """
+    :return: The peak resident set size in KB of this process, since reset_peak_rss where it is supported
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def get_children_peak_rss():
+    """
+    :return: The largest peak resident set size in KB of the finished child processes, such as extraction workers
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+def bench_near_lookups(unique_counts=(800, 3200, 9800), tile_size=16, max_channel_error=8, palette_size=16, seed=0):
+    """
+    Measures how near duplicate lookups scale with the number of unique tiles. Every unique tile is looked up once
+    and then twice more, with a little noise added to a third of the repeats.
+    :param unique_counts: The numbers of unique tiles to measure
+    :param tile_size: The size of the tiles
+    :param max_channel_error: The near duplicate threshold
+    :param palette_size: The number of colors tiles are painted with
+    :param seed: The random seed
+    :return: list of (unique tiles, seconds, candidate tiles per search) for every count
+    """
+    results = []
+    for num_unique in unique_counts:
+        rnd = random.Random(seed)
+        palette = [bytes(bytearray(rnd.getrandbits(8) for _ in range(0, 3))) for _ in range(0, palette_size)]
+        unique_tiles = [b''.join(rnd.choice(palette) for _ in range(0, tile_size * tile_size))
+                        for _ in range(0, num_unique)]
+        tiles = list(unique_tiles)
+        for _ in range(0, num_unique * 2):
+            tile = bytearray(rnd.choice(unique_tiles))
+            if rnd.random() < 0.3:
+                for _ in range(0, 4):
+                    channel = rnd.randrange(len(tile))
+                    tile[channel] = min(255, max(0, tile[channel] + rnd.randint(-4, 4)))
+            tiles.append(bytes(tile))
+
+        index = FuzzyTileIndex(tile_size, 3, max_channel_error=max_channel_error)
+        start = timeit.default_timer()
+        for tile in tiles:
+            index.lookup_gid(tile)
+        seconds = timeit.default_timer() - start
+        results.append((num_unique, seconds, index.near_candidates / float(max(1, index.near_searches))))
+    return results
+
+
+def get_folder_bytes(folder):
+    """
+    :param folder: The folder to measure
+    :return: The total size of the files in the folder
+    """
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder)
+               if os.path.isfile(os.path.join(folder, name)))
+
+
+def run_scenario(scenario, workers=1, seed=0):
+    """
+    Generates a scenario's map and measures each stage of the extraction.
+    The peak RSS of a stage is reset before it runs where the platform allows it (see reset_peak_rss), otherwise it is
+    the peak since the process started and peak_rss_per_stage is False. Worker processes are not part of a stage's
+    peak, children_peak_rss_kb is their largest peak, and like any high water mark it only covers one scenario when
+    the scenario runs in its own process.
+    :param scenario: The scenario options, see SCENARIOS
+    :param workers: The number of workers used for extraction and sheet encoding
+    :param seed: The random seed of the map
+    :return: dict of results, with wall seconds, tiles per second, peak RSS and output bytes for each stage, and the
+             extractor's metrics (see Instrumentation.get_metrics)
+    """
+    map_options = dict((key, value) for key, value in scenario.items()
+                       if key not in ('match_flips', 'max_channel_error', 'max_tile_error'))
+    extract_options = dict((key, value) for key, value in scenario.items()
+                           if key in ('match_flips', 'max_channel_error', 'max_tile_error'))
+    tile_size = scenario['tile_size']
+    num_tiles = scenario['tiles_width'] * scenario['tiles_height']
+
+    work_folder = tempfile.mkdtemp()
+    try:
+        map_file = os.path.join(work_folder, 'map.png')
+        num_distinct = make_synthetic_map(map_file, seed=seed, **map_options)
+        out_folder = os.path.join(work_folder, 'out')
+        os.makedirs(out_folder)
+
+        instrumentation = Instrumentation(quiet=True)
+        extractor = TileExtractor(instrumentation=instrumentation)
+        stage_runs = [
+            ('extract', num_tiles,
+             lambda: extractor.populate_extractor(map_file, tile_size, workers=workers, **extract_options)),
+            ('sheets', None, lambda: extractor.output_tiles_to_sheets(out_folder, 'map', workers)),
+            ('tmx', num_tiles, lambda: extractor.output_tmx_for_tiles(out_folder, 'map')),
+        ]
+        stages = {}
+        peak_rss_per_stage = True
+        for stage_name, stage_tiles, stage_func in stage_runs:
+            out_bytes = get_folder_bytes(out_folder)
+            peak_rss_per_stage = reset_peak_rss() and peak_rss_per_stage
+            start = timeit.default_timer()
+            stage_func()
+            seconds = timeit.default_timer() - start
+            if stage_tiles is None:
+                stage_tiles = len(extractor.tiles)
+            stages[stage_name] = {
+                'seconds': seconds,
+                'tiles_per_second': stage_tiles / max(seconds, 1e-9),
+                'peak_rss_kb': get_peak_rss(),
+                'output_bytes': get_folder_bytes(out_folder) - out_bytes,
+            }
+        unique_tiles = len(extractor.tiles)
+        extractor.tiles.close()
+    finally:
+        shutil.rmtree(work_folder)
+
+    return {'options': scenario, 'workers': workers, 'seed': seed, 'map_tiles': num_tiles,
+            'distinct_tiles': num_distinct, 'unique_tiles': unique_tiles, 'stages': stages,
+            'peak_rss_per_stage': peak_rss_per_stage, 'children_peak_rss_kb': get_children_peak_rss(),
+            'metrics': instrumentation.get_metrics()}
+
+
+def run_scenario_isolated(name, workers=1, seed=0, map_args=()):
+    """
+    Runs a scenario in a fresh interpreter so its peak RSS is not mixed up with other scenarios
+    :param name: The scenario name, see SCENARIOS
+    :param workers: The number of workers used for extraction and sheet encoding
+    :param seed: The random seed of the map
+    :param map_args: The map generator options overriding the scenario's, as command line arguments
+    :return: dict of results, see run_scenario
+    """
+    result_file, result_path = tempfile.mkstemp(suffix='.json')
+    os.close(result_file)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), '--scenario', name,
+                                   '--workers', str(workers), '--seed', str(seed), '--no-isolate',
+                                   '--json', result_path] + list(map_args), stdout=devnull)
+        with open(result_path) as results:
+            return json.load(results)['scenarios'][name]
+    finally:
+        os.remove(result_path)
+
+
+def get_environment():
+    """
+    :return: dict describing the machine and commit the results were measured on
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'machine': platform.machine(), 'png': getattr(png, '__version__', None)}
+
+
+def print_scenario(name, result):
+    """
+    Prints the stage lines of one scenario
+    :param name: The scenario name
+    :param result: The scenario results, see run_scenario
+    """
+    print('{0}: {1} map tiles, {2} unique'.format(name, result['map_tiles'], result['unique_tiles']))
+    # Without a per stage reset the peak is the peak since the process started
+    peak_name = 'peak' if result['peak_rss_per_stage'] else 'peak so far'
+    for stage_name in STAGES:
+        stage = result['stages'][stage_name]
+        print('    {0:<8} {1:8.3f}s {2:12.0f} tiles/s {3:10d} KB {4} {5:12d} bytes out'.format(
+            stage_name, stage['seconds'], stage['tiles_per_second'], stage['peak_rss_kb'], peak_name,
+            stage['output_bytes']))
+
+
+def print_result(name, legacy, optimized):
+    """
+    Prints one benchmark line
+    :param name: The benchmark name
+    :param legacy: The legacy time in seconds
+    :param optimized: The optimized time in seconds
+    """
+    print('{0:<40} legacy {1:8.3f}s  new {2:8.3f}s  speedup {3:6.1f}x'.format(
+        name, legacy, optimized, legacy / max(optimized, 1e-9)))
+
+
+def main(argv=None):
+    """
+    Runs the benchmark scenarios, and optionally the legacy comparisons
+    :param argv: The arguments, sys.argv[1:] if None
+    :return: The exit code
+    """
+    parser = argparse.ArgumentParser(description='Benchmarks tile extraction on deterministic synthetic maps.')
+    parser.add_argument('-s', '--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='a scenario to run, may be repeated (default all)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='extraction and encoding workers (default 1)')
+    parser.add_argument('--seed', type=int, default=0, help='the random seed of the maps (default 0)')
+    map_group = parser.add_argument_group('map generator', 'override the map options of the scenarios')
+    map_group.add_argument('--map-size', type=int, nargs=2, metavar=('TILES_WIDTH', 'TILES_HEIGHT'),
+                           help='the map size in tiles')
+    map_group.add_argument('--tile-size', type=int, help='the size of the tiles')
+    map_group.add_argument('--unique-ratio', type=float, help='the distinct tiles over the map tiles')
+    map_group.add_argument('--palette-size', type=int, help='the number of colors tiles are painted with')
+    map_group.add_argument('--flip-rate', type=float, help='the chance of a tile being flipped or rotated')
+    map_group.add_argument('--near-rate', type=float, help='the chance of a tile having a little noise added')
+    parser.add_argument('--json', help='write the results to this JSON file')
+    parser.add_argument('--no-isolate', dest='isolate', action='store_false',
+                        help='run scenarios in this process, peak RSS then accumulates across scenarios')
+    parser.add_argument('--legacy', type=int, metavar='NUM_TILES',
+                        help='also compare against the legacy sheet and single tile writers')
+    parser.add_argument('--near-lookups', action='store_true',
+                        help='also measure how near duplicate lookups scale with the unique tiles')
+    args = parser.parse_args(argv)
+
+    map_options = {}
+    map_args = []
+    if args.map_size is not None:
+        map_options['tiles_width'], map_options['tiles_height'] = args.map_size
+        map_args += ['--map-size'] + [str(size) for size in args.map_size]
+    for name in ('tile_size', 'unique_ratio', 'palette_size', 'flip_rate', 'near_rate'):
+        value = getattr(args, name)
+        if value is not None:
+            map_options[name] = value
+            map_args += ['--' + name.replace('_', '-'), str(value)]
+
+    results = {'environment': get_environment(), 'scenarios': {}}
+    for name in args.scenario or sorted(SCENARIOS):
+        if args.isolate:
+            result = run_scenario_isolated(name, args.workers, args.seed, map_args)
+        else:
+            scenario = dict(SCENARIOS[name])
+            scenario.update(map_options)
+            result = run_scenario(scenario, args.workers, args.seed)
+        results['scenarios'][name] = result
+        print_scenario(name, result)
+
+    if args.legacy is not None:
+        print_result('Compose 512x512 sheet of 16px tiles', *bench_sheet_composition(16))
+        print_result('Compose 512x512 sheet of 32px tiles', *bench_sheet_composition(32))
+        print_result('Write {0} single 16px tiles'.format(args.legacy), *bench_single_tiles(args.legacy))
+
+    if args.near_lookups:
+        for num_unique, seconds, candidates in bench_near_lookups():
+            print('Near duplicate lookups, {0:6d} unique tiles {1:8.3f}s {2:8.1f} candidates per search'.format(
+                num_unique, seconds, candidates))
+
+    if args.json is not None:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+    return 0
+
+# ----------------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    sys.exit(main())
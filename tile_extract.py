@@ -2,37 +2,1869 @@ import sys
 import png
 import os
 import itertools
-import copy
 import zlib
 import struct
 import math
-from xml.dom import minidom
+import base64
+import hashlib
+import collections
+import multiprocessing
+import mmap
+import tempfile
+import array
+import timeit
+import json
+import io
+import threading
+import contextlib
+import cProfile
+import glob
+import argparse
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Tile indices are stored as unsigned 32 bit ints, which is what TMX uses for gids
+UINT32_TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+
+# Tiled stores tile flips in the high bits of a gid
+FLIPPED_HORIZONTALLY = 0x80000000
+FLIPPED_VERTICALLY = 0x40000000
+FLIPPED_DIAGONALLY = 0x20000000
+FLIP_FLAGS = FLIPPED_HORIZONTALLY | FLIPPED_VERTICALLY | FLIPPED_DIAGONALLY
+
+
+def _crc32_digest(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def _adler32_digest(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+def _blake2_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class TileDigestIndex:
+    """
+    A hash index of unique tiles keyed on a digest of the tile bytes.
+    Lookups are O(1); a digest hit is confirmed with an exact byte comparison so results are identical
+    to comparing a tile against every unique tile.
+    Buckets look like this: {digest: [tile_id, tile_id]}, where tile_id is the 0 based unique tile index.
+    The tile bytes themselves live in the tiles container (a TileStore or a plain list), the index only holds ids.
+    """
+    # Fast non-cryptographic hashers and blake2 for when collisions need to be ruled out
+    HASHERS = {
+        'crc32': _crc32_digest,
+        'adler32': _adler32_digest,
+        'blake2': _blake2_digest,
+    }
+
+    def __init__(self, hasher='crc32', tiles=None):
+        """
+        :param hasher: The name of a hasher in HASHERS, or a callable taking bytes and returning a hashable digest
+        :param tiles: The container unique tiles are appended to, a new list if None
+        """
+        if callable(hasher):
+            self.hash_func = hasher
+        elif hasher in self.HASHERS:
+            self.hash_func = self.HASHERS[hasher]
+        else:
+            raise ValueError('Unknown tile hasher {0}, expected one of {1}'.format(hasher, sorted(self.HASHERS)))
+
+        self._buckets = {}
+        self.tiles = [] if tiles is None else tiles
+
+        # Counters used to verify the index is behaving on real maps
+        self.lookups = 0
+        self.digest_hits = 0
+        self.collisions = 0
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def find(self, tile_bytes, digest=None):
+        """
+        Finds a tile in the index
+        :param tile_bytes: The bytes of the tile to find
+        :param digest: The digest of tile_bytes if it is already known
+        :return: The 0 based tile id, or -1 if the tile is not in the index
+        """
+        if digest is None:
+            digest = self.hash_func(tile_bytes)
+        self.lookups += 1
+
+        bucket = self._buckets.get(digest)
+        if bucket is None:
+            return -1
+
+        self.digest_hits += 1
+        for tile_id in bucket:
+            if self.tiles[tile_id] == tile_bytes:
+                return tile_id
+
+        # Same digest, different bytes
+        self.collisions += 1
+        return -1
+
+    def add(self, tile_bytes, digest=None):
+        """
+        Adds a tile to the index without checking for an existing copy
+        :param tile_bytes: The bytes of the tile to add
+        :param digest: The digest of tile_bytes if it is already known
+        :return: The 0 based tile id of the new tile
+        """
+        if digest is None:
+            digest = self.hash_func(tile_bytes)
+        tile_id = len(self.tiles)
+        self.tiles.append(tile_bytes)
+        self._buckets.setdefault(digest, []).append(tile_id)
+        return tile_id
+
+    def find_or_add(self, tile_bytes):
+        """
+        Finds a tile in the index, adding it if it is not there
+        :param tile_bytes: The bytes of the tile
+        :return: tuple of (0 based tile id, True if the tile was added)
+        """
+        digest = self.hash_func(tile_bytes)
+        tile_id = self.find(tile_bytes, digest)
+        if tile_id != -1:
+            return tile_id, False
+        return self.add(tile_bytes, digest), True
+
+    def lookup_gid(self, tile_bytes):
+        """
+        Finds a tile in the index, adding it if it is not there
+        :param tile_bytes: The bytes of the tile
+        :return: the 1 based gid of the tile
+        """
+        return self.find_or_add(tile_bytes)[0] + 1
+
+    def get_stats(self):
+        """
+        :return: dict of the index counters
+        """
+        return {
+            'unique_tiles': len(self.tiles),
+            'buckets': len(self._buckets),
+            'lookups': self.lookups,
+            'digest_hits': self.digest_hits,
+            'collisions': self.collisions,
+        }
+
+
+def _get_flip_permutation(tile_size, flags, inverse):
+    """
+    Builds (and caches) the pixel permutation of a Tiled flip
+    :param tile_size: The size of the tiles
+    :param flags: A combination of the FLIPPED_* flags
+    :param inverse: True for the permutation that undoes the flip
+    :return: list where pixel i of the result is pixel permutation[i] of the source
+    """
+    key = (tile_size, flags, inverse)
+    permutation = _flip_permutations.get(key)
+    if permutation is None:
+        # Tiled applies the diagonal flip (x/y swap) first, then the horizontal and vertical flips
+        last = tile_size - 1
+        permutation = []
+        for y in range(0, tile_size):
+            flip_y = last - y if flags & FLIPPED_VERTICALLY else y
+            for x in range(0, tile_size):
+                flip_x = last - x if flags & FLIPPED_HORIZONTALLY else x
+                if flags & FLIPPED_DIAGONALLY:
+                    permutation.append(flip_x * tile_size + flip_y)
+                else:
+                    permutation.append(flip_y * tile_size + flip_x)
+
+        if inverse:
+            inverse_permutation = [0] * len(permutation)
+            for pixel, source_pixel in enumerate(permutation):
+                inverse_permutation[source_pixel] = pixel
+            permutation = inverse_permutation
+        _flip_permutations[key] = permutation
+    return permutation
+
+
+_flip_permutations = {}
+
+
+def flip_tile(tile_bytes, tile_size, channels, flags, inverse=False):
+    """
+    Flips a tile the way Tiled draws a gid with flip flags
+    :param tile_bytes: The tile, rows one after the other
+    :param tile_size: The size of the tile
+    :param channels: The number of bytes per pixel
+    :param flags: A combination of the FLIPPED_* flags
+    :param inverse: True to undo the flip instead
+    :return: the flipped tile bytes
+    """
+    pixels = [tile_bytes[i:i + channels] for i in range(0, len(tile_bytes), channels)]
+    return b''.join([pixels[source_pixel] for source_pixel in _get_flip_permutation(tile_size, flags, inverse)])
+
+
+class FlipTileIndex(TileDigestIndex):
+    """
+    A TileDigestIndex which also matches tiles against the 8 flipped and rotated versions of the unique tiles.
+    Matches are returned as gids with Tiled's flip flags in the high bits.
+    A tile that misses the exact lookup is checked against the orientations matched before, which costs one flip to
+    confirm, and then its 7 other orientations are looked up in the index, so lookups stay O(1).
+    """
+    # Orientations to try after the exact lookup, in order
+    ORIENTATIONS = [
+        FLIPPED_HORIZONTALLY,
+        FLIPPED_VERTICALLY,
+        FLIPPED_HORIZONTALLY | FLIPPED_VERTICALLY,
+        FLIPPED_DIAGONALLY,
+        FLIPPED_DIAGONALLY | FLIPPED_HORIZONTALLY,
+        FLIPPED_DIAGONALLY | FLIPPED_VERTICALLY,
+        FLIPPED_DIAGONALLY | FLIPPED_HORIZONTALLY | FLIPPED_VERTICALLY,
+    ]
+
+    def __init__(self, tile_size, channels, hasher='crc32', tiles=None):
+        """
+        :param tile_size: The size of the tiles
+        :param channels: The number of bytes per pixel
+        :param hasher: The name of a hasher in HASHERS, or a callable taking bytes and returning a hashable digest
+        :param tiles: The container unique tiles are appended to, a new list if None
+        """
+        TileDigestIndex.__init__(self, hasher, tiles)
+        self.tile_size = tile_size
+        self.channels = channels
+        # Flipped tiles seen before: {digest: [gid with flags, ...]}
+        self._flip_aliases = {}
+        self.flip_hits = 0
+
+    def lookup_gid(self, tile_bytes):
+        """
+        Finds a tile in any orientation, adding it if it is not there
+        :param tile_bytes: The bytes of the tile
+        :return: the 1 based gid of the tile, with flip flags if a flipped version of a unique tile matched
+        """
+        digest = self.hash_func(tile_bytes)
+        tile_id = self.find(tile_bytes, digest)
+        if tile_id != -1:
+            return tile_id + 1
+
+        for gid in self._flip_aliases.get(digest, ()):
+            flags = gid & FLIP_FLAGS
+            if flip_tile(self.tiles[(gid & ~FLIP_FLAGS) - 1], self.tile_size, self.channels, flags) == tile_bytes:
+                self.flip_hits += 1
+                return gid
+
+        for flags in self.ORIENTATIONS:
+            tile_id = self.find(flip_tile(tile_bytes, self.tile_size, self.channels, flags, inverse=True))
+            if tile_id != -1:
+                gid = (tile_id + 1) | flags
+                self._flip_aliases.setdefault(digest, []).append(gid)
+                self.flip_hits += 1
+                return gid
+
+        return self.add(tile_bytes, digest) + 1
+
+    def get_stats(self):
+        """
+        :return: dict of the index counters
+        """
+        stats = TileDigestIndex.get_stats(self)
+        stats['flip_hits'] = self.flip_hits
+        return stats
+
+
+class FuzzyTileIndex(TileDigestIndex):
+    """
+    A TileDigestIndex which also matches near duplicate tiles, for maps captured with lossy compression.
+    A tile matches a unique tile if no channel value differs by more than max_channel_error and/or the sum of the
+    absolute channel differences is no more than max_tile_error. The lowest matching tile id wins.
+    Near duplicates are found through a multi-index of index_tables tries. Each trie branches on a channel value per
+    level, index_positions values spread over the tile, quantized into cells four times the search radius wide.
+    A leaf splits on the next value once it holds more than LEAF_TILES tiles, so tries grow deeper rather than their
+    leaves longer. A near duplicate's values are within the radius of the tile's, so a search only follows the one or
+    two cells the radius overlaps at every level:
+        - with max_channel_error the radius is the channel error, and the trie whose leaves found hold the fewest
+          tiles holds every match
+        - with only max_tile_error, the channel differences at the positions of at least one trie add up to no more
+          than max_tile_error / index_tables, the radius, so the tries together hold every match
+    Only the tiles in the leaves found are compared pixel by pixel. A search visits about 1.5 ** depth nodes for a
+    depth of about log8(N / LEAF_TILES), so lookups are well below O(N) in the unique tiles N, unless the channel error
+    is a large part of the value range or the tiles are mostly flat color at the keyed positions. A tile error alone
+    prunes far less than a channel error, as its radius per trie is much wider.
+    """
+    # The most tiles a trie leaf holds before it splits
+    LEAF_TILES = 8
+
+    def __init__(self, tile_size, channels, max_channel_error=None, max_tile_error=None, hasher='crc32', tiles=None,
+                 index_tables=4, index_positions=8):
+        """
+        :param tile_size: The size of the tiles
+        :param channels: The number of bytes per pixel
+        :param max_channel_error: The largest difference allowed in any channel value, None for no limit
+        :param max_tile_error: The largest sum of absolute channel differences allowed, None for no limit
+        :param hasher: The name of a hasher in HASHERS, or a callable taking bytes and returning a hashable digest
+        :param tiles: The container unique tiles are appended to, a new list if None
+        :param index_tables: The number of tries
+        :param index_positions: The number of channel values every trie branches on, its largest depth
+        """
+        if max_channel_error is None and max_tile_error is None:
+            raise ValueError('FuzzyTileIndex needs a max_channel_error or a max_tile_error')
+
+        TileDigestIndex.__init__(self, hasher, tiles)
+        self.tile_size = tile_size
+        self.channels = channels
+        self.max_channel_error = max_channel_error
+        self.max_tile_error = max_tile_error
+
+        # Positions spread evenly over the tile bytes, trie t takes every index_tables-th one from t
+        num_bytes = tile_size * tile_size * channels
+        num_positions = min(num_bytes, index_tables * index_positions)
+        positions = [(position * 2 + 1) * num_bytes // (num_positions * 2) for position in range(0, num_positions)]
+        self._positions = positions
+        self._table_positions = [positions[table::index_tables] for table in range(0, min(index_tables,
+                                                                                          num_positions))]
+        if max_channel_error is not None:
+            self._search_radius = max_channel_error
+            if max_tile_error is not None:
+                self._search_radius = min(max_channel_error, max_tile_error)
+            self._match_all_tables = False
+        else:
+            self._search_radius = max_tile_error // len(self._table_positions)
+            self._match_all_tables = True
+        self._cell_size = max(1, self._search_radius * 4)
+        # Trie nodes look like this: [[tile_id, ...], None] for a leaf, [None, {cell: child node}] once split
+        self._tables = [[[], None] for _ in self._table_positions]
+        # Near duplicates seen before: {digest: [tile_id, ...]}
+        self._fuzzy_aliases = {}
+
+        self.fuzzy_hits = 0
+        self.near_searches = 0
+        self.near_candidates = 0
+        self.max_channel_error_accepted = 0
+        self.max_tile_error_accepted = 0
+
+    def get_error(self, tile_bytes1, tile_bytes2):
+        """
+        :return: tuple of (largest channel difference, sum of channel differences) between two tiles
+        """
+        differences = [abs(value1 - value2) for value1, value2 in zip(bytearray(tile_bytes1), bytearray(tile_bytes2))]
+        return max(differences), sum(differences)
+
+    def _accepts(self, error):
+        """
+        :param error: tuple of (largest channel difference, sum of channel differences)
+        :return: True if the error is within the thresholds
+        """
+        if self.max_channel_error is not None and error[0] > self.max_channel_error:
+            return False
+        if self.max_tile_error is not None and error[1] > self.max_tile_error:
+            return False
+        return True
+
+    def _accept(self, tile_id, error):
+        """
+        Records a near duplicate match
+        :return: the 1 based gid of the match
+        """
+        self.fuzzy_hits += 1
+        self.max_channel_error_accepted = max(self.max_channel_error_accepted, error[0])
+        self.max_tile_error_accepted = max(self.max_tile_error_accepted, error[1])
+        return tile_id + 1
+
+    def _may_match(self, tile_values1, tile_values2):
+        """
+        Compares two tiles at the trie positions only, a quick check before get_error
+        :param tile_values1: The bytearray of a tile
+        :param tile_values2: The bytearray of the other tile
+        :return: False if the tiles differ by more than the thresholds at the trie positions
+        """
+        differences = [abs(tile_values1[position] - tile_values2[position]) for position in self._positions]
+        if self.max_channel_error is not None and max(differences) > self.max_channel_error:
+            return False
+        if self.max_tile_error is not None and sum(differences) > self.max_tile_error:
+            return False
+        return True
+
+    def _search_tables(self, tile_values):
+        """
+        :param tile_values: The bytearray of the tile to search for
+        :return: sorted list of the ids of the unique tiles which may be near duplicates of the tile
+        """
+        radius = self._search_radius
+        cell_size = self._cell_size
+        table_buckets = []
+        for positions, root in zip(self._table_positions, self._tables):
+            # The leaves whose cells the radius overlaps
+            buckets = []
+            nodes = [(root, 0)]
+            while nodes:
+                (tile_ids, children), depth = nodes.pop()
+                if children is None:
+                    buckets.append(tile_ids)
+                    continue
+                value = tile_values[positions[depth]]
+                for cell in range(max(0, value - radius) // cell_size, min(255, value + radius) // cell_size + 1):
+                    child = children.get(cell)
+                    if child is not None:
+                        nodes.append((child, depth + 1))
+            table_buckets.append(buckets)
+
+        if self._match_all_tables:
+            candidates = set()
+            for buckets in table_buckets:
+                for bucket in buckets:
+                    candidates.update(bucket)
+            return sorted(candidates)
+        # Every trie holds all the matches, search the smallest
+        buckets = min(table_buckets, key=lambda buckets: sum(len(bucket) for bucket in buckets))
+        return sorted(tile_id for bucket in buckets for tile_id in bucket)
+
+    def lookup_gid(self, tile_bytes):
+        """
+        Finds a tile or a near duplicate of it, adding it if there is neither
+        :param tile_bytes: The bytes of the tile
+        :return: the 1 based gid of the tile
+        """
+        digest = self.hash_func(tile_bytes)
+        tile_id = self.find(tile_bytes, digest)
+        if tile_id != -1:
+            return tile_id + 1
+
+        for tile_id in self._fuzzy_aliases.get(digest, ()):
+            error = self.get_error(self.tiles[tile_id], tile_bytes)
+            if self._accepts(error):
+                return self._accept(tile_id, error)
+
+        tile_values = bytearray(tile_bytes)
+        candidates = self._search_tables(tile_values)
+        self.near_searches += 1
+        self.near_candidates += len(candidates)
+        for tile_id in candidates:
+            candidate_values = bytearray(self.tiles[tile_id])
+            if not self._may_match(candidate_values, tile_values):
+                continue
+            error = self.get_error(candidate_values, tile_values)
+            if self._accepts(error):
+                self._fuzzy_aliases.setdefault(digest, []).append(tile_id)
+                return self._accept(tile_id, error)
+
+        return self.add(tile_bytes, digest) + 1
+
+    def _insert_trie(self, root, positions, tile_values, tile_id):
+        """
+        Adds a tile to a trie, splitting its leaf if it gets too long
+        """
+        cell_size = self._cell_size
+        node = root
+        depth = 0
+        while node[1] is not None:
+            node = node[1].setdefault(tile_values[positions[depth]] // cell_size, [[], None])
+            depth += 1
+        node[0].append(tile_id)
+        if len(node[0]) > self.LEAF_TILES and depth < len(positions):
+            children = {}
+            for leaf_tile_id in node[0]:
+                cell = bytearray(self.tiles[leaf_tile_id])[positions[depth]] // cell_size
+                children.setdefault(cell, [[], None])[0].append(leaf_tile_id)
+            node[0] = None
+            node[1] = children
+
+    def add(self, tile_bytes, digest=None):
+        """
+        Adds a tile to the index and the tries without checking for an existing copy
+        :param tile_bytes: The bytes of the tile to add
+        :param digest: The digest of tile_bytes if it is already known
+        :return: The 0 based tile id of the new tile
+        """
+        tile_id = TileDigestIndex.add(self, tile_bytes, digest)
+        tile_values = bytearray(tile_bytes)
+        for positions, root in zip(self._table_positions, self._tables):
+            self._insert_trie(root, positions, tile_values, tile_id)
+        return tile_id
+
+    def get_stats(self):
+        """
+        :return: dict of the index counters
+        """
+        stats = TileDigestIndex.get_stats(self)
+        stats['fuzzy_hits'] = self.fuzzy_hits
+        stats['near_searches'] = self.near_searches
+        stats['near_candidates'] = self.near_candidates
+        stats['max_channel_error_accepted'] = self.max_channel_error_accepted
+        stats['max_tile_error_accepted'] = self.max_tile_error_accepted
+        return stats
+
+
+class MappedTileBuffer:
+    """
+    An append only byte buffer backed by a memory mapped temporary file.
+    TileStore spills its tiles into one of these once it goes over its memory budget, so tile pixels live in the
+    page cache rather than in the process heap.
+    """
+    MIN_CAPACITY = 1 << 20
+
+    def __init__(self, spill_dir=None):
+        """
+        :param spill_dir: The directory to create the temporary file in, the system temp directory if None
+        """
+        self._file = tempfile.TemporaryFile(dir=spill_dir)
+        self._map = None
+        self._length = 0
+        self._capacity = 0
+
+    def __len__(self):
+        return self._length
+
+    def _reserve(self, capacity):
+        """
+        Grows the file and re-maps it
+        Note: The old map is not closed, views into it stay valid until they are released.
+        :param capacity: The minimum number of bytes to map
+        """
+        new_capacity = max(self._capacity * 2, capacity, self.MIN_CAPACITY)
+        self._file.truncate(new_capacity)
+        self._map = mmap.mmap(self._file.fileno(), new_capacity)
+        self._capacity = new_capacity
+
+    def extend(self, data):
+        """
+        Appends bytes to the end of the buffer
+        :param data: The bytes-like object to append
+        """
+        end = self._length + len(data)
+        if end > self._capacity:
+            self._reserve(end)
+        self._map[self._length:end] = data
+        self._length = end
+
+    def view(self):
+        """
+        :return: A memoryview of the used part of the buffer
+        """
+        if self._map is None:
+            return memoryview(b'')
+        return memoryview(self._map)[:self._length]
+
+    def close(self):
+        """
+        Closes and deletes the temporary file
+        """
+        self._map = None
+        self._file.close()
+
+
+class TilePalette:
+    """
+    The colors of palette indexed tiles, up to 256 RGBA colors. Tiles store one byte per pixel, the index of its color,
+    so comparing and hashing tiles works on the indices.
+    Colors keep their index once added. A fixed palette (one handed in by the user) never grows and colors which are
+    not in it are an error.
+    """
+    MAX_COLORS = 256
+
+    def __init__(self, colors=None, fixed=False):
+        """
+        :param colors: Initial list of (R, G, B) or (R, G, B, A) colors
+        :param fixed: True if colors can not be added
+        """
+        self.colors = []
+        self._indices = {}
+        self.fixed = False
+        for color in colors or []:
+            self.get_index(color)
+        self.fixed = fixed
+
+    def __len__(self):
+        return len(self.colors)
+
+    def get_index(self, color):
+        """
+        Gets the index of a color, adding it if it is new
+        :param color: (R, G, B) or (R, G, B, A), or the 3 or 4 bytes of a pixel
+        :return: The palette index
+        """
+        color = tuple(bytearray(color))
+        if len(color) == 3:
+            color += (255,)
+        index = self._indices.get(color)
+        if index is not None:
+            return index
+        if self.fixed:
+            raise ValueError('Color {0} is not in the palette'.format(color))
+        if len(self.colors) >= self.MAX_COLORS:
+            raise ValueError('More than {0} colors, use an RGB or RGBA pixel format'.format(self.MAX_COLORS))
+        self._indices[color] = len(self.colors)
+        self.colors.append(color)
+        return self._indices[color]
+
+    def get_translation(self, source_colors):
+        """
+        Builds a bytes.translate table from the indices of another palette to the indices of this one
+        :param source_colors: The colors of the other palette
+        :return: 256 byte translation table, or None if the indices are the same
+        """
+        table = bytearray(range(0, 256))
+        for source_index, color in enumerate(source_colors):
+            table[source_index] = self.get_index(color)
+        if table == bytearray(range(0, 256)):
+            return None
+        return bytes(table)
+
+    def iter_translated_rows(self, rows, source_colors):
+        """
+        Converts rows of another palette's indices to indices of this palette. The colors are added on the first row,
+        so colors added before iterating keep their indices.
+        :param rows: Iterable of rows of palette indices
+        :param source_colors: The colors of the other palette
+        :return: generator of bytearray rows of palette indices
+        """
+        table = None
+        for row_number, row in enumerate(rows):
+            if row_number == 0:
+                table = self.get_translation(source_colors)
+            row = bytearray(row)
+            yield row.translate(table) if table is not None else row
+
+    def iter_index_rows(self, rows, channels):
+        """
+        Converts true color rows to palette index rows
+        :param rows: Iterable of rows, [R,G,B, R,G,B, ...] or [R,G,B,A, ...]
+        :param channels: 3 or 4
+        :return: generator of bytearray rows of palette indices
+        """
+        pixel_indices = dict((bytes(bytearray(color[:channels])), index) for index, color in enumerate(self.colors)
+                             if channels == 4 or color[3] == 255)
+        for row in rows:
+            row = bytes(bytearray(row))
+            pixels = [row[start:start + channels] for start in range(0, len(row), channels)]
+            try:
+                yield bytearray([pixel_indices[pixel] for pixel in pixels])
+            except KeyError:
+                for pixel in pixels:
+                    if pixel not in pixel_indices:
+                        pixel_indices[pixel] = self.get_index(pixel)
+                yield bytearray([pixel_indices[pixel] for pixel in pixels])
+
+    def get_fill_index(self):
+        """
+        :return: The index of the color unused sheet space is filled with: transparent if the palette has it, else
+                 white, added if there is room
+        """
+        for index, color in enumerate(self.colors):
+            if color[3] == 0:
+                return index
+        try:
+            return self.get_index((255, 255, 255))
+        except ValueError:
+            return 0
+
+    def get_chunks(self):
+        """
+        :return: list of the PNG (chunk type, chunk data) describing the palette, PLTE and tRNS if there is alpha
+        """
+        chunks = [(b'PLTE', bytes(bytearray(channel for color in self.colors for channel in color[:3])))]
+        alphas = [color[3] for color in self.colors]
+        while alphas and alphas[-1] == 255:
+            alphas.pop()
+        if alphas:
+            chunks.append((b'tRNS', bytes(bytearray(alphas))))
+        return chunks
+
+
+class TileStore:
+    """
+    A contiguous store of tile pixels. Tiles are laid out one after the other in a single growable uint8 buffer
+    shaped (num_tiles, tile_size, tile_size, channels). Two tiles, 2x2 pixels:
+    RGBRGB RGBRGB RGBRGB RGBRGB
+    |tile 1 rows| |tile 2 rows|
+    Indexing returns a memoryview of a tile and slicing returns a TileStore view sharing the same buffer,
+    so nothing is copied on the way to the outputs.
+    With a memory budget the tiles spill into a MappedTileBuffer once the budget is used up.
+    Palette indexed stores have one channel, the palette index of each pixel, see TilePalette.
+    Note: A bytearray cannot grow while a view of it is alive, release views before appending.
+    """
+    def __init__(self, tile_size, channels=3, buffer=None, memory_budget=None, spill_dir=None, palette=None):
+        """
+        :param tile_size: The width and height of each tile in pixels
+        :param channels: The number of bytes per pixel
+        :param buffer: An existing buffer of tile bytes to wrap, a new bytearray if None
+        :param memory_budget: The number of tile bytes to keep in memory before spilling to disk, None for no limit
+        :param spill_dir: The directory to spill tiles to, the system temp directory if None
+        :param palette: The TilePalette of a palette indexed store, channels must be 1
+        """
+        if palette is not None and channels != 1:
+            raise ValueError('Palette indexed tiles have 1 channel, got {0}'.format(channels))
+        self.tile_size = tile_size
+        self.channels = channels
+        self.palette = palette
+        self.row_bytes = tile_size * channels
+        self.tile_bytes = self.row_bytes * tile_size
+        self.buffer = bytearray() if buffer is None else buffer
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+
+    def __len__(self):
+        return len(self.buffer) // self.tile_bytes
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError('TileStore slices must be contiguous')
+            stop = max(start, stop)
+            view = self.view()[start * self.tile_bytes:stop * self.tile_bytes]
+            return TileStore(self.tile_size, self.channels, view, palette=self.palette)
+
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError('Tile index out of range')
+        return self.view()[key * self.tile_bytes:(key + 1) * self.tile_bytes]
+
+    def __iter__(self):
+        for tile_id in range(0, len(self)):
+            yield self[tile_id]
+
+    def append(self, tile_bytes):
+        """
+        Appends a tile to the end of the store
+        :param tile_bytes: The tile_bytes long tile, rows one after the other
+        :return: The 0 based id of the appended tile
+        """
+        if len(tile_bytes) != self.tile_bytes:
+            raise ValueError('Expected {0} tile bytes, got {1}'.format(self.tile_bytes, len(tile_bytes)))
+        tile_id = len(self)
+        if self.memory_budget is not None and not self.is_spilled() and \
+                len(self.buffer) + self.tile_bytes > self.memory_budget:
+            self.spill()
+        self.buffer.extend(tile_bytes)
+        return tile_id
+
+    def is_spilled(self):
+        """
+        :return: True if the tiles live in a memory mapped file
+        """
+        return isinstance(self.buffer, MappedTileBuffer)
+
+    def spill(self):
+        """
+        Moves the tiles into a memory mapped temporary file, new tiles are appended to the file
+        """
+        if self.is_spilled():
+            return
+        mapped_buffer = MappedTileBuffer(self.spill_dir)
+        mapped_buffer.extend(self.buffer)
+        self.buffer = mapped_buffer
+
+    def view(self):
+        """
+        :return: A memoryview of every tile in the store
+        """
+        if self.is_spilled():
+            return self.buffer.view()
+        return memoryview(self.buffer)
+
+    def close(self):
+        """
+        Releases the spill file, if any. The store is empty afterwards.
+        """
+        if self.is_spilled():
+            self.buffer.close()
+        self.buffer = bytearray()
+
+    def get_fill_pixel(self):
+        """
+        :return: The bytes of the pixel unused sheet space is filled with: white for RGB, transparent for RGBA and the
+                 palette's fill color for palette indexed tiles
+        """
+        if self.palette is not None:
+            return bytes(bytearray([self.palette.get_fill_index()]))
+        if self.channels == 4:
+            return b'\x00' * 4
+        return b'\xff' * self.channels
+
+    def get_tile_row(self, tile_id, row):
+        """
+        Gets a single row of pixels from a tile
+        :param tile_id: The 0 based tile id
+        :param row: The row within the tile
+        :return: memoryview of the row, [R,G,B, R,G,B, ...]
+        """
+        start = tile_id * self.tile_bytes + row * self.row_bytes
+        return self.view()[start:start + self.row_bytes]
+
+    def get_tile_rows(self, tile_id):
+        """
+        Gets a list of row views for a tile, which is what the PNG writer wants
+        :param tile_id: The 0 based tile id
+        :return: list of tile_size memoryviews
+        """
+        return [self.get_tile_row(tile_id, row) for row in range(0, self.tile_size)]
+
+    def get_tile_row_list(self, tile_id):
+        """
+        Compatibility accessor for the old tile layout, a list of rows of ints
+        :param tile_id: The 0 based tile id
+        :return: [[R, G, B, R, G, B], [R, G, B, R, G, B]]
+        """
+        return [list(row) for row in self.get_tile_rows(tile_id)]
+
+
+class PngEncoder:
+    """
+    Writes 8 bit PNGs with a tunable zlib compression level and strategy.
+    Rows use the PNG None filter like png.Writer, the strategy decides how zlib searches for matches.
+    An encoder only holds its settings so one encoder can write any number of same sized images, from any thread.
+    """
+    STRATEGIES = {
+        'default': zlib.Z_DEFAULT_STRATEGY,
+        'filtered': zlib.Z_FILTERED,
+        'huffman': zlib.Z_HUFFMAN_ONLY,
+        'rle': getattr(zlib, 'Z_RLE', zlib.Z_DEFAULT_STRATEGY),
+    }
+
+    # Named (level, strategy) pairs. fast is for iterating on maps, max is for shipping builds.
+    PRESETS = {
+        'fast': (1, 'rle'),
+        'default': (6, 'default'),
+        'max': (9, 'default'),
+    }
+
+    # PNG colour types by bytes per pixel
+    COLOR_TYPES = {3: 2, 4: 6}
+    PALETTE_COLOR_TYPE = 3
+
+    # Raw bytes handed to zlib at a time
+    COMPRESS_BATCH_SIZE = 1 << 16
+
+    def __init__(self, width, height, channels=3, compression='default', strategy=None, palette=None):
+        """
+        :param width: The width of the images in pixels
+        :param height: The height of the images in pixels
+        :param channels: 3 for RGB, 4 for RGBA, 1 for palette indices
+        :param compression: A preset name from PRESETS or a zlib level 0-9
+        :param strategy: A strategy name from STRATEGIES, overrides the preset strategy
+        :param palette: The TilePalette of palette indexed images
+        """
+        if compression in self.PRESETS:
+            self.level, preset_strategy = self.PRESETS[compression]
+        else:
+            self.level, preset_strategy = int(compression), 'default'
+        if not 0 <= self.level <= 9:
+            raise ValueError('PNG compression level must be 0-9, got {0}'.format(self.level))
+
+        self.strategy = preset_strategy if strategy is None else strategy
+        if self.strategy not in self.STRATEGIES:
+            raise ValueError('Unknown PNG strategy {0}, expected one of {1}'.format(self.strategy,
+                                                                                   sorted(self.STRATEGIES)))
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.palette = palette
+        if palette is not None:
+            if channels != 1:
+                raise ValueError('Palette indexed images have 1 channel, got {0}'.format(channels))
+            color_type = self.PALETTE_COLOR_TYPE
+        else:
+            color_type = self.COLOR_TYPES[channels]
+        self._header = struct.pack('!2I5B', width, height, 8, color_type, 0, 0, 0)
+
+    def write(self, out_file, rows):
+        """
+        Writes a PNG
+        :param out_file: The binary file to write to
+        :param rows: Iterable of height packed rows, width * channels bytes each
+        :return: the number of bytes written
+        """
+        bytes_written = [len(b'\x89PNG\r\n\x1a\n')]
+
+        def count_chunks(chunks):
+            for chunk_type, chunk_data in chunks:
+                bytes_written[0] += len(chunk_data) + 12  # length, type and crc
+                yield chunk_type, chunk_data
+
+        png.write_chunks(out_file, count_chunks(self._iter_chunks(rows)))
+        return bytes_written[0]
+
+    def _iter_chunks(self, rows):
+        """
+        :param rows: Iterable of packed rows
+        :return: generator of (chunk type, chunk data)
+        """
+        yield b'IHDR', self._header
+        if self.palette is not None:
+            # The palette is read when the image is written, tiles may have added colors since the encoder was made
+            for chunk in self.palette.get_chunks():
+                yield chunk
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS, 8, self.STRATEGIES[self.strategy])
+        raw = bytearray()
+        for row in rows:
+            raw.append(0)  # None filter
+            raw.extend(row)
+            if len(raw) >= self.COMPRESS_BATCH_SIZE:
+                compressed = compressor.compress(bytes(raw))
+                del raw[:]
+                if compressed:
+                    yield b'IDAT', compressed
+
+        compressed = compressor.compress(bytes(raw)) + compressor.flush()
+        if compressed:
+            yield b'IDAT', compressed
+        yield b'IEND', b''
+
+
+class SheetPacker:
+    """
+    Lays unique tiles out on sheets (texture atlases) and composes the sheet rows.
+    Every sheet but the last is the largest allowed size and full. The last sheet is the smallest one that fits the
+    tiles left: a square, or with square=False a rectangle close to square. Sizes are rounded up to powers of two
+    unless power_of_two is False.
+    Each tile can be surrounded by extrude copies of its edge pixels and padding pixels of spacing, which stops
+    neighbouring tiles bleeding into each other when the sheet is filtered or mip mapped. Tiled reads the tiles back
+    with the margin and spacing of the tile set, see get_margin and get_spacing. Unused space is filled with the fill
+    pixel of the tiles, see TileStore.get_fill_pixel.
+    The defaults are the original layout: power of two squares from 64 to 512 pixels with no padding.
+    """
+    def __init__(self, tile_size, max_sheet_size=512, min_sheet_size=64, square=True, power_of_two=True, padding=0,
+                 extrude=0):
+        """
+        :param tile_size: The size of the tiles
+        :param max_sheet_size: The largest sheet width and height, the maximum texture size of the engine
+        :param min_sheet_size: The smallest sheet width and height, when sizes are powers of two
+        :param square: False to allow rectangular sheets
+        :param power_of_two: False to allow any sheet size
+        :param padding: The pixels of space between tiles
+        :param extrude: The pixels of each tile's edge repeated around it
+        """
+        if padding < 0 or extrude < 0:
+            raise ValueError('Padding and extrude can not be negative')
+        self.tile_size = tile_size
+        self.max_sheet_size = max_sheet_size
+        self.min_sheet_size = min_sheet_size
+        self.square = square
+        self.power_of_two = power_of_two
+        self.padding = padding
+        self.extrude = extrude
+        # The space a tile takes up on the sheet, with its extrusion and the padding after it
+        self.cell_size = tile_size + 2 * extrude + padding
+        if self.get_columns(max_sheet_size) < 1:
+            raise ValueError('Max sheet size {0} does not fit one tile'.format(max_sheet_size))
+
+    def get_margin(self):
+        """
+        :return: The tile set margin, pixels before the first tile
+        """
+        return self.extrude
+
+    def get_spacing(self):
+        """
+        :return: The tile set spacing, pixels between tiles
+        """
+        return 2 * self.extrude + self.padding
+
+    def get_columns(self, size):
+        """
+        :param size: A sheet width or height
+        :return: The number of tiles which fit across size
+        """
+        return (size + self.padding) // self.cell_size
+
+    def get_size(self, columns):
+        """
+        :param columns: The number of tiles across
+        :return: The sheet width or height needed for columns tiles
+        """
+        size = max(columns * self.cell_size - self.padding, 1)
+        if self.power_of_two:
+            size = max(self.min_sheet_size, 1 << (size - 1).bit_length())
+        return min(size, self.max_sheet_size)
+
+    def _fit_last_sheet(self, num_tiles):
+        """
+        :param num_tiles: The number of tiles left, no more than fit on the largest sheet
+        :return: tuple of (width, height) of the smallest sheet that fits them
+        """
+        columns = int(math.ceil(math.sqrt(num_tiles)))
+        width = self.get_size(columns)
+        if self.square:
+            return width, width
+        # The width may have been rounded up, fill it before adding rows
+        columns = self.get_columns(width)
+        return width, self.get_size(int(math.ceil(num_tiles / float(columns))))
+
+    def get_layout(self, num_tiles):
+        """
+        :param num_tiles: The number of tiles to lay out
+        :return: list of [width, height, first tile id, number of tiles, columns, margin, spacing] for every sheet
+        """
+        full_columns = self.get_columns(self.max_sheet_size)
+        full_tiles = full_columns * full_columns
+
+        sheets = []
+        first_tile = 0
+        while first_tile < num_tiles:
+            tiles_left = num_tiles - first_tile
+            if tiles_left > full_tiles:
+                width, height = self.max_sheet_size, self.max_sheet_size
+            else:
+                width, height = self._fit_last_sheet(tiles_left)
+            columns = self.get_columns(width)
+            num_tiles_on_sheet = min(columns * self.get_columns(height), tiles_left)
+            sheets.append([width, height, first_tile, num_tiles_on_sheet, columns, self.get_margin(),
+                           self.get_spacing()])
+            first_tile += num_tiles_on_sheet
+        return sheets
+
+    def get_occupancy(self, sheet):
+        """
+        :param sheet: A sheet of get_layout
+        :return: tuple of (share of the sheet's tile slots used, share of the sheet's pixels that are tile pixels)
+        """
+        width, height, first_tile, num_tiles, columns = sheet[:5]
+        capacity = columns * self.get_columns(height)
+        return (num_tiles / float(capacity),
+                num_tiles * self.tile_size * self.tile_size / float(width * height))
+
+    def iter_sheet_rows(self, tiles, width, height):
+        """
+        Builds the rows of a sheet one row of tiles at a time
+        :param tiles: The TileStore (or TileStore slice) of tiles to put on the sheet
+        :param width: The sheet width
+        :param height: The sheet height
+        :return: generator of sheet rows, [R,G,B, R,G,B, ...]
+        """
+        columns = self.get_columns(width)
+        if width == height and not self.padding and not self.extrude and columns * self.tile_size == width:
+            # The original layout has a faster compositor
+            for row in TileExtractor.iter_sheet_rows(tiles, width):
+                yield row
+            return
+
+        channels = tiles.channels
+        row_bytes = tiles.row_bytes
+        extrude = self.extrude
+        cell_rows = self.tile_size + 2 * extrude
+        fill_pixel = tiles.get_fill_pixel()
+        padding_bytes = fill_pixel * self.padding
+        empty_cell_row = fill_pixel * cell_rows
+        empty_sheet_row = fill_pixel * width
+        num_tiles = len(tiles)
+        rows_written = 0
+
+        def extrude_row(row):
+            row = bytes(row)
+            if not extrude:
+                return row
+            return row[:channels] * extrude + row + row[-channels:] * extrude
+
+        def get_cell_rows(tile):
+            tile_rows = [extrude_row(tile[row * row_bytes:(row + 1) * row_bytes]) for row in range(0, self.tile_size)]
+            return [tile_rows[0]] * extrude + tile_rows + [tile_rows[-1]] * extrude
+
+        for first_tile in range(0, num_tiles, columns):
+            band_cells = [get_cell_rows(tiles[tile_id]) for tile_id in range(first_tile, min(first_tile + columns,
+                                                                                             num_tiles))]
+            if rows_written:
+                for _ in range(0, min(self.padding, height - rows_written)):
+                    yield empty_sheet_row
+                    rows_written += 1
+            for cell_row in range(0, min(cell_rows, height - rows_written)):
+                row = padding_bytes.join([cell[cell_row] for cell in band_cells] +
+                                         [empty_cell_row] * (columns - len(band_cells)))
+                yield row + empty_sheet_row[len(row):]
+                rows_written += 1
+
+        for _ in range(rows_written, height):
+            yield empty_sheet_row
+
+
+class TileCache:
+    """
+    A persistent cache of an extraction, kept next to the output folder, so a re-run of a map only slices and
+    de-duplicates the bands which changed. Tile ids stay stable between runs: cached unique tiles keep their ids
+    and new tiles are added after them.
+    The cache folder holds:
+        cache.json  - the source file stats, tile size and options, the digest of every band, the sheet layout and
+                      the palette of palette indexed tiles
+        tiles.bin   - the unique tiles, TileStore layout
+        indices.bin - the tile indices, 4 byte little endian
+    cache.json is written last, a folder without it is ignored.
+    """
+    VERSION = 1
+
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: The folder to keep the cache in
+        """
+        self.cache_dir = cache_dir
+        self.info = None
+        self.tile_indices = None
+
+    def _path(self, file_name):
+        return os.path.join(self.cache_dir, file_name)
+
+    @staticmethod
+    def get_source_stats(source_file):
+        """
+        :param source_file: The source PNG
+        :return: [size, modification time] of the file
+        """
+        stats = os.stat(source_file)
+        return [stats.st_size, stats.st_mtime]
+
+    @staticmethod
+    def get_band_digest(band_rows):
+        """
+        :param band_rows: The rows of a band
+        :return: hex digest of the band pixels
+        """
+        band_hash = hashlib.blake2b(digest_size=16)
+        for row in band_rows:
+            band_hash.update(row)
+        return band_hash.hexdigest()
+
+    def load(self, source_file, tile_size, options, tiles_width, tiles_height):
+        """
+        Loads the cache if it was made from the same source size, tile size and options
+        :param source_file: The source PNG
+        :param tile_size: The size of the tiles
+        :param options: dict of the de-duplication options, must match the cached options
+        :param tiles_width: The number of tiles across the source
+        :param tiles_height: The number of tiles down the source
+        :return: True if the cache was loaded
+        """
+        self.info = None
+        self.tile_indices = None
+        try:
+            with open(self._path('cache.json'), 'r') as info_file:
+                info = json.load(info_file)
+        except (IOError, OSError, ValueError):
+            return False
+
+        if info.get('version') != self.VERSION or info.get('tile_size') != tile_size or \
+                info.get('options') != options or info.get('tiles_width') != tiles_width or \
+                info.get('tiles_height') != tiles_height:
+            return False
+
+        with open(self._path('indices.bin'), 'rb') as indices_file:
+            self.tile_indices = TileExtractor.unpack_tile_indices(indices_file.read())
+        if len(self.tile_indices) != tiles_width * tiles_height:
+            self.tile_indices = None
+            return False
+
+        self.info = info
+        return True
+
+    def is_source_unchanged(self, source_file):
+        """
+        :param source_file: The source PNG
+        :return: True if the loaded cache was made from a file with the same size and modification time
+        """
+        return self.info is not None and self.info['source'] == self.get_source_stats(source_file)
+
+    def iter_tiles(self, tile_bytes):
+        """
+        Reads the cached unique tiles in tile id order
+        :param tile_bytes: The number of bytes in a tile
+        :return: generator of tile bytes
+        """
+        with open(self._path('tiles.bin'), 'rb') as tiles_file:
+            for _ in range(0, self.info['num_tiles']):
+                yield tiles_file.read(tile_bytes)
+
+    def get_band_indices(self, band, band_digest):
+        """
+        :param band: The band number
+        :param band_digest: The digest of the band
+        :return: the cached tile indices of the band if the band is unchanged, else None
+        """
+        if self.info is None or self.info['band_digests'][band] != band_digest:
+            return None
+        tiles_width = self.info['tiles_width']
+        return self.tile_indices[band * tiles_width:(band + 1) * tiles_width]
+
+    def get_palette(self):
+        """
+        :return: list of the cached palette colors, empty if the tiles are not palette indexed
+        """
+        if self.info is None:
+            return []
+        return self.info.get('palette') or []
+
+    def get_sheets(self):
+        """
+        :return: list of the cached sheet layouts, see TileExtractor.get_sheet_layout, None if nothing was loaded
+        """
+        if self.info is None:
+            return None
+        return self.info['sheets']
+
+    def get_output_options(self, output):
+        """
+        :param output: The output name, such as 'tmx'
+        :return: The options the output was last written with, None if unknown
+        """
+        if self.info is None:
+            return None
+        return self.info.get('outputs', {}).get(output)
+
+    def save_outputs(self, sheets, outputs):
+        """
+        Records what was written from the cached extraction, so a re-run can tell which outputs are stale
+        :param sheets: The sheet layout of the sheets on disk, None if they were not written
+        :param outputs: dict of output name to the options it was written with
+        """
+        if self.info is None:
+            return
+        if sheets is not None:
+            self.info['sheets'] = sheets
+        self.info.setdefault('outputs', {}).update(outputs)
+        with open(self._path('cache.json'), 'w') as info_file:
+            json.dump(self.info, info_file)
+
+    def save(self, source_file, options, extractor, band_digests):
+        """
+        Saves an extraction. Cached tiles never change, so only new tiles are appended to tiles.bin.
+        The sheet layout of the loaded cache is kept, it describes the sheets on disk until save_outputs records the
+        sheets written from this extraction. Outputs depend on the tile indices, so they are all stale.
+        :param source_file: The source PNG
+        :param options: dict of the de-duplication options
+        :param extractor: The populated TileExtractor
+        :param band_digests: The digest of every band
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # Invalidate first so a partly written cache is never loaded
+        info_path = self._path('cache.json')
+        if os.path.exists(info_path):
+            os.remove(info_path)
+
+        tiles = extractor.tiles
+        num_cached_tiles = self.info['num_tiles'] if self.info is not None else 0
+        sheets = self.info['sheets'] if self.info is not None else []
+        tiles_path = self._path('tiles.bin')
+        with open(tiles_path, 'r+b' if num_cached_tiles and os.path.exists(tiles_path) else 'wb') as tiles_file:
+            tiles_file.seek(num_cached_tiles * tiles.tile_bytes)
+            tiles_file.write(tiles.view()[num_cached_tiles * tiles.tile_bytes:])
+            tiles_file.truncate()
+
+        with open(self._path('indices.bin'), 'wb') as indices_file:
+            indices_file.write(TileExtractor.pack_tile_indices(extractor.tile_indices))
+
+        info = {
+            'version': self.VERSION,
+            'source': self.get_source_stats(source_file),
+            'tile_size': extractor.tile_size,
+            'options': options,
+            'tiles_width': extractor.tiles_width,
+            'tiles_height': extractor.tiles_height,
+            'num_tiles': len(tiles),
+            'palette': [list(color) for color in tiles.palette.colors] if tiles.palette is not None else None,
+            'band_digests': band_digests,
+            'sheets': sheets,
+            'outputs': {},
+        }
+        with open(info_path, 'w') as info_file:
+            json.dump(info, info_file)
+        self.info = info
+
+
+class TileIndexFile:
+    """
+    A chunked map index file, to read the gids of any rectangle of a huge map without reading the rest of it.
+    The map is cut into chunks of chunk_width * chunk_height gids. The file holds:
+        header      - HEADER: magic, version, tiles width, tiles height, chunk width, chunk height, tile size
+        chunk table - an 8 byte little endian file offset per chunk, chunk rows top to bottom, 0 for empty chunks
+        chunks      - chunk_width * chunk_height 4 byte little endian gids each, row by row. Chunks at the right and
+                      bottom edges are padded with empty (0) gids, chunks of only empty gids are not stored.
+    Files are read through mmap, so a lookup only pages in the chunk rows it touches.
+    """
+    MAGIC = b'TIDX'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIIIIII')
+
+    def __init__(self, file_name):
+        """
+        Opens an index file for lookups
+        :param file_name: The index file, see write
+        """
+        self._file = open(file_name, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.tiles_width, self.tiles_height, self.chunk_width, self.chunk_height, \
+                self.tile_size = self.HEADER.unpack_from(self._map, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError('{0} is not a version {1} tile index file'.format(file_name, self.VERSION))
+            self.chunks_across = -(-self.tiles_width // self.chunk_width)
+            self.chunks_down = -(-self.tiles_height // self.chunk_height)
+            self._offsets = struct.unpack_from('<{0}Q'.format(self.chunks_across * self.chunks_down), self._map,
+                                               self.HEADER.size)
+        except (ValueError, struct.error):
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Closes the mapped file
+        """
+        self._map.close()
+        self._file.close()
+
+    @staticmethod
+    def iter_chunks(tile_indices, tiles_width, tiles_height, chunk_width, chunk_height):
+        """
+        Cuts tile indices into chunks, chunks at the right and bottom edges are cut short by the map
+        :param tile_indices: The tile indices of the map, row by row
+        :param tiles_width: The number of tiles across the map
+        :param tiles_height: The number of tiles down the map
+        :param chunk_width: The number of tiles across a chunk
+        :param chunk_height: The number of tiles down a chunk
+        :return: generator of (tile x, tile y, width, height, array of gids) for every chunk, chunk rows top to bottom
+        """
+        for chunk_top in range(0, tiles_height, chunk_height):
+            rows = min(chunk_height, tiles_height - chunk_top)
+            for chunk_left in range(0, tiles_width, chunk_width):
+                columns = min(chunk_width, tiles_width - chunk_left)
+                gids = array.array(UINT32_TYPECODE)
+                for y in range(chunk_top, chunk_top + rows):
+                    start = y * tiles_width + chunk_left
+                    gids.extend(tile_indices[start:start + columns])
+                yield chunk_left, chunk_top, columns, rows, gids
+
+    @classmethod
+    def write(cls, file_name, tile_indices, tiles_width, tiles_height, chunk_width=16, chunk_height=16, tile_size=0):
+        """
+        Writes a map's tile indices as an index file
+        :param file_name: The file to write
+        :param tile_indices: The tile indices of the map, row by row
+        :param tiles_width: The number of tiles across the map
+        :param tiles_height: The number of tiles down the map
+        :param chunk_width: The number of tiles across a chunk
+        :param chunk_height: The number of tiles down a chunk
+        :param tile_size: The size of the tiles, kept for readers
+        :return: The number of bytes written
+        """
+        if chunk_width <= 0 or chunk_height <= 0:
+            raise ValueError('Chunk sizes have to be positive')
+        num_chunks = -(-tiles_width // chunk_width) * -(-tiles_height // chunk_height)
+        table_start = cls.HEADER.size
+        offsets = []
+        with open(file_name, 'wb') as index_file:
+            index_file.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, tiles_width, tiles_height, chunk_width,
+                                             chunk_height, tile_size))
+            # The chunk table is filled in once the chunks are written
+            index_file.write(b'\0' * (num_chunks * 8))
+            for _, _, columns, rows, gids in cls.iter_chunks(tile_indices, tiles_width, tiles_height, chunk_width,
+                                                             chunk_height):
+                if not any(gids):
+                    offsets.append(0)
+                    continue
+                if columns < chunk_width or rows < chunk_height:
+                    padded = array.array(UINT32_TYPECODE, bytes(chunk_width * chunk_height * gids.itemsize))
+                    for row in range(0, rows):
+                        padded[row * chunk_width:row * chunk_width + columns] = gids[row * columns:(row + 1) * columns]
+                    gids = padded
+                offsets.append(index_file.tell())
+                index_file.write(TileExtractor.pack_tile_indices(gids))
+            file_bytes = index_file.tell()
+            index_file.seek(table_start)
+            index_file.write(struct.pack('<{0}Q'.format(num_chunks), *offsets))
+        return file_bytes
+
+    def get_rect(self, x, y, width, height):
+        """
+        Reads the gids of a rectangle of the map. Only the chunks the rectangle overlaps are read.
+        :param x: The tile x of the left of the rectangle
+        :param y: The tile y of the top of the rectangle
+        :param width: The number of tiles across the rectangle
+        :param height: The number of tiles down the rectangle
+        :return: array of width * height gids row by row, 0 for empty tiles and tiles outside the map
+        """
+        if width < 0 or height < 0:
+            raise ValueError('Rectangle sizes can not be negative')
+        gids = array.array(UINT32_TYPECODE, bytes(width * height * 4))
+        left = max(x, 0)
+        top = max(y, 0)
+        right = min(x + width, self.tiles_width)
+        bottom = min(y + height, self.tiles_height)
+        if left >= right or top >= bottom:
+            return gids
+
+        chunk_row_bytes = self.chunk_width * 4
+        for chunk_y in range(top // self.chunk_height, (bottom - 1) // self.chunk_height + 1):
+            chunk_top = chunk_y * self.chunk_height
+            for chunk_x in range(left // self.chunk_width, (right - 1) // self.chunk_width + 1):
+                offset = self._offsets[chunk_y * self.chunks_across + chunk_x]
+                if offset == 0:
+                    continue
+                chunk_left = chunk_x * self.chunk_width
+                start_x = max(left, chunk_left)
+                end_x = min(right, chunk_left + self.chunk_width)
+                span_bytes = (end_x - start_x) * 4
+                for row_y in range(max(top, chunk_top), min(bottom, chunk_top + self.chunk_height)):
+                    start = offset + (row_y - chunk_top) * chunk_row_bytes + (start_x - chunk_left) * 4
+                    target = (row_y - y) * width + start_x - x
+                    gids[target:target + end_x - start_x] = TileExtractor.unpack_tile_indices(
+                        self._map[start:start + span_bytes])
+        return gids
+
+    def get_gid(self, x, y):
+        """
+        :param x: The tile x
+        :param y: The tile y
+        :return: The gid of one tile, 0 for empty tiles and tiles outside the map
+        """
+        return self.get_rect(x, y, 1, 1)[0]
+
+
+class Instrumentation:
+    """
+    Progress, timings and counters of an extraction, and its console output.
+    Progress callbacks are called as callback(stage, done, total). Without callbacks the progress of extraction is
+    printed as dots and percentages. With quiet nothing is printed at all.
+    Stage timers add up the seconds spent in each of STAGES. Stages running in several threads or processes are summed
+    over all of them, so they can add up to more than the wall time.
+    """
+    STAGES = ('detect', 'decode', 'slice', 'dedup', 'compose', 'encode', 'tmx', 'index')
+
+    def __init__(self, quiet=False, progress_callbacks=None, profile_file=None):
+        """
+        :param quiet: True to print nothing
+        :param progress_callbacks: List of callback(stage, done, total)
+        :param profile_file: The file run writes cProfile stats to, None to not profile
+        """
+        self.quiet = quiet
+        self.progress_callbacks = list(progress_callbacks or [])
+        self.profile_file = profile_file
+        self.timings = dict((stage, 0.0) for stage in self.STAGES)
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+        self._percent_stacks = {}
+
+    def log(self, message):
+        """
+        Prints a message unless quiet
+        :param message: The message
+        """
+        if not self.quiet:
+            print(message)
+
+    def progress(self, stage, done, total):
+        """
+        Reports progress of a stage to the callbacks, or to the console if there are none
+        :param stage: The name of the stage, 'extract', 'maps', 'sheets' or 'tiles'
+        :param done: The amount of work done
+        :param total: The total amount of work
+        """
+        for callback in self.progress_callbacks:
+            callback(stage, done, total)
+        if self.progress_callbacks or self.quiet or stage != 'extract' or total <= 0:
+            return
+
+        percent_stack = self._percent_stacks.setdefault(stage, [])
+        TileExtractor.print_tile_work_percentage(done, total, percent_stack)
+        if done >= total:
+            print('')  # new line after percentage indicator
+            del self._percent_stacks[stage]
+
+    def add_time(self, stage, seconds):
+        """
+        :param stage: The stage, one of STAGES
+        :param seconds: The seconds to add to the stage timer
+        """
+        with self._lock:
+            self.timings[stage] += seconds
+
+    def count(self, name, amount=1):
+        """
+        :param name: The counter name
+        :param amount: The amount to add
+        """
+        with self._lock:
+            self.counters[name] += amount
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Times a block of code, with instrumentation.timer('tmx'): ...
+        :param stage: The stage, one of STAGES
+        """
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.add_time(stage, timeit.default_timer() - start)
+
+    def timed_iter(self, stage, iterable, outer_stage=None):
+        """
+        Times the items of an iterable as they are pulled
+        :param stage: The stage, one of STAGES
+        :param iterable: The iterable to time
+        :param outer_stage: A stage being timed around the consumer, the time is taken off it so it is not counted twice
+        :return: generator of the items
+        """
+        iterator = iter(iterable)
+        seconds = 0.0
+        try:
+            while True:
+                start = timeit.default_timer()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += timeit.default_timer() - start
+                yield item
+        finally:
+            self.add_time(stage, seconds)
+            if outer_stage is not None:
+                self.add_time(outer_stage, -seconds)
+
+    def merge(self, timings, counters):
+        """
+        Adds the timings and counters of another Instrumentation, such as one in a worker process
+        :param timings: dict of stage seconds
+        :param counters: dict of counters
+        """
+        with self._lock:
+            for stage, seconds in timings.items():
+                self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+            self.counters.update(counters)
+
+    def get_metrics(self):
+        """
+        :return: dict of the stage timings, counters, de-duplication hit rate, bytes written and extraction tiles per
+                 second
+        """
+        counters = dict(self.counters)
+        tiles_seen = counters.get('tiles_seen', 0)
+        extract_seconds = self.timings['decode'] + self.timings['slice'] + self.timings['dedup']
+        return {
+            'timings': dict(self.timings),
+            'counters': counters,
+            'dedup_hit_rate': (tiles_seen - counters.get('unique_tiles', 0)) / float(tiles_seen) if tiles_seen else 0.0,
+            'bytes_written': sum(counters.get(name, 0) for name in ('sheet_bytes', 'tile_bytes', 'tmx_bytes')),
+            'extract_tiles_per_second': tiles_seen / extract_seconds if extract_seconds > 0 else 0.0,
+        }
+
+    def write_json(self, file_name, **extra):
+        """
+        Dumps get_metrics to a JSON file
+        :param file_name: The file to write
+        :param extra: Other entries to add to the metrics
+        """
+        metrics = self.get_metrics()
+        metrics.update(extra)
+        with open(file_name, 'w') as metrics_file:
+            json.dump(metrics, metrics_file, indent=2, sort_keys=True)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Calls func, under cProfile if there is a profile_file
+        :param func: The function to call
+        :return: The result of func
+        """
+        if self.profile_file is None:
+            return func(*args, **kwargs)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            profiler.dump_stats(self.profile_file)
+
+
+class TileGridAnalyzer:
+    """
+    Finds the tile size and grid offset of a map, for captures where they are not known.
+    Tiles repeat in a tile map, so the right grid is the one that cuts the map into the fewest unique tiles. Scoring
+    every tile size at every x/y offset costs a tile hash per pixel per size, far more than an extraction, so only a
+    few candidates are scored, and mostly on a sample of the map:
+        1. A few sampled rows are hashed in tile wide segments at every x. Tile rows repeat along with the tiles, so
+           for each tile size the x offsets with the fewest unique segments are where the grid lines fall. The best
+           OFFSET_CANDIDATES x offsets of each size are kept.
+        2. Each kept tile size and x offset is scored like a digest extraction of the sample: a segment per tile
+           column of every sampled row, and every tile_size segments down a column make a tile. Each tile goes into
+           the unique set of its y offset (y % tile_size).
+        3. analyze extracts the whole map with the best offsets of the FINAL_CANDIDATES best tile sizes, as sizes
+           with close scores can swap places in a sample.
+    Candidates are ranked against each other by the bytes of their unique tile pixels plus their map indices, per map
+    pixel, as smaller tile sizes always have fewer unique tiles. Grids with partial tiles at the edges are scored
+    without them, the way the 'crop' edge mode extracts them.
+    The sample is up to SAMPLE_SPANS bands of rows spread down the map, max_rows rows in all, cut into up to
+    SAMPLE_SPANS windows spread across it, max_columns pixels in all. The first pass costs a slice hash per pixel per
+    tile size for FIRST_PASS_ROWS rows, the second a hash per sampled pixel per kept offset, and the unique sets hold
+    up to a hash per sampled pixel per kept offset. Maps where most tiles are unique need a bigger sample.
+    """
+    DEFAULT_TILE_SIZES = (8, 16, 24, 32, 48, 64)
+
+    # The sample detect_tile_grid analyzes by default
+    DEFAULT_MAX_ROWS = 512
+    DEFAULT_MAX_COLUMNS = 2048
+
+    # The most row bands and column windows the sample is cut into
+    SAMPLE_SPANS = 4
+
+    # The most rows the first pass hashes at every x
+    FIRST_PASS_ROWS = 64
+
+    # The x offsets of every tile size the second pass scores
+    OFFSET_CANDIDATES = 2
+
+    # The tile sizes analyze scores over the whole map
+    FINAL_CANDIDATES = 3
+
+    # The bytes a tile index costs in the map, see get_score
+    INDEX_BYTES = 4
+
+    def __init__(self, tile_sizes=DEFAULT_TILE_SIZES, max_rows=None, max_columns=None):
+        """
+        :param tile_sizes: The candidate tile sizes
+        :param max_rows: Only analyze this many rows, in bands spread down the map, None for all of them
+        :param max_columns: Only analyze this many pixels of every row, in windows spread across the map, None for
+                            all of them
+        """
+        self.tile_sizes = sorted(set(tile_sizes))
+        self.max_rows = max_rows
+        self.max_columns = max_columns
+
+    def analyze(self, file_name):
+        """
+        Analyzes the sample, then scores the best candidate of the FINAL_CANDIDATES best tile sizes over the whole
+        map with an extraction each, as tile sizes with close scores can swap places in a sample
+        :param file_name: The map PNG
+        :return: list of candidates best first, see analyze_rows
+        """
+        with open(file_name, 'rb') as png_file:
+            png_reader = png.Reader(file=png_file)
+            pixel_format = TileExtractor.get_pixel_format(png_reader)
+            if pixel_format == 'palette':
+                # Palette indices identify colors as well as the colors do
+                width, height, rows, info = png_reader.read()
+            elif pixel_format == 'rgba':
+                width, height, rows, info = png_reader.asRGBA8()
+            else:
+                width, height, rows, info = png_reader.asRGB8()
+            channels = TileExtractor.PIXEL_FORMATS[pixel_format]
+            candidates = self.analyze_rows(rows, width, height, channels)
+
+        if (self.max_rows is None or height <= self.max_rows) and \
+                (self.max_columns is None or width <= self.max_columns):
+            # The sample was the whole map
+            return candidates
+
+        finalists = []
+        for candidate in candidates:
+            if len(finalists) == self.FINAL_CANDIDATES:
+                break
+            if candidate['tile_size'] not in [finalist['tile_size'] for finalist in finalists]:
+                finalists.append(candidate)
+        for candidate in finalists:
+            extractor = TileExtractor(file_name, candidate['tile_size'], Instrumentation(quiet=True),
+                                      pixel_format=pixel_format, offset_x=candidate['offset_x'],
+                                      offset_y=candidate['offset_y'], edge_mode='crop')
+            candidate['unique_tiles'] = len(extractor.tiles)
+            candidate['num_tiles'] = len(extractor.tile_indices)
+            candidate['score'] = self.get_score(candidate['tile_size'], channels, candidate['unique_tiles'],
+                                                candidate['num_tiles'])
+        finalists.sort(key=self._get_rank)
+        return finalists + [candidate for candidate in candidates if candidate not in finalists]
+
+    def get_score(self, tile_size, channels, unique_tiles, num_tiles):
+        """
+        Tile sizes and offsets cover a little more or less of the sample, so the bytes are relative to the pixels the
+        tiles cover
+        :return: The bytes of the unique tile pixels and the map indices per map pixel, lower is better
+        """
+        pixels = num_tiles * tile_size * tile_size
+        return (unique_tiles * tile_size * tile_size * channels + num_tiles * self.INDEX_BYTES) / float(pixels)
+
+    def get_sample_spans(self, length, max_length):
+        """
+        Spreads the sampled rows or columns over the map
+        :param length: The height or width of the map
+        :param max_length: The most rows or columns to sample, None for all of them
+        :return: list of (start, end) spans, each at least twice the largest tile size unless the map is smaller
+        """
+        if max_length is None or length <= max_length:
+            return [(0, length)]
+        num_spans = max(1, min(self.SAMPLE_SPANS, max_length // (self.tile_sizes[-1] * 2)))
+        span_length = max_length // num_spans
+        if num_spans == 1:
+            return [(0, span_length)]
+        starts = [(length - span_length) * span // (num_spans - 1) for span in range(0, num_spans)]
+        return [(start, start + span_length) for start in starts]
+
+    def analyze_rows(self, rows, width, height, channels):
+        """
+        :param rows: Iterable of image rows, width * channels bytes each
+        :param width: The image width
+        :param height: The image height
+        :param channels: The bytes per pixel
+        :return: list of dicts with the tile_size, offset_x, offset_y, unique_tiles, num_tiles and score of every
+                 scored candidate, best first. The tile counts are those of the sample.
+        """
+        bands = self.get_sample_spans(height, self.max_rows)
+        windows = self.get_sample_spans(width, self.max_columns)
+
+        # The sampled rows of every band, cut into the windows
+        band_rows = [[] for _ in bands]
+        band = 0
+        for y, row in enumerate(rows):
+            while band < len(bands) and y >= bands[band][1]:
+                band += 1
+            if band == len(bands):
+                break
+            if y >= bands[band][0]:
+                row = bytes(row)
+                band_rows[band].append([row[start * channels:end * channels] for start, end in windows])
+
+        band_height = min(end - start for start, end in bands)
+        window_width = min(end - start for start, end in windows)
+        tile_sizes = [tile_size for tile_size in self.tile_sizes
+                      if tile_size <= band_height and tile_size <= window_width]
+
+        sample_rows = [row for rows_of_band in band_rows for row in rows_of_band]
+        first_pass_rows = sample_rows[::max(1, len(sample_rows) // self.FIRST_PASS_ROWS)]
+        candidates = []
+        for tile_size in tile_sizes:
+            for offset_x in self.get_offset_candidates(first_pass_rows, windows, tile_size, channels):
+                candidates.extend(self.score_offset(band_rows, bands, windows, tile_size, offset_x, channels))
+        candidates.sort(key=self._get_rank)
+        return candidates
+
+    @staticmethod
+    def _get_rank(candidate):
+        """
+        :return: The sort key of a candidate, lowest score first, then larger tiles, then the smallest offset
+        """
+        return candidate['score'], -candidate['tile_size'], candidate['offset_x'] + candidate['offset_y']
+
+    def get_offset_candidates(self, rows, windows, tile_size, channels):
+        """
+        The first pass, finds the x offsets of the grid lines of a tile size
+        :param rows: list of sampled rows, each a list of the bytes of every window
+        :param windows: list of (start x, end x) of every window
+        :param tile_size: The tile size
+        :param channels: The bytes per pixel
+        :return: list of the OFFSET_CANDIDATES x offsets with the fewest unique tile wide segments
+        """
+        segment_bytes = tile_size * channels
+        uniques = [set() for _ in range(0, tile_size)]
+        for row in rows:
+            for (start, _), window in zip(windows, row):
+                segments = [hash(window[segment_start:segment_start + segment_bytes])
+                            for segment_start in range(0, len(window) - segment_bytes + 1, channels)]
+                # segments[i] starts at x = start + i
+                for offset_x in range(0, tile_size):
+                    uniques[offset_x].update(segments[(offset_x - start) % tile_size::tile_size])
+        return sorted(range(0, tile_size), key=lambda offset_x: (len(uniques[offset_x]), offset_x))[
+            :self.OFFSET_CANDIDATES]
+
+    def score_offset(self, band_rows, bands, windows, tile_size, offset_x, channels):
+        """
+        The second pass, scores every y offset of a tile size and x offset
+        :param band_rows: list of the sampled rows of every band, each a list of the bytes of every window
+        :param bands: list of (start y, end y) of every band
+        :param windows: list of (start x, end x) of every window
+        :param tile_size: The tile size
+        :param offset_x: The x offset of the grid
+        :param channels: The bytes per pixel
+        :return: list of candidate dicts, see analyze_rows
+        """
+        segment_bytes = tile_size * channels
+        # The byte offsets of the tile columns in every window
+        column_starts = [range(((offset_x - start) % tile_size) * channels,
+                               (end - start) * channels - segment_bytes + 1, segment_bytes) for start, end in windows]
+        uniques = [set() for _ in range(0, tile_size)]
+        num_tiles = [0] * tile_size
+        for (band_start, _), rows in zip(bands, band_rows):
+            segment_rows = collections.deque(maxlen=tile_size)
+            for y, row in enumerate(rows, band_start):
+                segment_rows.append([hash(window[segment_start:segment_start + segment_bytes])
+                                     for starts, window in zip(column_starts, row) for segment_start in starts])
+                if len(segment_rows) < tile_size:
+                    continue
+                # The tiles with their top row at y - tile_size + 1, a tuple of segments down each tile column
+                offset_y = (y - tile_size + 1) % tile_size
+                uniques[offset_y].update(map(hash, zip(*segment_rows)))
+                num_tiles[offset_y] += len(segment_rows[0])
+
+        candidates = []
+        for offset_y, unique in enumerate(uniques):
+            if num_tiles[offset_y]:
+                candidates.append({
+                    'tile_size': tile_size,
+                    'offset_x': offset_x,
+                    'offset_y': offset_y,
+                    'unique_tiles': len(unique),
+                    'num_tiles': num_tiles[offset_y],
+                    'score': self.get_score(tile_size, channels, len(unique), num_tiles[offset_y]),
+                })
+        return candidates
 
 
 class TileExtractor:
     """
     A class with methods to output tile information from a large tile sheet.
-    Tile list looks like this: two tiles, 2x2 pixels:
+    Unique tiles are kept in a TileStore (self.tiles), see TileStore for the layout.
+    get_tile_row_lists returns the old layout, a list of tiles each containing a list of rows of pixels:
     [
         [[R, G, B, R, G, B], [R, G, B, R, G, B]], # tile 1
         [[R, G, B, R, G, B], [R, G, B, R, G, B]]  # tile 2
     ]
-    It is a list of tiles, each containing a list of rows of pixels, with R G B for each pixel.
     """
-    def __init__(self, file_name=None, tile_size=0):
+    # Layer data compressions TMX supports, zstd needs the zstandard module
+    TMX_COMPRESSIONS = ('none', 'zlib', 'gzip', 'zstd')
+
+    # Bytes per pixel of the tile pixel formats. 'auto' picks one from the source PNG, see get_pixel_format.
+    PIXEL_FORMATS = {'rgb': 3, 'rgba': 4, 'palette': 1}
+
+    # What happens to partial tiles at the edges of the grid, see get_grid_window
+    EDGE_MODES = ('strict', 'crop', 'pad')
+
+    def __init__(self, file_name=None, tile_size=0, instrumentation=None, sheet_packer=None, **populate_options):
         """
         An immediate initializer of the tile extractor class
         :param file_name: The name of the PNG to sub-divide into tiles
         :param tile_size: The size of tiles to extract from the PNG
+        :param instrumentation: The Instrumentation to report progress, timings and counters to, and print with.
+                                A new one if None.
+        :param sheet_packer: The SheetPacker laying out tile sheets, the original layout if None
+        :param populate_options: Options passed on to populate_extractor (hasher, workers, memory_budget, ...)
         """
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+        self.instrumentation = instrumentation
+        self.sheet_packer = sheet_packer
         self.tiles = None
         self.tile_indices = None
+        self.dedup_index = None
+        self.pixel_format = 'rgb'
         self.tile_size = tile_size
         self.master_tile_file_name = file_name
         self.tiles_width = 0
         self.tiles_height = 0
+        # Incremental extraction information, see populate_extractor
+        self.changed_bands = 0
+        self.previous_sheets = None
+        self.cache = None
         if file_name is not None and tile_size != 0:
-            self.populate_extractor(file_name, tile_size)
+            self.populate_extractor(file_name, tile_size, **populate_options)
+
+    def get_tile_row_lists(self):
+        """
+        Compatibility accessor for the old tile layout, see class description
+        :return: list of tiles, each a list of rows of ints
+        """
+        if self.tiles is None:
+            return []
+        return [self.tiles.get_tile_row_list(tile_id) for tile_id in range(0, len(self.tiles))]
 
     def has_validate_tiles(self):
         """
@@ -46,7 +1878,7 @@ class TileExtractor:
     @staticmethod
     def print_tile_work_percentage(cur_y, max_y, percent_stack):
         """
-        Prints the percentage for long tile work methods
+        Prints the percentage for long tile work methods, the console progress of Instrumentation
         :param cur_y: The current Y in the tile parsing work
         :param max_y: The max Y in the tile parsing work
         :param percent_stack: A list of percentages already shown
@@ -58,106 +1890,611 @@ class TileExtractor:
             sys.stdout.write(' {0}% '.format(percentage))
             percent_stack.append(percentage)
 
-    def populate_extractor(self, file_name, tile_size):
+    def reset_tiles(self, tile_size, hasher='crc32', memory_budget=None, spill_dir=None, match_flips=False,
+                    max_channel_error=None, max_tile_error=None, pixel_format='rgb', palette=None):
+        """
+        Starts an empty set of unique tiles and its de-duplication index, see populate_extractor for the options
+        :param tile_size: The size of the tiles
+        :param hasher: The tile digest hasher used for de-duplication, see TileDigestIndex.HASHERS
+        :param memory_budget: Bytes of unique tile pixels to keep in memory before spilling to disk, None for no limit
+        :param spill_dir: The directory to spill unique tiles to, the system temp directory if None
+        :param match_flips: True to match tiles in all 8 flipped and rotated orientations
+        :param max_channel_error: Near duplicate matching, the largest difference allowed in any channel value
+        :param max_tile_error: Near duplicate matching, the largest sum of absolute channel differences allowed
+        :param pixel_format: How tile pixels are stored, one of PIXEL_FORMATS
+        :param palette: A fixed list of palette colors for the palette pixel format, None to collect the colors
+        """
+        fuzzy = max_channel_error is not None or max_tile_error is not None
+        if fuzzy and match_flips:
+            raise ValueError('Flip matching and near duplicate matching can not be combined')
+        if pixel_format not in self.PIXEL_FORMATS:
+            raise ValueError('Unknown pixel format {0}, expected one of {1}'.format(pixel_format,
+                                                                                   sorted(self.PIXEL_FORMATS)))
+        if fuzzy and pixel_format == 'palette':
+            raise ValueError('Near duplicate matching needs RGB or RGBA pixels, not palette indices')
+        if palette is not None and pixel_format != 'palette':
+            raise ValueError('A palette needs the palette pixel format')
+
+        tile_palette = None
+        if pixel_format == 'palette':
+            tile_palette = TilePalette(palette, fixed=palette is not None)
+
+        # See TileStore to understand structure layout of tiles
+        self.tiles = TileStore(tile_size, self.PIXEL_FORMATS[pixel_format], memory_budget=memory_budget,
+                               spill_dir=spill_dir, palette=tile_palette)
+        self.pixel_format = pixel_format
+
+        # This is an index list of the used tiles in order so we can export a tile map file to use in tiled.
+        # Note: Indices are 1 based so the +1s are intentional
+        self.tile_indices = array.array(UINT32_TYPECODE)
+
+        # Digest index of the unique tiles, lets us find duplicates without scanning every unique tile
+        if match_flips:
+            self.dedup_index = FlipTileIndex(tile_size, self.tiles.channels, hasher, self.tiles)
+        elif fuzzy:
+            self.dedup_index = FuzzyTileIndex(tile_size, self.tiles.channels, max_channel_error, max_tile_error,
+                                              hasher, self.tiles)
+        else:
+            self.dedup_index = TileDigestIndex(hasher, self.tiles)
+
+        self.tile_size = tile_size
+
+    def populate_extractor(self, file_name, tile_size, hasher='crc32', workers=1, memory_budget=None,
+                           spill_dir=None, match_flips=False, max_channel_error=None, max_tile_error=None,
+                           cache_dir=None, pixel_format='rgb', palette=None, offset_x=0, offset_y=0,
+                           edge_mode='strict'):
         """
         From a large PNG file, sub-divides the bitmap using tile_size as
         a boundary size.
-        Improvements: Slowest part of code is reading from PNG and comparing a tile against all current tiles.
-                      Tile comparisons become exponential.
-                      Tile comparisons could be speed up with tile hashes. Comparisons could also be concurrent.
+        Tiles are de-duplicated through a digest index (see TileDigestIndex) so each tile lookup is O(1).
+        With workers > 1 each band of tiles is de-duplicated locally in a process pool and the bands are merged
+        in order, so the result is identical to a single process run.
+        Rows are streamed from the PNG one band at a time. With a memory_budget the unique tile pixels spill to a
+        memory mapped file, so memory use depends on the band width and the budget rather than the unique tile count.
+        With match_flips, tiles which are flipped or rotated versions of a unique tile reuse it, and the flip is stored
+        in the high bits of the tile index the way Tiled expects (see FlipTileIndex).
+        With max_channel_error and/or max_tile_error, near duplicate tiles reuse the first unique tile within the
+        error (see FuzzyTileIndex). Fuzzy matching can not be combined with match_flips.
+        With a cache_dir, the extraction is cached (see TileCache). A re-run with the same options reuses the cached
+        tile ids and only slices and de-duplicates bands whose pixels changed. If the source file is unchanged it is
+        not decoded at all. changed_bands counts the bands which were processed.
+        pixel_format picks how tile pixels are stored: 'rgb' (the original), 'rgba' which keeps transparency, or
+        'palette' with one byte per pixel, an index into a TilePalette of up to 256 colors. Palette PNGs keep their
+        palette, true color PNGs have their colors collected. Sheets are then written as palette PNGs.
+        offset_x and offset_y place the tile grid for captures with a border, and edge_mode picks what happens to
+        partial tiles at the edges (see get_grid_window). TileGridAnalyzer finds the tile size and offset.
+        Improvements: Slowest part of code is reading from PNG.
                       It is unclear if PNG reads could be speed up with concurrency however...
         :param file_name: The name of the PNG to sub-divide into tiles
         :param tile_size: The size of tiles to extract from the PNG
+        :param hasher: The tile digest hasher used for de-duplication, see TileDigestIndex.HASHERS
+        :param workers: The number of processes used to de-duplicate bands
+        :param memory_budget: Bytes of unique tile pixels to keep in memory before spilling to disk, None for no limit
+        :param spill_dir: The directory to spill unique tiles to, the system temp directory if None
+        :param match_flips: True to match tiles in all 8 flipped and rotated orientations
+        :param max_channel_error: Near duplicate matching, the largest difference allowed in any channel value
+        :param max_tile_error: Near duplicate matching, the largest sum of absolute channel differences allowed
+        :param cache_dir: The folder to keep an incremental extraction cache in, None for no cache
+        :param pixel_format: How tile pixels are stored, one of PIXEL_FORMATS or 'auto'
+        :param palette: A fixed list of palette colors for the palette pixel format, None to collect the colors
+        :param offset_x: The x of the first grid line in the PNG
+        :param offset_y: The y of the first grid line in the PNG
+        :param edge_mode: What happens to partial tiles at the edges, one of EDGE_MODES
         """
-        png_file = open(file_name)
+        self._check_grid_options(offset_x, offset_y, edge_mode)
+
+        png_file = open(file_name, 'rb')
         if not png_file:
-            print('TileExtractor: No file at path {0}!'.format(file_name))
+            self.instrumentation.log('TileExtractor: No file at path {0}!'.format(file_name))
             return
 
         png_reader = png.Reader(file=png_file)
-        image_data = png_reader.asRGB8()
-        size = None
-        iter_map = None
-
-        # search the returned tuple for important information
-        for elm in image_data:
-            if isinstance(elm, itertools.imap):
-                iter_map = elm
-            elif isinstance(elm, dict) and elm.get('size'):
-                size = elm['size']
-
-        if size is None or size[0] % tile_size != 0 or size[1] % tile_size != 0:
-            print('Invalid image size! {0}'.format(size))
+        try:
+            if pixel_format == 'auto':
+                with self.instrumentation.timer('decode'):
+                    pixel_format = self.get_pixel_format(png_reader)
+            self.reset_tiles(tile_size, hasher, memory_budget, spill_dir, match_flips, max_channel_error,
+                             max_tile_error, pixel_format, palette)
+        except ValueError:
+            png_file.close()
+            raise
+
+        with self.instrumentation.timer('decode'):
+            width, height, iter_map = self._read_pixels(png_reader)
+
+        grid_window = self._place_grid(width, height, offset_x, offset_y, edge_mode)
+        if grid_window is None:
+            png_file.close()
             return
+        left, top = grid_window
+
+        cache = None
+        cache_options = {'channels': self.tiles.channels, 'match_flips': match_flips,
+                         'max_channel_error': max_channel_error, 'max_tile_error': max_tile_error,
+                         'pixel_format': self.pixel_format,
+                         'palette': [list(color) for color in palette] if palette is not None else None,
+                         'grid': [left, top, edge_mode]}
+        self.previous_sheets = None
+        self.cache = None
+        if cache_dir is not None:
+            cache = TileCache(cache_dir)
+            self.cache = cache
+            if cache.load(file_name, tile_size, cache_options, self.tiles_width, self.tiles_height):
+                # Cached tiles keep their ids, and palette colors their indices
+                if self.tiles.palette is not None:
+                    for color in cache.get_palette():
+                        self.tiles.palette.get_index(color)
+                for tile in cache.iter_tiles(self.tiles.tile_bytes):
+                    self.dedup_index.add(tile)
+                self.previous_sheets = cache.get_sheets()
+
+                if cache.is_source_unchanged(file_name):
+                    self.instrumentation.log('Source unchanged, using {0} cached tiles'.format(len(self.tiles)))
+                    self.tile_indices = cache.tile_indices
+                    self.changed_bands = 0
+                    png_file.close()
+                    return
+
+        iter_map = self.instrumentation.timed_iter('decode', iter_map)
+        band_digests = self._extract_rows(iter_map, width, height, left, top, workers, cache)
+        # Close the file, we have extracted what we need
+        png_file.close()
 
-        print('Valid image size: {0} for tile size ({1}), extracting unique tiles...'.format(size, tile_size))
+        if cache is not None:
+            self.instrumentation.log('{0} of {1} bands changed since the cached extraction'.format(
+                self.changed_bands, self.tiles_height))
+            cache.save(file_name, cache_options, self, band_digests)
 
-        # See comment at top of page to understand structure layout of tiles
-        self.tiles = []
+    def populate_from_buffer(self, buffer, width, height, tile_size, channels=3, row_stride=None, hasher='crc32',
+                             workers=1, memory_budget=None, spill_dir=None, match_flips=False, max_channel_error=None,
+                             max_tile_error=None, pixel_format='auto', palette=None, offset_x=0, offset_y=0,
+                             edge_mode='strict'):
+        """
+        Like populate_extractor, from pixels already in memory rather than a PNG. buffer can be anything with the
+        buffer protocol: bytes, bytearray, a memoryview, an mmap of a raw pixel file or a C contiguous NumPy uint8
+        array. Rows are sliced as views of the buffer, so tiles are copied straight out of it with no decode and no
+        intermediate copies, as long as the tile pixel format matches the buffer's.
+        :param buffer: The pixels, rows top to bottom
+        :param width: The image width
+        :param height: The image height
+        :param tile_size: The size of tiles to extract
+        :param channels: The bytes per pixel of the buffer: 3 for RGB, 4 for RGBA, 1 for indices into palette
+        :param row_stride: The bytes from the start of one row to the next, None for width * channels
+        :param pixel_format: How tile pixels are stored, one of PIXEL_FORMATS, or 'auto' for the buffer's format
+        :param palette: The palette colors of a 1 channel buffer, or a fixed palette for the palette pixel format
+        See populate_extractor for the other options
+        """
+        self._check_grid_options(offset_x, offset_y, edge_mode)
+        if channels not in (1, 3, 4):
+            raise ValueError('Buffers need 1, 3 or 4 channels, not {0}'.format(channels))
+        if channels == 1 and (palette is None or pixel_format not in ('auto', 'palette')):
+            raise ValueError('1 channel buffers need their palette and the palette pixel format')
+        if pixel_format == 'auto':
+            pixel_format = {1: 'palette', 3: 'rgb', 4: 'rgba'}[channels]
+
+        view = memoryview(buffer)
+        if view.ndim != 1 or view.itemsize != 1:
+            # Such as NumPy arrays of (height, width, channels), the cast fails unless they are C contiguous
+            view = view.cast('B')
+        row_bytes = width * channels
+        if row_stride is None:
+            row_stride = row_bytes
+        if width <= 0 or height <= 0 or row_stride < row_bytes or len(view) < row_stride * (height - 1) + row_bytes:
+            raise ValueError('A buffer of {0} bytes does not hold {1}x{2} pixels of {3} bytes with a row stride of '
+                             '{4}'.format(len(view), width, height, channels, row_stride))
+
+        self.reset_tiles(tile_size, hasher, memory_budget, spill_dir, match_flips, max_channel_error,
+                         max_tile_error, pixel_format, palette)
+        grid_window = self._place_grid(width, height, offset_x, offset_y, edge_mode)
+        if grid_window is None:
+            return
+        left, top = grid_window
+
+        rows = (view[start:start + row_bytes] for start in range(0, row_stride * height, row_stride))
+        if self.tiles.palette is not None and channels == 1:
+            if self.tiles.palette.get_translation(palette) is not None:
+                rows = self.tiles.palette.iter_translated_rows(rows, palette)
+        elif self.tiles.palette is not None:
+            rows = self.tiles.palette.iter_index_rows(rows, channels)
+        elif self.tiles.channels != channels:
+            rows = self._iter_converted_rows(rows, width, channels, self.tiles.channels)
+        self._extract_rows(rows, width, height, left, top, workers)
+
+    @classmethod
+    def from_buffer(cls, buffer, width, height, tile_size, channels=3, instrumentation=None, sheet_packer=None,
+                    **populate_options):
+        """
+        Creates an extractor from pixels in memory, see populate_from_buffer
+        :return: The TileExtractor, results are in tiles and tile_indices, see get_sheet_pngs and get_tmx_bytes
+        """
+        extractor = cls(instrumentation=instrumentation, sheet_packer=sheet_packer)
+        extractor.populate_from_buffer(buffer, width, height, tile_size, channels, **populate_options)
+        return extractor
 
-        # This is an index list of the used tiles in order so we can export a tile map file to use in tiled.
-        # Note: Indices are 1 based so the +1s are intentional
-        self.tile_indices = []
+    @classmethod
+    def from_raw_file(cls, file_name, width, height, tile_size, channels=3, instrumentation=None, sheet_packer=None,
+                      **populate_options):
+        """
+        Creates an extractor from a file of raw pixels, mapped with mmap so tiles are copied straight out of the page
+        cache, see populate_from_buffer
+        :param file_name: The raw RGB or RGBA file, rows top to bottom with no header
+        :return: The TileExtractor
+        """
+        with open(file_name, 'rb') as raw_file:
+            raw_map = mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls.from_buffer(raw_map, width, height, tile_size, channels, instrumentation, sheet_packer,
+                                   **populate_options)
+        finally:
+            try:
+                raw_map.close()
+            except BufferError:
+                # A row view is still alive, the map closes once it is collected
+                pass
 
-        self.tile_size = tile_size
+    @staticmethod
+    def _iter_converted_rows(rows, width, channels, tile_channels):
+        """
+        Converts rows between RGB and RGBA, RGB pixels become opaque
+        :param rows: Iterable of rows with channels bytes per pixel
+        :param width: The row width
+        :param channels: The bytes per pixel of the rows, 3 or 4
+        :param tile_channels: The bytes per pixel to convert to, 4 or 3
+        :return: generator of bytearray rows
+        """
+        for row in rows:
+            row = bytes(row)
+            converted = bytearray(b'\xff' * (width * tile_channels))
+            for channel in range(0, 3):
+                converted[channel::tile_channels] = row[channel::channels]
+            yield converted
 
-        self.tiles_width = int(size[0] / tile_size)
-        self.tiles_height = int(size[1] / tile_size)
+    @staticmethod
+    def _check_grid_options(offset_x, offset_y, edge_mode):
+        """
+        Validates the grid placement options of populate_extractor
+        """
+        if edge_mode not in TileExtractor.EDGE_MODES:
+            raise ValueError('Unknown edge mode {0}, expected one of {1}'.format(edge_mode, TileExtractor.EDGE_MODES))
+        if offset_x < 0 or offset_y < 0:
+            raise ValueError('Grid offsets can not be negative')
 
-        cur_slice_y = 0
-        work_percentage_stack = []
+    def _place_grid(self, width, height, offset_x, offset_y, edge_mode):
+        """
+        Places the tile grid on the image and sets tiles_width and tiles_height, see get_grid_window
+        :return: tuple of (left, top) of the grid, None if the image does not fit it
+        """
+        size = (width, height)
+        grid_window = self.get_grid_window(width, height, self.tile_size, offset_x, offset_y, edge_mode)
+        if grid_window is None:
+            self.instrumentation.log('Invalid image size! {0}'.format(size))
+            return None
+        left, top, self.tiles_width, self.tiles_height = grid_window
+
+        self.instrumentation.log('Valid image size: {0} for tile size ({1}), extracting unique tiles...'.format(
+            size, self.tile_size))
+        if (left, top) != (0, 0) or self.tiles_width * self.tile_size != width or \
+                self.tiles_height * self.tile_size != height:
+            self.instrumentation.log('Tile grid at ({0}, {1}), {2} edges, {3}x{4} tiles'.format(
+                offset_x, offset_y, edge_mode, self.tiles_width, self.tiles_height))
+        return left, top
+
+    def _extract_rows(self, iter_map, width, height, left, top, workers=1, cache=None):
+        """
+        Slices the rows of an image into tiles on the placed grid and de-duplicates them into tile_indices
+        :param iter_map: Iterator of image rows in the pixel format of the tiles
+        :param width: The image width
+        :param height: The image height
+        :param left: The image x of the grid's left edge, see get_grid_window
+        :param top: The image y of the grid's top edge
+        :param workers: The number of processes used to de-duplicate bands
+        :param cache: A loaded TileCache to reuse unchanged bands from, or None
+        :return: list of the band digests for the cache
+        """
+        self.changed_bands = 0
         """
         We populate the tile list like this:
             1) grab tile_size rows in an iterator slice
             2) grab (width / tile_size) tiles in that slice
-            3) compare new tiles vs current tiles and throw away duplicates
+            3) look up new tiles in the digest index and throw away duplicates
             4) grab next slice
         """
-        while cur_slice_y < size[1]:
-            # Initialize tile list
-            new_tiles = [[] for _ in range(0, size[0] / self.tile_size)]
-
-            # We go through each row of pixels grabbing tile_size iterator slices
-            it_slice = itertools.islice(iter_map, 0, self.tile_size)
-
-            # Run through every tile_size * tile_size tile
-            for elm in it_slice:
-                cur_new_tile = 0
-                cur_slice_x = 0
-                while cur_slice_x < size[0]:
-                    # Get the row of pixels [R,G,B, R,G,B, R,G,B]
-                    tile_row = list(elm[cur_slice_x * 3:cur_slice_x * 3 + self.tile_size * 3])
-
-                    # Append the row to one of the new tiles
-                    new_tiles[cur_new_tile].append(tile_row)
-
-                    # Iterate to next section of row
-                    cur_slice_x += self.tile_size
-                    cur_new_tile += 1
-
-            num_new_tiles = 0
-            # Go through new tile list and see if any of the tiles are duplicates.
-            # If there are duplicates, they are not added to the master list of tiles.
-            for new_tile in new_tiles:
-                found_tile = False
-                for master_tile_index in range(0, len(self.tiles)):
-                    if self.compare_tiles(self.tiles[master_tile_index], new_tile):
-                        self.tile_indices.append(master_tile_index + 1)
-                        found_tile = True
-                        break
-
-                if not found_tile:
-                    self.tiles.append(copy.deepcopy(new_tile))
-                    self.tile_indices.append(len(self.tiles))
-                    num_new_tiles += 1
-
-            # print('{0} tiles added for row {1}. Tile count = {2}'.format(num_new_tiles,
-            #                                                            cur_slice_y / self.tile_size, len(self.tiles)))
-            cur_slice_y += self.tile_size
-            self.print_tile_work_percentage(cur_slice_y, size[1], work_percentage_stack)
-        print('')  # new line after percentage indicator
-        # Close the file, we have extracted what we need
-        png_file.close()
+        iter_map = self._iter_grid_rows(iter_map, width, height, left, top)
+        bands = self._iter_bands(iter_map, self.tiles_height, self.tile_size)
+        band_digests = []
+        if cache is not None:
+            bands = self._iter_cached_bands(bands, cache, band_digests)
+        else:
+            bands = ((band_rows, None) for band_rows in bands)
+
+        if workers > 1:
+            band_results = self._dedup_bands_parallel(bands, workers)
+        else:
+            band_results = self._dedup_bands(bands)
+
+        for band, band_indices in enumerate(band_results):
+            self.tile_indices.extend(band_indices)
+            self.instrumentation.progress('extract', band + 1, self.tiles_height)
+        self.instrumentation.count('bands', self.tiles_height)
+        self.instrumentation.count('bands_changed', self.changed_bands)
+        self.instrumentation.count('tiles_seen', len(self.tile_indices))
+        self.log_index_stats()
+        return band_digests
+
+    @staticmethod
+    def get_pixel_format(png_reader):
+        """
+        Picks the pixel format which keeps everything in a PNG
+        :param png_reader: A png.Reader which has not read any rows yet
+        :return: 'palette' for palette PNGs, 'rgba' for PNGs with transparency, else 'rgb'
+        """
+        png_reader.preamble()
+        if png_reader.colormap:
+            return 'palette'
+        if png_reader.alpha or png_reader.trns:
+            return 'rgba'
+        return 'rgb'
+
+    @staticmethod
+    def read_palette(file_name):
+        """
+        Reads the palette of a palette PNG, to use as a fixed palette
+        :param file_name: The palette PNG
+        :return: list of (R, G, B, A) colors
+        """
+        with open(file_name, 'rb') as png_file:
+            png_reader = png.Reader(file=png_file)
+            png_reader.preamble()
+            if not png_reader.colormap:
+                raise ValueError('{0} is not a palette PNG'.format(file_name))
+            return png_reader.palette(alpha='force')
+
+    def _read_pixels(self, png_reader):
+        """
+        Starts reading the rows of a PNG in the pixel format of the tiles
+        :param png_reader: A png.Reader which has not read any rows yet
+        :return: tuple of (width, height, iterator of rows)
+        """
+        if self.tiles.palette is None:
+            if self.tiles.channels == 4:
+                width, height, rows, info = png_reader.asRGBA8()
+            else:
+                width, height, rows, info = png_reader.asRGB8()
+            return width, height, rows
+
+        png_reader.preamble()
+        if png_reader.colormap:
+            width, height, rows, info = png_reader.read()
+            return width, height, self.tiles.palette.iter_translated_rows(rows, info['palette'])
+
+        if png_reader.alpha or png_reader.trns:
+            width, height, rows, info = png_reader.asRGBA8()
+            return width, height, self.tiles.palette.iter_index_rows(rows, 4)
+        width, height, rows, info = png_reader.asRGB8()
+        return width, height, self.tiles.palette.iter_index_rows(rows, 3)
+
+    @staticmethod
+    def get_grid_window(width, height, tile_size, offset_x=0, offset_y=0, edge_mode='strict'):
+        """
+        Places the tile grid on an image. Pixels before the first grid line are always left out, except with 'pad'.
+        'strict': the grid has to end at the right and bottom edges, the original behavior
+        'crop': partial tiles at the right and bottom edges are left out
+        'pad': partial tiles at all edges are padded to full tiles with the fill pixel of the tiles
+        :param width: The image width
+        :param height: The image height
+        :param tile_size: The size of the tiles
+        :param offset_x: The x of the first grid line
+        :param offset_y: The y of the first grid line
+        :param edge_mode: One of EDGE_MODES
+        :return: tuple of (left, top, tiles_width, tiles_height), the image position of the grid's top left corner
+                 which is negative when padded, or None if the image does not fit the grid
+        """
+        if edge_mode == 'pad':
+            left = -(-offset_x % tile_size)
+            top = -(-offset_y % tile_size)
+            tiles_width = -(-(width - left) // tile_size)
+            tiles_height = -(-(height - top) // tile_size)
+        else:
+            left = offset_x
+            top = offset_y
+            tiles_width, width_remainder = divmod(width - left, tile_size)
+            tiles_height, height_remainder = divmod(height - top, tile_size)
+            if edge_mode == 'strict' and (width_remainder != 0 or height_remainder != 0):
+                return None
+        if tiles_width <= 0 or tiles_height <= 0:
+            return None
+        return left, top, tiles_width, tiles_height
+
+    def _iter_grid_rows(self, rows, width, height, left, top):
+        """
+        Moves image rows onto the tile grid, see get_grid_window. Rows past the right and bottom of the grid are
+        not cut, band slicing and reading stop at the grid.
+        :param rows: Iterator of image rows in the pixel format of the tiles
+        :param width: The image width
+        :param height: The image height
+        :param left: The image x of the grid's left edge, negative to pad
+        :param top: The image y of the grid's top edge, negative to pad
+        :return: iterator of grid rows
+        """
+        grid_width = self.tiles_width * self.tile_size
+        grid_height = self.tiles_height * self.tile_size
+        if left == 0 and top == 0 and grid_width <= width and grid_height <= height:
+            return rows
+        return self._iter_padded_rows(rows, width, height, left, top, grid_width, grid_height)
+
+    def _iter_padded_rows(self, rows, width, height, left, top, grid_width, grid_height):
+        """
+        Generator behind _iter_grid_rows for grids which are offset or padded
+        """
+        channels = self.tiles.channels
+        fill_pixel = self.tiles.get_fill_pixel()
+        left_fill = fill_pixel * max(0, -left)
+        right_fill = fill_pixel * max(0, left + grid_width - width)
+        row_start = max(0, left) * channels
+        row_end = min(width, left + grid_width) * channels
+        fill_row = fill_pixel * grid_width
+        if top > 0:
+            rows = itertools.islice(rows, top, None)
+        for y in range(top, top + grid_height):
+            if y < 0 or y >= height:
+                yield fill_row
+            elif left_fill or right_fill:
+                yield left_fill + bytes(memoryview(next(rows))[row_start:row_end]) + right_fill
+            else:
+                yield memoryview(next(rows))[row_start:row_end]
+
+    def log_index_stats(self):
+        """
+        Prints the de-duplication index counters, and records them as instrumentation counters
+        """
+        stats = self.dedup_index.get_stats()
+        for name in ('unique_tiles', 'lookups', 'digest_hits', 'collisions', 'flip_hits', 'fuzzy_hits'):
+            if name in stats:
+                self.instrumentation.counters[name] = stats[name]
+        self.instrumentation.log('{0} unique tiles from {1} lookups, {2} digest hits, {3} digest collisions'.format(
+            stats['unique_tiles'], stats['lookups'], stats['digest_hits'], stats['collisions']))
+        if 'flip_hits' in stats:
+            self.instrumentation.log('{0} tiles matched a flipped or rotated unique tile'.format(stats['flip_hits']))
+        if 'fuzzy_hits' in stats:
+            self.instrumentation.log('{0} near duplicate tiles merged, max channel error {1}, max tile error {2}'.format(
+                stats['fuzzy_hits'], stats['max_channel_error_accepted'], stats['max_tile_error_accepted']))
+
+    def _iter_cached_bands(self, bands, cache, band_digests):
+        """
+        Pairs bands with their cached tile indices
+        :param bands: Iterable of bands of rows
+        :param cache: The loaded TileCache
+        :param band_digests: list the digest of every band is appended to
+        :return: generator of (band rows, cached tile indices or None if the band changed)
+        """
+        for band, band_rows in enumerate(bands):
+            band_digest = cache.get_band_digest(band_rows)
+            band_digests.append(band_digest)
+            yield band_rows, cache.get_band_indices(band, band_digest)
+
+    @staticmethod
+    def _iter_bands(iter_map, num_bands, tile_size):
+        """
+        Groups image rows into bands of tile_size rows
+        :param iter_map: Iterator of image rows, [R,G,B, R,G,B, R,G,B]
+        :param num_bands: The number of bands to read
+        :param tile_size: The number of rows in a band
+        :return: generator of lists of row memoryviews, rows are viewed rather than copied
+        """
+        for _ in range(0, num_bands):
+            yield [memoryview(elm) for elm in itertools.islice(iter_map, 0, tile_size)]
+
+    @staticmethod
+    def slice_band_tiles(band_rows, tiles_width, row_bytes):
+        """
+        Joins the rows of every tile_size * tile_size tile in a band
+        :param band_rows: The tile_size rows of the band
+        :param tiles_width: The number of tiles across the band
+        :param row_bytes: The number of bytes in one row of a tile
+        :return: generator of tile bytes, left to right
+        """
+        for tile_start in range(0, tiles_width * row_bytes, row_bytes):
+            yield b''.join([row[tile_start:tile_start + row_bytes] for row in band_rows])
+
+    def _dedup_bands(self, bands):
+        """
+        De-duplicates bands in this process. If there are duplicates, they are not added to the master list of tiles.
+        :param bands: Iterable of (band rows, cached tile indices or None)
+        :return: generator of the 1 based tile indices of each band
+        """
+        for band_rows, cached_indices in bands:
+            if cached_indices is not None:
+                yield cached_indices
+                continue
+
+            self.changed_bands += 1
+            with self.instrumentation.timer('slice'):
+                band_tiles = list(self.slice_band_tiles(band_rows, self.tiles_width, self.tiles.row_bytes))
+            with self.instrumentation.timer('dedup'):
+                band_indices = [self.dedup_index.lookup_gid(new_tile) for new_tile in band_tiles]
+            yield band_indices
+
+    def _dedup_bands_parallel(self, bands, workers):
+        """
+        De-duplicates bands in a process pool. Each band is de-duplicated locally by a worker and the local unique
+        tiles are merged into the master list in band order, which keeps the first occurrence order of a single
+        process run.
+        :param bands: Iterable of (band rows, cached tile indices or None)
+        :param workers: The number of worker processes
+        :return: generator of the 1 based tile indices of each band
+        """
+        pool = multiprocessing.Pool(workers)
+        # Only keep a few bands in flight so the decoded image is never queued up in memory
+        max_pending = workers * 2
+        # Pending bands look like this: (cached tile indices, None) or (None, worker result)
+        pending = collections.deque()
+        try:
+            for band_rows, cached_indices in bands:
+                if cached_indices is not None:
+                    pending.append((cached_indices, None))
+                else:
+                    self.changed_bands += 1
+                    with self.instrumentation.timer('slice'):
+                        band = b''.join(band_rows)
+                    pending.append((None, pool.apply_async(_dedup_band, (band, self.tiles_width, self.tile_size,
+                                                                         self.tiles.channels))))
+                if len(pending) >= max_pending:
+                    yield self._finish_band(*pending.popleft())
+
+            while pending:
+                yield self._finish_band(*pending.popleft())
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _finish_band(self, cached_indices, worker_result):
+        """
+        :param cached_indices: The cached tile indices of an unchanged band, or None
+        :param worker_result: The worker result of a changed band, or None
+        :return: The 1 based master tile indices of the band
+        """
+        if cached_indices is not None:
+            return cached_indices
+        with self.instrumentation.timer('dedup'):
+            return self._merge_band(*worker_result.get())
+
+    def _merge_band(self, band_tiles, band_indices):
+        """
+        Merges a locally de-duplicated band into the master list of tiles
+        :param band_tiles: The bytes of the band's unique tiles in first occurrence order
+        :param band_indices: The 0 based local tile id of every tile in the band
+        :return: The 1 based master tile indices of the band
+        """
+        local_tiles = TileStore(self.tile_size, self.tiles.channels, band_tiles)
+        local_to_master = [self.dedup_index.lookup_gid(tile) for tile in local_tiles]
+        return [local_to_master[local_id] for local_id in band_indices]
+
+    def merge_tiles(self, tiles, tile_ids):
+        """
+        Merges tiles de-duplicated elsewhere, such as another map in a shared tile set, into the unique tiles
+        :param tiles: The bytes of the unique tiles in first occurrence order
+        :param tile_ids: The 0 based id into tiles of every tile of the map
+        :return: array of the 1 based master tile indices of the map
+        """
+        return array.array(UINT32_TYPECODE, self._merge_band(tiles, tile_ids))
+
+    def get_map_extractor(self, tile_indices, tiles_width, tiles_height):
+        """
+        Builds an extractor for one map of a shared tile set, it shares the unique tiles of this extractor
+        :param tile_indices: The 1 based master tile indices of the map, see merge_tiles
+        :param tiles_width: The width of the map in tiles
+        :param tiles_height: The height of the map in tiles
+        :return: The TileExtractor of the map
+        """
+        map_extractor = TileExtractor(instrumentation=self.instrumentation, sheet_packer=self.sheet_packer)
+        map_extractor.tiles = self.tiles
+        map_extractor.pixel_format = self.pixel_format
+        map_extractor.dedup_index = self.dedup_index
+        map_extractor.tile_size = self.tile_size
+        map_extractor.tile_indices = tile_indices
+        map_extractor.tiles_width = tiles_width
+        map_extractor.tiles_height = tiles_height
+        return map_extractor
 
     @staticmethod
     def compare_tiles(tile_row_list1, tile_row_list2):
@@ -175,98 +2512,226 @@ class TileExtractor:
         return True
 
     @staticmethod
-    def output_tile_to_file(tile, tile_size, out_folder, group_name, file_index):
+    def output_tile_to_file(tile, tile_size, out_folder, group_name, file_index, png_encoder=None):
         """
-        Outputs a tile row list to a PNG
-        :param tile: The tile list to output
+        Outputs a tile to a PNG
+        :param tile: The tile bytes to output, rows one after the other (a TileStore tile view)
         :param tile_size: The length of the tile
         :param out_folder: The output folder to put the file
         :param group_name: The prefix for the file
         :param file_index: The postfix for the file
+        :param png_encoder: A tile_size PngEncoder to reuse, a default one is created if None
+        :return: tuple of (file name, encode seconds, bytes written)
         """
+        start_time = timeit.default_timer()
         out_filename = '{0}{1}{2}_{3}.png'.format(out_folder, os.sep, group_name, file_index)
-        tile_png = open(out_filename, 'wb')     # binary mode is important
+        if png_encoder is None:
+            png_encoder = PngEncoder(tile_size, tile_size)
 
-        png_writer = png.Writer(tile_size, tile_size)
-        png_writer.write(tile_png, tile)
+        row_bytes = len(tile) // tile_size
+        with open(out_filename, 'wb') as tile_png:     # binary mode is important
+            bytes_written = png_encoder.write(tile_png, [tile[row * row_bytes:(row + 1) * row_bytes]
+                                                         for row in range(0, tile_size)])
+        return out_filename, timeit.default_timer() - start_time, bytes_written
 
     @staticmethod
-    def output_tiles_to_sheet(tiles, square_width, out_folder, group_name, file_index):
+    def output_tiles_to_sheet(tiles, square_width, out_folder, group_name, file_index, compression='default',
+                              strategy=None, instrumentation=None, sheet_height=None, sheet_packer=None):
         """
         Exports a tile map containing tiles in the tiles list.
-        :param tiles: The tiles to output to the sheet
+        :param tiles: The TileStore (or TileStore slice) of tiles to output to the sheet
         :param square_width: The width of the texture to output, which will also be the height. Should be pow 2.
         :param out_folder: The output folder to put the tile maps.
         :param group_name: The prefix of the out file
         :param file_index: The postfix index
+        :param compression: A PngEncoder preset name or zlib level
+        :param strategy: A PngEncoder strategy name, None for the preset strategy
+        :param instrumentation: The Instrumentation to add the compose and encode times to, or None
+        :param sheet_height: The height of a rectangular sheet, None for square
+        :param sheet_packer: The SheetPacker which laid the sheet out, None for the original layout
+        :return: tuple of (file name, encode seconds, bytes written)
         """
+        start_time = timeit.default_timer()
         out_filename = '{0}{1}{2}_{3}.png'.format(out_folder, os.sep, group_name, file_index)
-        tile_png = open(out_filename, 'wb')     # binary mode is important
+        with open(out_filename, 'wb') as tile_png:     # binary mode is important
+            bytes_written = TileExtractor.write_sheet(tile_png, tiles, square_width, compression, strategy,
+                                                      instrumentation, sheet_height, sheet_packer)
+        seconds = timeit.default_timer() - start_time
+        if instrumentation is not None:
+            instrumentation.add_time('encode', seconds)
+        return out_filename, seconds, bytes_written
 
-        png_writer = png.Writer(square_width, square_width)
+    @staticmethod
+    def write_sheet(out_file, tiles, square_width, compression='default', strategy=None, instrumentation=None,
+                    sheet_height=None, sheet_packer=None):
+        """
+        Encodes a tile sheet PNG to a binary file object, see output_tiles_to_sheet for the parameters
+        :param out_file: The binary file object to write to
+        :return: The number of bytes written
+        """
+        if sheet_height is None:
+            sheet_height = square_width
+        # A palette may gain its fill color here, it has to be in the palette before the encoder writes it
+        tiles.get_fill_pixel()
+        png_encoder = PngEncoder(square_width, sheet_height, tiles.channels, compression, strategy, tiles.palette)
+        if sheet_packer is not None:
+            rows = sheet_packer.iter_sheet_rows(tiles, square_width, sheet_height)
+        else:
+            rows = TileExtractor.iter_sheet_rows(tiles, square_width)
+        if instrumentation is not None:
+            rows = instrumentation.timed_iter('compose', rows, outer_stage='encode')
+        return png_encoder.write(out_file, rows)
+
+    def get_sheet_pngs(self, compression='default', strategy=None):
+        """
+        Encodes the tile sheets in memory, the sheets output_tiles_to_sheets would write
+        :param compression: A PngEncoder preset name ('fast', 'default', 'max') or zlib level
+        :param strategy: A PngEncoder strategy name, None for the preset strategy
+        :return: list of the PNG bytes of every sheet, in the order of get_sheet_layout
+        """
+        if not self.has_validate_tiles():
+            return []
+        sheet_packer = self.get_sheet_packer()
+        sheet_pngs = []
+        for sheet in self.get_sheet_layout():
+            sheet_width, sheet_height, first_tile, num_tiles = sheet[:4]
+            sheet_png = io.BytesIO()
+            with self.instrumentation.timer('encode'):
+                self.write_sheet(sheet_png, self.tiles[first_tile:first_tile + num_tiles], sheet_width, compression,
+                                 strategy, None, sheet_height, sheet_packer)
+            sheet_pngs.append(sheet_png.getvalue())
+        return sheet_pngs
 
+    @staticmethod
+    def iter_sheet_rows(tiles, square_width):
+        """
+        Builds the rows of a tile sheet one row of tiles at a time, so a whole sheet is never held in memory.
+        Each row of tiles is composed with a single join over the tile buffer which transposes the
+        (tile, row) layout of the store into the (row, tile) layout of the sheet.
+        :param tiles: The TileStore (or TileStore slice) of tiles to output to the sheet
+        :param square_width: The width of the sheet, which will also be the height
+        :return: generator of sheet rows, [R,G,B, R,G,B, ...]
+        """
         # Get some information about the tiles we are injecting into the large sheet
         num_tiles = len(tiles)
-        num_tile_rows = len(tiles[0])
-        num_tiles_per_row = square_width / num_tile_rows
-
-        # build rows
-        output_rows = []
-        for cur_row in range(0, square_width):
-            row_out = []
-            # row_debug = []
-
-            for cur_tile_index in range(0, num_tiles_per_row):
-                cur_tile_row = int(cur_row / num_tile_rows)
-                tile_index = cur_tile_index + cur_tile_row * num_tiles_per_row
-                if tile_index < num_tiles:
-                    tile_row_index = cur_row % num_tile_rows
-                    # row_debug.append((tile_index, tile_row_index))
-                    row_out.extend(tiles[tile_index][tile_row_index])
-                else:
-                    # row_debug = list(itertools.repeat((99, 99), 8))
-                    # create a row of white
-                    row_out.extend(list(itertools.repeat(255, num_tile_rows * 3)))
+        num_tile_rows = tiles.tile_size
+        num_tiles_per_row = square_width // num_tile_rows
+        row_bytes = tiles.row_bytes
+        sheet_row_bytes = num_tiles_per_row * row_bytes
+        tile_views = list(tiles)
+
+        # create a tile of the fill color (white for RGB) for the space after the last tile
+        white_tile = memoryview(tiles.get_fill_pixel() * (num_tile_rows * num_tile_rows))
+
+        for first_tile_index in range(0, num_tiles_per_row * num_tiles_per_row, num_tiles_per_row):
+            band_tiles = [tile_views[tile_index] if tile_index < num_tiles else white_tile
+                          for tile_index in range(first_tile_index, first_tile_index + num_tiles_per_row)]
+            band = memoryview(b''.join([tile[tile_row * row_bytes:(tile_row + 1) * row_bytes]
+                                        for tile_row in range(0, num_tile_rows) for tile in band_tiles]))
+            for tile_row in range(0, num_tile_rows):
+                yield band[tile_row * sheet_row_bytes:(tile_row + 1) * sheet_row_bytes]
+
+    def get_sheet_packer(self):
+        """
+        :return: The SheetPacker laying out the tile sheets
+        """
+        if self.sheet_packer is None or self.sheet_packer.tile_size != self.tile_size:
+            self.sheet_packer = SheetPacker(self.tile_size)
+        return self.sheet_packer
 
-            # print row_debug
-            output_rows.append(row_out)
+    def get_sheet_layout(self):
+        """
+        Lays the unique tiles out on sheets, see SheetPacker.get_layout
+        :return: list of [width, height, first tile id, number of tiles, columns, margin, spacing] for every sheet
+        """
+        return self.get_sheet_packer().get_layout(len(self.tiles))
 
-        png_writer.write(tile_png, output_rows)
+    def get_sheet_occupancy(self):
+        """
+        :return: list of (tile slots used, pixels used) shares of every sheet, see SheetPacker.get_occupancy
+        """
+        sheet_packer = self.get_sheet_packer()
+        return [sheet_packer.get_occupancy(sheet) for sheet in self.get_sheet_layout()]
 
-    def output_tiles_to_sheets(self, out_folder, group_name):
+    def output_tiles_to_sheets(self, out_folder, group_name, workers=1, compression='default', strategy=None,
+                               skip_unchanged=False):
         """
         Outputs the tiles created by the extractor.
+        Sheets are independent so with workers > 1 they are encoded in a thread pool, zlib releases the GIL.
         :param out_folder: The output folder to extract the sheet to
         :param group_name: The prefix name of the output file
+        :param workers: The number of sheets to encode at once
+        :param compression: A PngEncoder preset name ('fast', 'default', 'max') or zlib level
+        :param strategy: A PngEncoder strategy name, None for the preset strategy
+        :param skip_unchanged: True to skip sheets which already exist with the same tiles as the cached extraction.
+                               Cached tile ids never change, so a sheet with the same layout has the same pixels.
+        :return: list of (file name, encode seconds, bytes written) for every sheet written
         """
         if not self.has_validate_tiles():
-            print('Unable to extract tiles, no tile information!')
+            self.instrumentation.log('Unable to extract tiles, no tile information!')
             return
 
         self._check_output_dir(out_folder)
 
-        # Now we need to create tile sheets with these unique tiles. Determine how many sheets we will need.
-        sheet_info = self.get_tile_sheet_specs(len(self.tiles), self.tile_size)
-
-        cur_out_tile = 0
-        file_index = 0
-        for square_width in sheet_info:
-            num_tiles_in_sheet = int(math.pow(square_width / self.tile_size, 2))
-            num_tiles_on_sheet = num_tiles_in_sheet
-            num_tiles_left = len(self.tiles) - cur_out_tile
-
-            if num_tiles_in_sheet > num_tiles_left:
-                num_tiles_on_sheet = num_tiles_left
+        sheet_packer = self.get_sheet_packer()
+        # Settle the fill color before sheets are encoded in parallel
+        self.tiles.get_fill_pixel()
+        previous_sheets = self.previous_sheets if skip_unchanged and self.previous_sheets is not None else []
+        sheet_jobs = []
+        for file_index, sheet in enumerate(self.get_sheet_layout()):
+            sheet_width, sheet_height, cur_out_tile, num_tiles_on_sheet = sheet[:4]
+            out_filename = '{0}{1}{2}_{3}.png'.format(out_folder, os.sep, group_name, file_index)
+            if file_index < len(previous_sheets) and previous_sheets[file_index] == sheet and \
+                    os.path.exists(out_filename):
+                continue
 
             tiles_out = self.tiles[cur_out_tile:cur_out_tile + num_tiles_on_sheet]
 
-            out_msg = 'Creating ({0} x {0}) tile sheet containing {1} tiles. {2}% of sheet used...'
-            print(out_msg.format(square_width, len(tiles_out), int((len(tiles_out) / float(num_tiles_in_sheet)) * 100)))
+            tile_occupancy, pixel_occupancy = sheet_packer.get_occupancy(sheet)
+            out_msg = 'Creating ({0} x {1}) tile sheet containing {2} tiles. {3}% of sheet used, {4}% of pixels...'
+            self.instrumentation.log(out_msg.format(sheet_width, sheet_height, len(tiles_out),
+                                                    int(tile_occupancy * 100), int(pixel_occupancy * 100)))
+
+            sheet_jobs.append((tiles_out, sheet_width, out_folder, group_name, file_index, compression, strategy,
+                               self.instrumentation, sheet_height, sheet_packer))
 
-            self.output_tiles_to_sheet(tiles_out, square_width, out_folder, group_name, file_index)
+        reports = self._run_output_jobs(self.output_tiles_to_sheet, sheet_jobs, workers,
+                                        lambda done, total: self.instrumentation.progress('sheets', done, total))
+        for out_filename, encode_seconds, bytes_written in reports:
+            self.instrumentation.log('Wrote {0}: {1} bytes in {2:.3f}s'.format(out_filename, bytes_written,
+                                                                               encode_seconds))
+        self.instrumentation.count('sheets_written', len(reports))
+        self.instrumentation.count('sheet_bytes', sum(report[2] for report in reports))
+        return reports
 
-            cur_out_tile += num_tiles_on_sheet
-            file_index += 1
+    @staticmethod
+    def _run_output_jobs(output_func, jobs, workers, progress=None):
+        """
+        Runs output jobs, in a thread pool if there is more than one worker
+        :param output_func: The function to call with each job's arguments
+        :param jobs: List of argument tuples
+        :param workers: The number of jobs to run at once
+        :param progress: Called as progress(done, total) after each job, or None
+        :return: list of the job results in job order
+        """
+        pool = None
+        if workers <= 1 or len(jobs) <= 1:
+            results = (output_func(*job) for job in jobs)
+        else:
+            pool = ThreadPool(min(workers, len(jobs)))
+            results = pool.imap(lambda job: output_func(*job), jobs)
+
+        try:
+            reports = []
+            for report in results:
+                reports.append(report)
+                if progress is not None:
+                    progress(len(reports), len(jobs))
+            return reports
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
     @staticmethod
     def get_tile_sheet_specs(num_tiles, tile_size, min_sheet_width=64, max_sheet_width=512):
@@ -277,181 +2742,476 @@ class TileExtractor:
         :param max_sheet_width: The max allowed sheet size, keep it Pow 2 or else!
         :return: list of square texture sheet widths
         """
-        # Build sheet table
-        # Table looks like : [(width, tiles), (width, tiles)] highest to lowest
-        tiles_table = []
-        cur_sheet_width = max_sheet_width
-        while cur_sheet_width >= min_sheet_width:
-            tiles_table.append((cur_sheet_width, int(math.pow(cur_sheet_width / tile_size, 2))))
-            cur_sheet_width >>= 1
-
-        output = []
-        num_tiles_left = num_tiles
-        while num_tiles_left > 0:
-            if num_tiles_left > tiles_table[0][1]:
-                chosen_sheet_size = tiles_table[0]
-            else:
-                # Search for a suitable table. Default to lowest table.
-                chosen_sheet_size = tiles_table[len(tiles_table) - 1]
-                for tile_table in tiles_table:
-                    if tile_table[1] >= num_tiles_left:
-                        chosen_sheet_size = tile_table
-
-            num_tiles_left -= chosen_sheet_size[1]
-            output.append(chosen_sheet_size[0])
-
-        return output
+        # Tiles that do not divide the sheet evenly only fit whole columns, see SheetPacker. SheetPacker raises
+        # ValueError if no tile fits the largest sheet.
+        sheet_packer = SheetPacker(tile_size, max_sheet_width, min_sheet_width)
+        return [sheet[0] for sheet in sheet_packer.get_layout(num_tiles)]
 
-    def output_single_tiles_to_folder(self, out_folder, group_name):
+    def output_single_tiles_to_folder(self, out_folder, group_name, workers=1, compression='default', strategy=None):
         """
-        Extracts all tiles to a folder, one PNG per tile
+        Extracts all tiles to a folder, one PNG per tile, named {group_name}_tile_{tile id}.png so they never
+        overwrite the {group_name}_{index}.png sheets in the same folder
         :param out_folder: The folder to output to
         :param group_name: The prefix of the output PNG files
+        :param workers: The number of tiles to encode at once
+        :param compression: A PngEncoder preset name ('fast', 'default', 'max') or zlib level
+        :param strategy: A PngEncoder strategy name, None for the preset strategy
+        :return: list of (file name, encode seconds, bytes written) for every tile
         """
         if not self.has_validate_tiles():
-            print('Unable to extract tiles, no tile information!')
+            self.instrumentation.log('Unable to extract tiles, no tile information!')
             return
 
         self._check_output_dir(out_folder)
 
-        print('Writing {0} unique tiles to output directory {1}...'.format(len(self.tiles), out_folder))
-        # Write tiles out to the output directory
-        file_index = 0
-        for tile in self.tiles:
-            self.output_tile_to_file(tile, self.tile_size, out_folder, group_name, file_index)
-            file_index += 1
+        self.instrumentation.log('Writing {0} unique tiles to output directory {1}...'.format(len(self.tiles),
+                                                                                             out_folder))
+        # Write tiles out to the output directory, every tile is the same size so one encoder does them all
+        png_encoder = PngEncoder(self.tile_size, self.tile_size, self.tiles.channels, compression, strategy,
+                                 self.tiles.palette)
+        tile_jobs = [(tile, self.tile_size, out_folder, group_name + '_tile', file_index, png_encoder)
+                     for file_index, tile in enumerate(self.tiles)]
+
+        reports = self._run_output_jobs(self.output_tile_to_file, tile_jobs, workers,
+                                        lambda done, total: self.instrumentation.progress('tiles', done, total))
+        total_seconds = sum(report[1] for report in reports)
+        total_bytes = sum(report[2] for report in reports)
+        self.instrumentation.add_time('encode', total_seconds)
+        self.instrumentation.count('tiles_written', len(reports))
+        self.instrumentation.count('tile_bytes', total_bytes)
+        self.instrumentation.log('Wrote {0} tiles: {1} bytes, {2:.3f}s encoding, largest tile {3} bytes'.format(
+            len(reports), total_bytes, total_seconds, max(report[2] for report in reports)))
+        return reports
 
     @staticmethod
-    def get_tile_indices(tmx_file):
+    def iter_tmx_layers(tmx_file):
+        """
+        Reads the tile layers of a tmx file one at a time. The file is parsed incrementally and every layer is
+        decoded and released as soon as its data element ends, so memory use is bounded by the largest layer.
+        :param tmx_file: the tmx file to read. Layer data needs to be XML, csv or base64, with any of TMX_COMPRESSIONS.
+        Chunked layers of infinite maps are assembled into one rectangle, see decode_layer_chunks.
+        :return: generator of (layer name, layer width, layer height, array of indices)
+        """
+        layer_attributes = None
+        # The open elements, layers may be nested in groups
+        parents = []
+        for event, elem in ElementTree.iterparse(tmx_file, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == 'layer':
+                    layer_attributes = dict(elem.attrib)
+                parents.append(elem)
+                continue
+
+            parents.pop()
+            if elem.tag == 'data' and layer_attributes is not None:
+                width = int(layer_attributes.get('width', 0))
+                height = int(layer_attributes.get('height', 0))
+                if elem.find('chunk') is not None:
+                    width, height, layer_indices = TileExtractor.decode_layer_chunks(elem, width, height)
+                else:
+                    layer_indices = TileExtractor.decode_layer_data(elem)
+                yield layer_attributes.get('name', ''), width, height, layer_indices
+                # Release the layer text
+                elem.clear()
+            elif elem.tag == 'layer':
+                layer_attributes = None
+                # Drop the finished layer from its map or group so the parsed tree never grows
+                if parents:
+                    parents[-1].remove(elem)
+
+    @staticmethod
+    def decode_layer_data(data):
+        """
+        Decodes a TMX data element
+        :param data: The data element
+        :return: array of indices
+        """
+        # No compression attribute means uncompressed
+        return TileExtractor._decode_layer_element(data, data.get('encoding'), data.get('compression', 'none'))
+
+    @staticmethod
+    def decode_layer_chunks(data, width=0, height=0):
+        """
+        Decodes the chunks of a TMX data element of an infinite map into one rectangle. The rectangle starts at
+        tile (0, 0), or further up and left if chunks do, and covers the layer size and every chunk.
+        :param data: The data element
+        :param width: The layer width
+        :param height: The layer height
+        :return: tuple of (width, height, array of indices)
+        """
+        encode_type = data.get('encoding')
+        compress_type = data.get('compression', 'none')
+        chunks = [(int(chunk.get('x', 0)), int(chunk.get('y', 0)), int(chunk.get('width', 0)),
+                   int(chunk.get('height', 0)), TileExtractor._decode_layer_element(chunk, encode_type, compress_type))
+                  for chunk in data.iter('chunk')]
+        left = min([0] + [chunk[0] for chunk in chunks])
+        top = min([0] + [chunk[1] for chunk in chunks])
+        width = max([width + left] + [chunk[0] + chunk[2] for chunk in chunks]) - left
+        height = max([height + top] + [chunk[1] + chunk[3] for chunk in chunks]) - top
+
+        layer_indices = array.array(UINT32_TYPECODE, bytes(width * height * 4))
+        for chunk_x, chunk_y, chunk_width, chunk_height, chunk_indices in chunks:
+            for row in range(0, chunk_height):
+                start = (chunk_y - top + row) * width + chunk_x - left
+                layer_indices[start:start + chunk_width] = chunk_indices[row * chunk_width:(row + 1) * chunk_width]
+        return width, height, layer_indices
+
+    @staticmethod
+    def _decode_layer_element(element, encode_type, compress_type):
+        """
+        Decodes a TMX data or chunk element
+        :param element: The data or chunk element
+        :param encode_type: The data encoding, csv or base64, None for XML tile elements
+        :param compress_type: One of TMX_COMPRESSIONS
+        :return: array of indices
+        """
+        if encode_type is None:
+            # A tile element per gid, a tile without a gid is empty
+            return array.array(UINT32_TYPECODE, [int(tile.get('gid', 0)) for tile in element.iter('tile')])
+
+        text = (element.text or '').strip()
+        if encode_type == 'csv':
+            return array.array(UINT32_TYPECODE, [int(tile_id) for tile_id in text.split(',') if tile_id.strip()])
+
+        if (encode_type != 'base64') or (compress_type not in TileExtractor.TMX_COMPRESSIONS):
+            raise ValueError('Unsupported TMX layer data, encoding {0} with compression {1}'.format(encode_type,
+                                                                                                  compress_type))
+
+        # Data is in Base64, decode to byte array
+        data_compressed = base64.b64decode(text.encode('ascii', 'ignore'))
+
+        # Now we have a byte string with unsigned ints every 4 bytes.
+        return TileExtractor.unpack_tile_indices(TileExtractor.decompress_layer_data(data_compressed, compress_type))
+
+    @staticmethod
+    def get_tile_indices(tmx_file, decode_flips=False):
         """
         Gets a list of tile indices
-        :param tmx_file: the tmx file to read the indices from. Needs to be base64 with gzip compression.
-        :return: the list of indices
-        """
-        xml_doc = minidom.parse(tmx_file)
-        index_list = []
-
-        layers = xml_doc.getElementsByTagName('layer')
-        for layer in layers:
-            data = layer.getElementsByTagName('data')
-            encode_type = data[0].attributes['encoding'].value
-            compress_type = data[0].attributes['compression'].value
-            if (encode_type != u'base64') or (compress_type != u'gzip'):
-                print('ERROR: Unsupported tiled format')
-                quit()
-
-            # Data is in Base64, decode to byte array
-            data_base64 = data[0].firstChild.nodeValue.strip().encode('ascii', 'ignore')
-            data_compressed = data_base64.decode('base64')
-
-            # Decompress gzip. Zlib can do this. wbits is the window buffer for gzip, compression log
-            decompressed_data = zlib.decompress(data_compressed, 16 + zlib.MAX_WBITS)
-
-            # Now we have a byte string with unsigned ints every 4 bytes.
-            num_ints = len(decompressed_data) / 4
-            for i in range(0, num_ints):
-                int_data = decompressed_data[i * 4:i * 4 + 4]
-                # unpack to little endian, unsigned long
-                tile_id = struct.unpack("<L", int_data)[0]
-                index_list.append(tile_id)
+        :param tmx_file: the tmx file to read the indices from. Needs to be XML, csv or base64, with any of
+                         TMX_COMPRESSIONS.
+        :param decode_flips: True to split the flip flags out of every index, see decode_gid
+        :return: array of the indices of every layer, one after the other.
+                 With decode_flips a list of (tile index, flipped horizontally, flipped vertically, flipped diagonally)
+        """
+        index_list = array.array(UINT32_TYPECODE)
+        for _, _, _, layer_indices in TileExtractor.iter_tmx_layers(tmx_file):
+            index_list.extend(layer_indices)
 
+        if decode_flips:
+            return [TileExtractor.decode_gid(gid) for gid in index_list]
         return index_list
 
-    def get_base_64_index_string(self):
+    @staticmethod
+    def decode_gid(gid):
+        """
+        Splits a Tiled gid into the tile index and its flip flags
+        :param gid: The gid, flip flags in the high bits
+        :return: tuple of (tile index, flipped horizontally, flipped vertically, flipped diagonally)
+        """
+        return (gid & ~FLIP_FLAGS, bool(gid & FLIPPED_HORIZONTALLY), bool(gid & FLIPPED_VERTICALLY),
+                bool(gid & FLIPPED_DIAGONALLY))
+
+    @staticmethod
+    def pack_tile_indices(tile_indices):
+        """
+        Packs tile indices as 4 byte, little endian unsigned ints in one go
+        :param tile_indices: A sequence of tile indices
+        :return: the packed bytes
+        """
+        packed = array.array(UINT32_TYPECODE, tile_indices)
+        if sys.byteorder != 'little':
+            packed.byteswap()
+        return packed.tobytes()
+
+    @staticmethod
+    def unpack_tile_indices(packed_indices):
+        """
+        Unpacks 4 byte, little endian unsigned ints in one go
+        :param packed_indices: The packed bytes
+        :return: array of tile indices
+        """
+        tile_indices = array.array(UINT32_TYPECODE)
+        tile_indices.frombytes(packed_indices)
+        if sys.byteorder != 'little':
+            tile_indices.byteswap()
+        return tile_indices
+
+    @staticmethod
+    def _create_layer_compressor(compression):
+        """
+        Creates a streaming compressor for layer data
+        :param compression: One of TMX_COMPRESSIONS
+        :return: an object with compress and flush methods, None for no compression
+        """
+        if compression == 'none':
+            return None
+        elif compression == 'zlib':
+            return zlib.compressobj()
+        elif compression == 'gzip':
+            # wbits is the window buffer for gzip, compression log
+            return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif compression == 'zstd':
+            if zstandard is None:
+                raise ValueError('zstd layer compression needs the zstandard module')
+            return zstandard.ZstdCompressor().compressobj()
+        raise ValueError('Unknown layer compression {0}, expected one of {1}'.format(
+            compression, TileExtractor.TMX_COMPRESSIONS))
+
+    @staticmethod
+    def compress_layer_data(data, compression):
+        """
+        Compresses packed layer data the way a TMX data element describes it
+        :param data: The packed bytes
+        :param compression: One of TMX_COMPRESSIONS
+        :return: the compressed bytes
+        """
+        compressor = TileExtractor._create_layer_compressor(compression)
+        if compressor is None:
+            return data
+        return compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def decompress_layer_data(data, compression):
+        """
+        Decompresses TMX layer data
+        :param data: The compressed bytes
+        :param compression: One of TMX_COMPRESSIONS
+        :return: the packed bytes
+        """
+        if compression == 'none':
+            return data
+        elif compression == 'zlib':
+            return zlib.decompress(data)
+        elif compression == 'gzip':
+            # Zlib can do this. wbits is the window buffer for gzip, compression log
+            return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        elif compression == 'zstd':
+            if zstandard is None:
+                raise ValueError('zstd layer compression needs the zstandard module')
+            # Streamed frames carry no content size, which the one shot decompress needs
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        raise ValueError('Unknown layer compression {0}, expected one of {1}'.format(
+            compression, TileExtractor.TMX_COMPRESSIONS))
+
+    @staticmethod
+    def iter_layer_data(tile_indices, compression, chunk_size=1 << 16):
+        """
+        Packs and compresses tile indices a chunk at a time
+        :param tile_indices: A sequence of tile indices
+        :param compression: One of TMX_COMPRESSIONS
+        :param chunk_size: The number of indices packed at a time
+        :return: generator of compressed bytes
+        """
+        compressor = TileExtractor._create_layer_compressor(compression)
+        for start in range(0, len(tile_indices), chunk_size):
+            data = TileExtractor.pack_tile_indices(tile_indices[start:start + chunk_size])
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                yield data
+
+        if compressor is not None:
+            data = compressor.flush()
+            if data:
+                yield data
+
+    @staticmethod
+    def iter_base_64(chunks):
+        """
+        Base 64 encodes a stream of bytes without joining it first
+        :param chunks: Iterable of bytes
+        :return: generator of base 64 strings, which joined are the encoding of the joined chunks
+        """
+        remainder = b''
+        for chunk in chunks:
+            data = remainder + chunk
+            # Only whole 3 byte groups can be encoded without padding
+            cut = len(data) - len(data) % 3
+            if cut:
+                yield base64.b64encode(data[:cut]).decode('ascii')
+            remainder = data[cut:]
+
+        if remainder:
+            yield base64.b64encode(remainder).decode('ascii')
+
+    def get_base_64_index_string(self, compression='none'):
         """
         Returns a Base 64 index string of the input png tile map indices.
         Note: Indices are packed as 4 byte, little endian longs
+        :param compression: One of TMX_COMPRESSIONS, applied before the base 64 encode
         :return: the base 64 index string
         """
-        packed_indices = ''
-        for tile_index in self.tile_indices:
-            packed_indices += struct.pack("<L", tile_index)
+        return ''.join(self.iter_base_64(self.iter_layer_data(self.tile_indices, compression)))
 
-        return packed_indices.encode('base64')
+    @staticmethod
+    def _xml_tag(name, attributes, close=False):
+        """
+        Builds an XML start tag
+        :param name: The tag name
+        :param attributes: List of (name, value) pairs, written in order
+        :param close: True for an empty element tag
+        :return: the tag string
+        """
+        attribute_str = ''.join(' {0}={1}'.format(key, quoteattr(str(value))) for key, value in attributes)
+        return '<{0}{1}{2}>'.format(name, attribute_str, '/' if close else '')
 
-    def output_tmx_for_tiles(self, out_folder, group_name):
+    def output_tmx_for_tiles(self, out_folder, group_name, compression='gzip', tileset_name=None, chunk_size=None):
         """
-        Outputs a tmx file
+        Outputs a tmx file.
+        The file is streamed: the header and tile sets are written first and the layer data is packed, compressed
+        and base 64 encoded a chunk at a time straight into the file.
+        With a chunk_size the map is written as a Tiled infinite map, with the layer cut into chunks which editors
+        and runtimes load lazily. Chunks of only empty tiles are left out.
         :param out_folder: The output folder for the tmx file
         :param group_name: The name of the tmx file to output, and the tile sheet names
+        :param compression: The layer data compression, one of TMX_COMPRESSIONS
+        :param tileset_name: The name of the tile sheets if they are not named after group_name (a shared tile set)
+        :param chunk_size: The number of tiles across and down a chunk of an infinite map, None for a finite map
         """
+        if tileset_name is None:
+            tileset_name = group_name
+
         if not self.has_validate_tiles():
-            print('Unable to extract tiles, no tile information!')
+            self.instrumentation.log('Unable to extract tiles, no tile information!')
             return
 
         self._check_output_dir(out_folder)
 
-        # Create the initial document
-        doc = minidom.Document()
+        # Fail on an unknown or unavailable compression before anything is written
+        self._create_layer_compressor(compression)
+
+        out_file = os.path.join(out_folder, group_name) + '.tmx'
+        self.instrumentation.log('Creating TMX XML of Base 64 {0} indices describing input png to {1}...'.format(
+            compression, out_file))
+
+        # Written next to the TMX and moved over it once complete, so a failed write never leaves a partial TMX
+        temp_file = out_file + '.tmp'
+        try:
+            with self.instrumentation.timer('tmx'), open(temp_file, 'wb') as tmx_out_file:
+                self.write_tmx(tmx_out_file, group_name, compression, tileset_name, chunk_size)
+                self.instrumentation.count('tmx_bytes', tmx_out_file.tell())
+            os.replace(temp_file, out_file)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    def get_tmx_bytes(self, group_name, compression='gzip', tileset_name=None, chunk_size=None):
+        """
+        Builds the TMX file in memory, see output_tmx_for_tiles for the parameters
+        :return: The TMX file bytes
+        """
+        if tileset_name is None:
+            tileset_name = group_name
+        tmx_out_file = io.BytesIO()
+        with self.instrumentation.timer('tmx'):
+            self.write_tmx(tmx_out_file, group_name, compression, tileset_name, chunk_size)
+        return tmx_out_file.getvalue()
+
+    def write_tmx(self, tmx_out_file, group_name, compression, tileset_name, chunk_size=None):
+        """
+        Writes the TMX XML to a binary file object, see output_tmx_for_tiles for the parameters
+        :param tmx_out_file: The binary file object to write to
+        """
+        self._create_layer_compressor(compression)
+
+        # Four space tabbed output, utf-8 to file
+        def write_line(depth, line):
+            tmx_out_file.write(('    ' * depth + line + '\n').encode('utf-8'))
+
+        write_line(0, '<?xml version="1.0" encoding="utf-8"?>')
 
         # Create map object
-        world = doc.createElement('map')
-        world.setAttribute('version', '1.0')
-        world.setAttribute('orientation', 'orthogonal')
-        world.setAttribute('renderorder', 'right-down')
-        world.setAttribute('width', str(self.tiles_width))
-        world.setAttribute('height', str(self.tiles_height))
-        world.setAttribute('tilewidth', str(self.tile_size))
-        world.setAttribute('tileheight', str(self.tile_size))
-        world.setAttribute('nextobjectid', '1')
-        doc.appendChild(world)
-
-        # Now we need to create tile sheets with these unique tiles. Determine how many sheets we will need.
-        sheet_info = self.get_tile_sheet_specs(len(self.tiles), self.tile_size)
-
-        file_index = 0
-        cur_first_tile_index = 0
-        for square_width in sheet_info:
-            num_tiles_in_sheet = int(math.pow(square_width / self.tile_size, 2))
+        write_line(0, self._xml_tag('map', [
+            ('version', '1.0'),
+            ('orientation', 'orthogonal'),
+            ('renderorder', 'right-down'),
+            ('width', self.tiles_width),
+            ('height', self.tiles_height),
+            ('tilewidth', self.tile_size),
+            ('tileheight', self.tile_size),
+            ('infinite', 1 if chunk_size else 0),
+            ('nextobjectid', 1)]))
+        if chunk_size:
+            write_line(1, '<editorsettings>')
+            write_line(2, self._xml_tag('chunksize', [('width', chunk_size), ('height', chunk_size)], close=True))
+            write_line(1, '</editorsettings>')
+
+        # Now we need to create tile sheets with these unique tiles. Tile sets only count the tiles on their sheet,
+        # so the gids of the sheets follow on from each other with no gaps.
+        for file_index, sheet in enumerate(self.get_sheet_layout()):
+            sheet_width, sheet_height, first_tile, num_tiles, columns, margin, spacing = sheet
 
             # Create a tile set description, describes the tile set sizes
-            tile_set = doc.createElement('tileset')
-            tile_set.setAttribute('firstgid', str(cur_first_tile_index + 1))  # 1 based indices
-            tile_set.setAttribute('name', group_name + '_' + str(file_index))
-            tile_set.setAttribute('tilewidth', str(self.tile_size))
-            tile_set.setAttribute('tileheight', str(self.tile_size))
-            world.appendChild(tile_set)
+            tileset_attributes = [
+                ('firstgid', first_tile + 1),  # 1 based indices
+                ('name', tileset_name + '_' + str(file_index)),
+                ('tilewidth', self.tile_size),
+                ('tileheight', self.tile_size)]
+            if spacing:
+                tileset_attributes.append(('spacing', spacing))
+            if margin:
+                tileset_attributes.append(('margin', margin))
+            tileset_attributes.extend([('tilecount', num_tiles), ('columns', columns)])
+            write_line(1, self._xml_tag('tileset', tileset_attributes))
 
             # Create the image information
-            image = doc.createElement('image')
-            image.setAttribute('source', group_name + '_' + str(file_index) + '.png')
-            image.setAttribute('width', str(square_width))
-            image.setAttribute('height', str(square_width))
-            tile_set.appendChild(image)
-
-            file_index += 1
-            cur_first_tile_index += num_tiles_in_sheet
+            write_line(2, self._xml_tag('image', [
+                ('source', tileset_name + '_' + str(file_index) + '.png'),
+                ('width', sheet_width),
+                ('height', sheet_height)], close=True))
+            write_line(1, '</tileset>')
 
         # Create a layer. TMX can have a number of layers which make up the map.
-        layer = doc.createElement('layer')
-        layer.setAttribute('name', group_name)
-        layer.setAttribute('width', str(self.tiles_width))
-        layer.setAttribute('height', str(self.tiles_height))
-        world.appendChild(layer)
+        write_line(1, self._xml_tag('layer', [
+            ('name', group_name),
+            ('width', self.tiles_width),
+            ('height', self.tiles_height)]))
 
         # Create the data. The data describes how the tiles are laid.
-        data = doc.createElement('data')
-        data.setAttribute('encoding', 'base64')
-        # data.setAttribute('compression', 'zlib')
-        base_64_str = self.get_base_64_index_string()
-        # print base_64_str
-        # compressed_data = zlib.compress(base_64_str, 9)
-        # out_test = open('out_compressed.txt', 'wb')
-        # out_test.write(compressed_data)
-        # out_test.close()
-        map_layout = doc.createTextNode(base_64_str)
-        data.appendChild(map_layout)
-        layer.appendChild(data)
-
-        # Four space tabbed pretty print output
-        xml_out = doc.toprettyxml(indent="    ", encoding="utf-8")
-
-        # Output utf-8 string to file
-        out_file = os.path.join(out_folder, group_name) + '.tmx'
-        print('Creating TMX XML of Base 64 Gzip indices describing input png to {0}...'.format(out_file))
-        tmx_out_file = open(out_file, 'wb')
-        tmx_out_file.write(xml_out)
-        tmx_out_file.close()
+        data_attributes = [('encoding', 'base64')]
+        if compression != 'none':
+            data_attributes.append(('compression', compression))
+        if chunk_size:
+            write_line(2, self._xml_tag('data', data_attributes))
+            for chunk_x, chunk_y, columns, rows, gids in TileIndexFile.iter_chunks(
+                    self.tile_indices, self.tiles_width, self.tiles_height, chunk_size, chunk_size):
+                if not any(gids):
+                    continue
+                tmx_out_file.write(('    ' * 3 + self._xml_tag('chunk', [
+                    ('x', chunk_x), ('y', chunk_y), ('width', columns), ('height', rows)])).encode('utf-8'))
+                tmx_out_file.write(base64.b64encode(self.compress_layer_data(
+                    self.pack_tile_indices(gids), compression)))
+                tmx_out_file.write(b'</chunk>\n')
+            write_line(2, '</data>')
+        else:
+            tmx_out_file.write(('    ' * 2 + self._xml_tag('data', data_attributes)).encode('utf-8'))
+            for base_64_str in self.iter_base_64(self.iter_layer_data(self.tile_indices, compression)):
+                tmx_out_file.write(base_64_str.encode('ascii'))
+            tmx_out_file.write(b'</data>\n')
+
+        write_line(1, '</layer>')
+        write_line(0, '</map>')
+
+    def output_index_file(self, out_folder, group_name, chunk_size=16):
+        """
+        Outputs the tile indices as a chunked index file, for random access lookups, see TileIndexFile
+        :param out_folder: The output folder for the index file
+        :param group_name: The name of the index file to output
+        :param chunk_size: The number of tiles across and down a chunk
+        """
+        if not self.has_validate_tiles():
+            self.instrumentation.log('Unable to extract tiles, no tile information!')
+            return
+
+        self._check_output_dir(out_folder)
+
+        out_file = os.path.join(out_folder, group_name) + '.tidx'
+        self.instrumentation.log('Creating chunked tile index of {0}x{0} tile chunks to {1}...'.format(
+            chunk_size, out_file))
+        with self.instrumentation.timer('index'):
+            index_bytes = TileIndexFile.write(out_file, self.tile_indices, self.tiles_width, self.tiles_height,
+                                              chunk_size, chunk_size, self.tile_size)
+        self.instrumentation.count('index_bytes', index_bytes)
 
     @staticmethod
     def _check_output_dir(out_folder):
@@ -463,28 +3223,484 @@ class TileExtractor:
             os.makedirs(out_folder)
 
 
-def create_unique_tile_sheet_from_file(file_path, tile_size):
+def _dedup_band(band, tiles_width, tile_size, channels):
+    """
+    Process pool worker, de-duplicates the tiles of one band locally
+    :param band: The bytes of the tile_size rows of the band
+    :param tiles_width: The number of tiles across the band
+    :param tile_size: The size of the tiles
+    :param channels: The number of bytes per pixel
+    :return: tuple of (bytes of the band's unique tiles in first occurrence order, 0 based local id of every tile)
+    """
+    local_tiles = TileStore(tile_size, channels)
+    local_index = TileDigestIndex(tiles=local_tiles)
+    band_view = memoryview(band)
+    stride = tiles_width * local_tiles.row_bytes
+    band_rows = [band_view[row * stride:(row + 1) * stride] for row in range(0, tile_size)]
+    band_indices = [local_index.find_or_add(new_tile)[0]
+                    for new_tile in TileExtractor.slice_band_tiles(band_rows, tiles_width, local_tiles.row_bytes)]
+    return bytes(local_tiles.buffer), band_indices
+
+
+# Outputs written by the command line tool: tile sheets, one PNG per unique tile and the TMX map
+OUTPUT_MODES = ('sheets', 'tiles', 'tmx', 'index')
+
+
+def _extract_map(job):
+    """
+    Process pool worker, extracts the unique tiles of one map of a shared tile set
+    :param job: tuple of (map file path, tile size, pixel format, fixed palette or None, (grid offset x, y), edge mode)
+    :return: tuple of (map file path, tiles width, tiles height, bytes of the map's unique tiles in first occurrence
+             order, 0 based local id of every tile, palette colors of the tiles or None, stage timings, counters),
+             the tiles are None if the map could not be extracted
+    """
+    file_path, tile_size, pixel_format, palette, offset, edge_mode = job
+    instrumentation = Instrumentation(quiet=True)
+    try:
+        extractor = TileExtractor(file_path, tile_size, instrumentation, pixel_format=pixel_format, palette=palette,
+                                  offset_x=offset[0], offset_y=offset[1], edge_mode=edge_mode)
+    except ValueError as error:
+        # Too many colors for a palette
+        return file_path, 0, 0, None, str(error), None, instrumentation.timings, {}
+    map_counters = dict((name, instrumentation.counters[name]) for name in ('bands', 'bands_changed', 'tiles_seen'))
+    if not extractor.has_validate_tiles():
+        return file_path, 0, 0, None, 'no tiles extracted', None, instrumentation.timings, map_counters
+    map_tiles = bytes(extractor.tiles.view())
+    map_ids = [tile_index - 1 for tile_index in extractor.tile_indices]
+    map_palette = extractor.tiles.palette.colors if extractor.tiles.palette is not None else None
+    extractor.tiles.close()
+    return (file_path, extractor.tiles_width, extractor.tiles_height, map_tiles, map_ids, map_palette,
+            instrumentation.timings, map_counters)
+
+
+def create_unique_tile_sheet_from_file(file_path, tile_size, workers=1, memory_budget=None, compression='default',
+                                       incremental=False, out_folder=None, outputs=('sheets', 'tmx'),
+                                       tmx_compression='gzip', instrumentation=None, sheet_packer=None,
+                                       tmx_chunk_size=None, index_chunk_size=16, **populate_options):
     """
     Output a unique tile sheet to a local folder named after the file path
     :param file_path: The path to the large PNG to split up
     :param tile_size: The size of the tiles to extract
+    :param workers: The number of processes used to de-duplicate tiles, and threads used to encode sheets
+    :param memory_budget: Bytes of unique tile pixels to keep in memory before spilling next to the output,
+                          None for no limit
+    :param compression: A PngEncoder preset name ('fast', 'default', 'max') or zlib level for the sheets
+    :param incremental: True to keep an extraction cache in the output folder and only redo what changed since the
+                        last run, see TileCache
+    :param out_folder: The folder to output to, None for a folder named after the file next to it
+    :param outputs: The outputs to write, see OUTPUT_MODES
+    :param tmx_compression: The TMX layer data compression, see TileExtractor.TMX_COMPRESSIONS
+    :param instrumentation: The Instrumentation to report to, a new one if None
+    :param sheet_packer: The SheetPacker laying out the sheets, the original layout if None
+    :param tmx_chunk_size: The chunk size of an infinite TMX map, None for a finite map
+    :param index_chunk_size: The chunk size of the index file, see TileIndexFile
+    :param populate_options: Other options passed on to populate_extractor (hasher, match_flips, ...)
+    :return: The TileExtractor
     """
-    extractor = TileExtractor(file_path, tile_size)
-
     # extract the base path and the file name
-    file_path, file_name = os.path.split(file_path)
+    base_path, file_name = os.path.split(file_path)
 
     # we will use the name of the file to name a folder
     group_name = os.path.splitext(file_name)[0]
 
     # Create output directory path
-    out_folder = os.path.join(file_path, group_name)
+    if out_folder is None:
+        out_folder = os.path.join(base_path, group_name)
+
+    spill_dir = None
+    if memory_budget is not None:
+        TileExtractor._check_output_dir(out_folder)
+        spill_dir = out_folder
+
+    cache_dir = None
+    if incremental:
+        # The cache is keyed by source file and tile size
+        cache_dir = os.path.join(out_folder, '.tile_cache', '{0}_{1}'.format(file_name, tile_size))
+
+    extractor = TileExtractor(file_path, tile_size, instrumentation, sheet_packer, workers=workers,
+                              memory_budget=memory_budget, spill_dir=spill_dir, cache_dir=cache_dir, **populate_options)
+
+    sheet_reports = None
+    if 'sheets' in outputs:
+        sheet_reports = extractor.output_tiles_to_sheets(out_folder, group_name, workers, compression,
+                                                         skip_unchanged=incremental)
+    if 'tiles' in outputs:
+        extractor.output_single_tiles_to_folder(out_folder, group_name, workers, compression)
+    written_outputs = {}
+    if 'tmx' in outputs:
+        # The TMX describes the sheet layout as well as the tile indices, it is stale if either changed
+        tmx_options = {'compression': tmx_compression, 'chunk_size': tmx_chunk_size,
+                       'sheets': extractor.get_sheet_layout()}
+        if extractor.cache is None or extractor.changed_bands or sheet_reports or \
+                extractor.cache.get_output_options('tmx') != tmx_options or \
+                not os.path.exists(os.path.join(out_folder, group_name) + '.tmx'):
+            extractor.output_tmx_for_tiles(out_folder, group_name, tmx_compression, chunk_size=tmx_chunk_size)
+            written_outputs['tmx'] = tmx_options
+    if 'index' in outputs:
+        extractor.output_index_file(out_folder, group_name, index_chunk_size)
+    if extractor.cache is not None and extractor.has_validate_tiles():
+        extractor.cache.save_outputs(extractor.get_sheet_layout() if 'sheets' in outputs else None, written_outputs)
+
+    extractor.instrumentation.log('Done!')
+    return extractor
+
+
+def create_shared_tile_sheet_from_files(file_paths, tile_size, out_folder, tileset_name, workers=1,
+                                        memory_budget=None, compression='default', outputs=('sheets', 'tmx'),
+                                        tmx_compression='gzip', instrumentation=None, sheet_packer=None,
+                                        offsets=None, edge_mode='strict', tmx_chunk_size=None, index_chunk_size=16,
+                                        **index_options):
+    """
+    Output one unique tile sheet shared by many maps, and one TMX per map using it.
+    Each map is extracted on its own in a process pool which is kept for all the maps, then merged in order into one
+    index of unique tiles, so the result is identical to a single process run. Flip and near duplicate matching
+    happen during the merge.
+    :param file_paths: The paths of the map PNGs
+    :param tile_size: The size of the tiles to extract
+    :param out_folder: The folder to output to
+    :param tileset_name: The name of the shared tile sheets
+    :param workers: The number of processes used to extract maps, and threads used to encode sheets
+    :param memory_budget: Bytes of unique tile pixels to keep in memory before spilling next to the output,
+                          None for no limit
+    :param compression: A PngEncoder preset name ('fast', 'default', 'max') or zlib level for the sheets
+    :param outputs: The outputs to write, see OUTPUT_MODES
+    :param tmx_compression: The TMX layer data compression, see TileExtractor.TMX_COMPRESSIONS
+    :param instrumentation: The Instrumentation to report to, a new one if None. Worker timings and counters are
+                            added to it.
+    :param sheet_packer: The SheetPacker laying out the sheets, the original layout if None
+    :param offsets: dict of map file path to its (x, y) grid offset, see populate_extractor. None or missing maps
+                    for (0, 0).
+    :param edge_mode: What happens to partial tiles at the map edges, see TileExtractor.EDGE_MODES
+    :param tmx_chunk_size: The chunk size of infinite TMX maps, None for finite maps
+    :param index_chunk_size: The chunk size of the index files, see TileIndexFile
+    :param index_options: Options passed on to reset_tiles (hasher, match_flips, max_channel_error, max_tile_error,
+                          pixel_format, palette). An 'auto' pixel_format is picked from the first map.
+    :return: tuple of (the shared TileExtractor, list of (group name, map TileExtractor))
+    """
+    spill_dir = None
+    if memory_budget is not None:
+        TileExtractor._check_output_dir(out_folder)
+        spill_dir = out_folder
+
+    shared = TileExtractor(instrumentation=instrumentation, sheet_packer=sheet_packer)
+    instrumentation = shared.instrumentation
+    if index_options.get('pixel_format') == 'auto' and file_paths:
+        with open(file_paths[0], 'rb') as png_file:
+            index_options['pixel_format'] = TileExtractor.get_pixel_format(png.Reader(file=png_file))
+    shared.reset_tiles(tile_size, memory_budget=memory_budget, spill_dir=spill_dir, **index_options)
+
+    if offsets is None:
+        offsets = {}
+    jobs = [(file_path, tile_size, shared.pixel_format, index_options.get('palette'),
+             offsets.get(file_path, (0, 0)), edge_mode) for file_path in file_paths]
+    pool = None
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(workers)
+        map_results = pool.imap(_extract_map, jobs)
+    else:
+        map_results = (_extract_map(job) for job in jobs)
+
+    maps = []
+    try:
+        for file_path, tiles_width, tiles_height, map_tiles, map_ids, map_palette, timings, counters in map_results:
+            instrumentation.merge(timings, counters)
+            if map_tiles is None:
+                instrumentation.log('Skipping {0}, {1}'.format(file_path, map_ids))
+                continue
+            group_name = os.path.splitext(os.path.basename(file_path))[0]
+            if map_palette is not None:
+                # Every map collected its own palette, move its tiles over to the shared one
+                try:
+                    translation = shared.tiles.palette.get_translation(map_palette)
+                except ValueError as error:
+                    instrumentation.log('Skipping {0}, {1}'.format(file_path, error))
+                    continue
+                if translation is not None:
+                    map_tiles = map_tiles.translate(translation)
+            with instrumentation.timer('dedup'):
+                tile_indices = shared.merge_tiles(map_tiles, map_ids)
+            maps.append((group_name, shared.get_map_extractor(tile_indices, tiles_width, tiles_height)))
+            instrumentation.count('maps')
+            instrumentation.progress('maps', len(maps), len(jobs))
+            instrumentation.log('Merged {0}, {1} shared unique tiles'.format(file_path, len(shared.tiles)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    shared.log_index_stats()
+    if not maps:
+        instrumentation.log('No maps extracted!')
+        return shared, maps
+
+    # Sheets and single tiles are checked against the tile indices of the first map
+    shared.tile_indices = maps[0][1].tile_indices
+    if 'sheets' in outputs:
+        shared.output_tiles_to_sheets(out_folder, tileset_name, workers, compression)
+    if 'tiles' in outputs:
+        shared.output_single_tiles_to_folder(out_folder, tileset_name, workers, compression)
+    for group_name, map_extractor in maps:
+        if 'tmx' in outputs:
+            map_extractor.output_tmx_for_tiles(out_folder, group_name, tmx_compression, tileset_name, tmx_chunk_size)
+        if 'index' in outputs:
+            map_extractor.output_index_file(out_folder, group_name, index_chunk_size)
+
+    instrumentation.log('Done!')
+    return shared, maps
+
+
+def _expand_inputs(inputs):
+    """
+    Expands glob patterns in the input paths, paths are kept in order and only listed once
+    :param inputs: The input paths and glob patterns
+    :return: list of paths
+    """
+    file_paths = []
+    for pattern in inputs:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        for file_path in matches:
+            if file_path not in file_paths:
+                file_paths.append(file_path)
+    return file_paths
 
-    extractor.output_tiles_to_sheets(out_folder, group_name)
-    extractor.output_tmx_for_tiles(out_folder, group_name)
 
-    print('Done!')
+def _tile_size_arg(value):
+    """
+    argparse type of the tile size option
+    :param value: A tile size or 'auto'
+    :return: The tile size int or 'auto'
+    """
+    if value == 'auto':
+        return value
+    try:
+        tile_size = int(value)
+    except ValueError:
+        tile_size = 0
+    if tile_size <= 0:
+        raise argparse.ArgumentTypeError('expected a positive tile size or auto, not {0}'.format(value))
+    return tile_size
+
+
+def detect_tile_grid(file_path, tile_sizes=TileGridAnalyzer.DEFAULT_TILE_SIZES, instrumentation=None,
+                     max_rows=TileGridAnalyzer.DEFAULT_MAX_ROWS, max_columns=TileGridAnalyzer.DEFAULT_MAX_COLUMNS):
+    """
+    Finds the tile size and grid offset of a map with a TileGridAnalyzer
+    :param file_path: The path of the map PNG
+    :param tile_sizes: The candidate tile sizes
+    :param instrumentation: The Instrumentation to time the 'detect' stage and log with, a new one if None
+    :param max_rows: Only analyze this many rows, None for all of them. See TileGridAnalyzer for the cost.
+    :param max_columns: Only analyze this many pixels of every row, None for all of them
+    :return: list of candidates best first, see TileGridAnalyzer.analyze_rows
+    """
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    with instrumentation.timer('detect'):
+        candidates = TileGridAnalyzer(tile_sizes, max_rows, max_columns).analyze(file_path)
+    if candidates:
+        best = candidates[0]
+        instrumentation.log('Detected tile size {0} at offset ({1}, {2}) in {3}, {4} unique of {5} tiles'.format(
+            best['tile_size'], best['offset_x'], best['offset_y'], file_path, best['unique_tiles'],
+            best['num_tiles']))
+    else:
+        instrumentation.log('No tile grid detected in {0}'.format(file_path))
+    return candidates
+
+
+def main(argv=None):
+    """
+    Command line entry point, run with --help for the options
+    :param argv: The arguments, sys.argv[1:] if None
+    :return: The exit code
+    """
+    parser = argparse.ArgumentParser(
+        description='Extracts the unique tiles of tile maps into tile sheets and Tiled TMX maps.')
+    parser.add_argument('inputs', nargs='+', help='map PNGs or glob patterns')
+    parser.add_argument('-t', '--tile-size', type=_tile_size_arg, default=32,
+                        help='the size of the tiles, or auto to detect the tile size and grid offset (default 32)')
+    parser.add_argument('--tile-sizes', type=int, nargs='+', default=list(TileGridAnalyzer.DEFAULT_TILE_SIZES),
+                        help='the tile sizes auto detection tries (default {0})'.format(
+                            ' '.join(str(size) for size in TileGridAnalyzer.DEFAULT_TILE_SIZES)))
+    parser.add_argument('--detect', action='store_true',
+                        help='only print the best tile sizes and grid offsets of each map')
+    parser.add_argument('--detect-rows', type=int, default=TileGridAnalyzer.DEFAULT_MAX_ROWS,
+                        help='the rows auto detection samples, spread down the map, 0 for all (default {0})'.format(
+                            TileGridAnalyzer.DEFAULT_MAX_ROWS))
+    parser.add_argument('--detect-columns', type=int, default=TileGridAnalyzer.DEFAULT_MAX_COLUMNS,
+                        help='the pixels of every row auto detection samples, spread across the map, 0 for all '
+                             '(default {0})'.format(TileGridAnalyzer.DEFAULT_MAX_COLUMNS))
+    parser.add_argument('--offset', type=int, nargs=2, metavar=('X', 'Y'),
+                        help='the position of the first grid line, detected with -t auto (default 0 0)')
+    parser.add_argument('--edges', choices=TileExtractor.EDGE_MODES,
+                        help='partial tiles at the edges are an error (strict), left out (crop) or padded (pad), '
+                             '(default strict, crop with -t auto)')
+    parser.add_argument('-o', '--output-dir',
+                        help='the folder to output to, by default a folder named after each map next to it')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='processes used to extract tiles and threads used to encode sheets (default 1)')
+    parser.add_argument('-m', '--outputs', nargs='+', choices=OUTPUT_MODES, default=['sheets', 'tmx'],
+                        help='what to write, index is a chunked tile index for random access (default sheets tmx)')
+    parser.add_argument('-s', '--shared', metavar='NAME',
+                        help='de-duplicate all maps into one tile set named NAME, and write one TMX per map')
+    parser.add_argument('--max-sheet-size', type=int, default=512, help='the largest sheet size (default 512)')
+    parser.add_argument('--min-sheet-size', type=int, default=64,
+                        help='the smallest power of two sheet size (default 64)')
+    parser.add_argument('--rect-sheets', action='store_true', help='allow rectangular sheets')
+    parser.add_argument('--any-sheet-size', action='store_true', help='allow sheet sizes that are not powers of two')
+    parser.add_argument('--padding', type=int, default=0, help='pixels of space between tiles on sheets')
+    parser.add_argument('--extrude', type=int, default=0, help='pixels of edge repeated around tiles on sheets')
+    parser.add_argument('-c', '--compression', default='default', choices=sorted(PngEncoder.PRESETS),
+                        help='sheet PNG compression preset (default default)')
+    # zstd is only offered when the zstandard module is installed
+    tmx_compressions = [compression for compression in TileExtractor.TMX_COMPRESSIONS
+                        if compression != 'zstd' or zstandard is not None]
+    parser.add_argument('--tmx-compression', default='gzip', choices=tmx_compressions,
+                        help='TMX layer data compression (default gzip)')
+    parser.add_argument('--chunk-size', type=int, default=16,
+                        help='tiles across and down the chunks of index files and infinite maps (default 16)')
+    parser.add_argument('--infinite', action='store_true', help='write TMX files as chunked infinite maps')
+    parser.add_argument('-p', '--pixel-format', default='rgb', choices=sorted(TileExtractor.PIXEL_FORMATS) + ['auto'],
+                        help='how tile pixels are stored, auto keeps palettes and transparency (default rgb)')
+    parser.add_argument('--palette', metavar='PNG', help='use the palette of a palette PNG, implies -p palette')
+    parser.add_argument('--hasher', default='crc32', choices=sorted(TileDigestIndex.HASHERS),
+                        help='tile digest used for de-duplication (default crc32)')
+    parser.add_argument('--memory-budget', type=int, help='bytes of unique tiles to keep in memory before spilling')
+    parser.add_argument('--match-flips', action='store_true', help='match flipped and rotated tiles')
+    parser.add_argument('--max-channel-error', type=int, help='near duplicate matching, largest channel difference')
+    parser.add_argument('--max-tile-error', type=int, help='near duplicate matching, largest summed difference')
+    parser.add_argument('--incremental', action='store_true',
+                        help='cache extractions and only redo what changed, not supported with --shared')
+    parser.add_argument('-q', '--quiet', action='store_true', help='print nothing')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write stage timings and counters to a JSON file, with a section for each map')
+    parser.add_argument('--profile', metavar='FILE', help='run under cProfile and write the stats to FILE')
+    args = parser.parse_args(argv)
+
+    if args.shared is not None and args.incremental:
+        parser.error('--incremental can not be used with --shared')
+    if args.match_flips and (args.max_channel_error is not None or args.max_tile_error is not None):
+        parser.error('--match-flips can not be used with near duplicate matching')
+
+    if args.offset is not None and min(args.offset) < 0:
+        parser.error('--offset can not be negative')
+    if args.chunk_size <= 0:
+        parser.error('--chunk-size has to be positive')
+    if min(args.tile_sizes) <= 0:
+        parser.error('--tile-sizes have to be positive')
+    if args.detect_rows < 0 or args.detect_columns < 0:
+        parser.error('--detect-rows and --detect-columns can not be negative')
+
+    file_paths = _expand_inputs(args.inputs)
+    missing = [file_path for file_path in file_paths if not os.path.isfile(file_path)]
+    if missing:
+        parser.error('no such file: {0}'.format(', '.join(missing)))
+
+    detect_sample = (args.detect_rows or None, args.detect_columns or None)
+    if args.detect:
+        instrumentation = Instrumentation(args.quiet)
+        for file_path in file_paths:
+            candidates = detect_tile_grid(file_path, args.tile_sizes, instrumentation, *detect_sample)
+            for candidate in candidates[:5]:
+                instrumentation.log('  tile size {tile_size} offset ({offset_x}, {offset_y}): {unique_tiles} unique '
+                                    'of {num_tiles} tiles, {score:.3f} bytes per pixel'.format(**candidate))
+        return 0
+
+    def get_sheet_packer(tile_size):
+        return SheetPacker(tile_size, args.max_sheet_size, args.min_sheet_size, not args.rect_sheets,
+                           not args.any_sheet_size, args.padding, args.extrude)
+
+    auto = args.tile_size == 'auto'
+    edge_mode = args.edges
+    if edge_mode is None:
+        edge_mode = 'crop' if auto else 'strict'
+    sheet_packer = None
+    if not auto:
+        try:
+            sheet_packer = get_sheet_packer(args.tile_size)
+        except ValueError as error:
+            parser.error(str(error))
+
+    index_options = {'hasher': args.hasher, 'match_flips': args.match_flips,
+                     'max_channel_error': args.max_channel_error, 'max_tile_error': args.max_tile_error,
+                     'pixel_format': args.pixel_format, 'palette': None}
+    if args.palette is not None:
+        try:
+            index_options['palette'] = TileExtractor.read_palette(args.palette)
+        except (IOError, OSError, ValueError, png.Error) as error:
+            parser.error(str(error))
+        index_options['pixel_format'] = 'palette'
+    if index_options['pixel_format'] == 'palette' and \
+            (args.max_channel_error is not None or args.max_tile_error is not None):
+        parser.error('near duplicate matching can not be used with palette pixels')
+    instrumentation = Instrumentation(args.quiet, profile_file=args.profile)
+    map_metrics = {}
+
+    def get_grid(file_path, grid_instrumentation, tile_size=None):
+        """
+        :return: tuple of (tile size, (offset x, offset y)) of a map, detected with -t auto. A given tile size only
+                 has its offset detected.
+        """
+        offset = tuple(args.offset) if args.offset is not None else (0, 0)
+        if not auto:
+            return args.tile_size, offset
+        candidates = detect_tile_grid(file_path, [tile_size] if tile_size else args.tile_sizes,
+                                      grid_instrumentation, *detect_sample)
+        if not candidates:
+            raise ValueError('no tile grid detected, use --tile-size')
+        best = candidates[0]
+        if args.offset is None:
+            offset = (best['offset_x'], best['offset_y'])
+        return best['tile_size'], offset
+
+    tmx_chunk_size = args.chunk_size if args.infinite else None
+
+    def run():
+        if args.shared is not None:
+            out_folder = args.output_dir
+            if out_folder is None:
+                out_folder = os.path.join(os.path.dirname(file_paths[0]), args.shared)
+            # A shared tile set has one tile size, from the first map, each map has its own offset
+            try:
+                tile_size, offset = get_grid(file_paths[0], instrumentation)
+                offsets = {file_paths[0]: offset}
+                for file_path in file_paths[1:]:
+                    offsets[file_path] = get_grid(file_path, instrumentation, tile_size)[1]
+                shared_packer = sheet_packer if sheet_packer is not None else get_sheet_packer(tile_size)
+            except ValueError as error:
+                instrumentation.log('Skipping {0}, {1}'.format(args.shared, error))
+                return 1
+            shared, maps = create_shared_tile_sheet_from_files(
+                file_paths, tile_size, out_folder, args.shared, args.workers, args.memory_budget,
+                args.compression, args.outputs, args.tmx_compression, instrumentation, shared_packer, offsets,
+                edge_mode, tmx_chunk_size, args.chunk_size, **index_options)
+            return 0 if len(maps) == len(file_paths) else 1
+
+        failed = 0
+        for file_path in file_paths:
+            # Every map gets its own metrics so slow maps stand out
+            map_instrumentation = Instrumentation(args.quiet)
+            try:
+                tile_size, offset = get_grid(file_path, map_instrumentation)
+                map_packer = sheet_packer if sheet_packer is not None else get_sheet_packer(tile_size)
+                extractor = create_unique_tile_sheet_from_file(
+                    file_path, tile_size, args.workers, args.memory_budget, args.compression, args.incremental,
+                    args.output_dir, args.outputs, args.tmx_compression, map_instrumentation, map_packer,
+                    tmx_chunk_size, args.chunk_size, offset_x=offset[0], offset_y=offset[1], edge_mode=edge_mode,
+                    **index_options)
+            except ValueError as error:
+                # Such as too many colors for a palette
+                map_instrumentation.log('Skipping {0}, {1}'.format(file_path, error))
+                extractor = None
+            instrumentation.merge(map_instrumentation.timings, map_instrumentation.counters)
+            map_metrics[file_path] = map_instrumentation.get_metrics()
+            if extractor is None or not extractor.has_validate_tiles():
+                failed += 1
+        return 1 if failed else 0
+
+    exit_code = instrumentation.run(run)
+    if args.metrics is not None:
+        instrumentation.write_json(args.metrics, maps=map_metrics)
+    return exit_code
 
 # ----------------------------------------------------------------------------------------------------------------------
 if __name__ == '__main__':
-    create_unique_tile_sheet_from_file('onett_full.png', 32)
\ No newline at end of file
+    sys.exit(main())